@@ -0,0 +1,306 @@
+"""Resumable, multi-process classification and Grad-CAM over patch collections.
+
+    python batch_job.py "patches/centered_*/*.npy" shards/ --models cnn resnet u_net \\
+        --out results.h5 --workers 4
+
+Inputs are globs of .npy U/V patches and/or shard directories written by
+pack_flow_patches. Every input item gets a fixed row in the result store, and
+the rows are split into chunks that N spawned worker processes work through.
+Each worker is pinned to its own share of the CPUs and sizes TensorFlow's
+thread pools to match. With --batch-size auto (the default) each worker
+also picks the largest batch that fits its share of the memory budget.
+
+results.h5 (written by the parent process only):
+
+    paths                 (N,) source path of every row
+    labels                (N,) int8 class index from the directory name, -1 if unknown
+    valid                 (N,) bool, False for rows whose file failed to load
+    <model>/probabilities (N, 3) float32
+    <model>/classes       (N,) int8 predicted class
+    <model>/heatmaps      (N, h, w) float16 Grad-CAM, unless --no-heatmaps
+
+results.h5.manifest lists the chunks that are in the file, one JSON line
+each, appended only after the chunk's rows are flushed. Re-running the same
+command skips those chunks, so an interrupted run resumes where it stopped.
+Because every chunk writes to fixed rows, a chunk that is redone after a
+crash simply overwrites itself.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+log = logging.getLogger("batch_job")
+
+SHARD_INDEX = "index.json"
+
+# Per-process state of a worker, set up once by _init_worker
+_worker = {}
+
+
+def _is_shard_dir(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, SHARD_INDEX))
+
+
+def plan_items(inputs):
+    """
+    Flatten the inputs into rows.
+
+    Returns (sources, paths): sources is a list of (kind, ref, offset, count)
+    with kind "files" (ref: list of paths) or "shards" (ref: shard directory)
+    and paths the source path of every row.
+    """
+    from flow_data import expand_paths
+    from flow_shards import FlowShards
+
+    sources, paths = [], []
+    files = []
+
+    def flush_files():
+        if files:
+            sources.append(("files", list(files), len(paths), len(files)))
+            paths.extend(files)
+            files.clear()
+
+    for item in inputs:
+        if _is_shard_dir(item):
+            flush_files()
+            shards = FlowShards(item)
+            sources.append(("shards", item, len(paths), len(shards)))
+            paths.extend(shards.paths)
+        else:
+            files.extend(expand_paths(item))
+    flush_files()
+    return sources, paths
+
+
+def plan_chunks(sources, chunk_size):
+    """(chunk id, kind, ref, local start, local stop, global start) per chunk; chunks never span sources."""
+    chunks = []
+    for kind, ref, offset, count in sources:
+        for lo in range(0, count, chunk_size):
+            hi = min(lo + chunk_size, count)
+            chunk_ref = ref[lo:hi] if kind == "files" else ref
+            chunks.append((len(chunks), kind, chunk_ref, lo, hi, offset + lo))
+    return chunks
+
+
+def _cpu_share(worker_id, num_workers):
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    return cpus[worker_id::num_workers] if len(cpus) >= num_workers else cpus
+
+
+def _init_worker(worker_ids, num_workers, models, weights, untrained, batch_size, heatmaps):
+    worker_id = worker_ids.get()
+    cpus = _cpu_share(worker_id, num_workers)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+    # Thread pools can only be sized before TensorFlow runs anything
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cpus))
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    from gradcam_engine import GradCamComparison
+    from memory_budget import memory_budget, resolve_batch_size
+    from models import get_model, set_weights_path
+    from quantized_inference import XLARunner
+
+    for name, path in weights.items():
+        set_weights_path(name, path)
+    networks = {name: get_model(name, weights=None, logits=True) if untrained else get_model(name, logits=True)
+                for name in models}
+    batch_size = resolve_batch_size(batch_size, networks, "gradcam" if heatmaps else "predict",
+                                    budget=memory_budget(share=num_workers))
+    log.info("worker %d: batch size %d", worker_id, batch_size)
+    _worker.update(
+        id=worker_id, names=list(models), heatmaps=heatmaps, shards={},
+        comparison=GradCamComparison(networks, batch_size=batch_size) if heatmaps else None,
+        runners=None if heatmaps else {name: XLARunner(model, batch_size=batch_size)
+                                       for name, model in networks.items()},
+    )
+
+
+def _load_chunk(kind, ref, lo, hi):
+    from flow_data import PATCH_SHAPE, magnitude_patch
+    from flow_shards import FlowShards, label_from_path
+
+    if kind == "shards":
+        if ref not in _worker["shards"]:
+            _worker["shards"][ref] = FlowShards(ref)
+        shards = _worker["shards"][ref]
+        return (np.asarray(shards.magnitude(lo, hi)), np.asarray(shards.labels(lo, hi)),
+                np.ones(hi - lo, bool))
+
+    patches = np.zeros((len(ref),) + PATCH_SHAPE, np.float32)
+    valid = np.zeros(len(ref), bool)
+    for i, path in enumerate(ref):
+        try:
+            patch = magnitude_patch(np.load(path))
+            if patch.shape == PATCH_SHAPE:
+                patches[i] = patch
+                valid[i] = True
+        except Exception as e:
+            log.warning("skipping %s: %r", path, e)
+    labels = np.array([label_from_path(p) for p in ref], dtype=np.int8)
+    return patches, labels, valid
+
+
+def _run_chunk(chunk):
+    import tensorflow as tf
+
+    chunk_id, kind, ref, lo, hi, start = chunk
+    patches, labels, valid = _load_chunk(kind, ref, lo, hi)
+    results = {}
+    if _worker["heatmaps"]:
+        explained = _worker["comparison"].compute(patches)
+        for name in _worker["names"]:
+            results[name] = (explained[name].predictions, explained[name].heatmaps.astype(np.float16))
+    else:
+        for name in _worker["names"]:
+            results[name] = (_worker["runners"][name].predict(patches), None)
+
+    out = {}
+    for name, (preds, heatmaps) in results.items():
+        probabilities = tf.nn.softmax(preds).numpy()
+        out[name] = {"probabilities": probabilities, "classes": probabilities.argmax(axis=1).astype(np.int8),
+                     "heatmaps": heatmaps}
+    return chunk_id, start, labels, valid, out
+
+
+def _inputs_digest(paths, models, heatmaps):
+    digest = hashlib.sha256()
+    for p in paths:
+        digest.update(p.encode() + b"\0")
+    digest.update(json.dumps([models, heatmaps]).encode())
+    return digest.hexdigest()
+
+
+class ResultStore:
+    """
+    The consolidated HDF5 file plus its manifest of finished chunks.
+
+    Opening an existing store checks it was made for the same inputs and
+    models, and then reports which chunks are already done.
+    """
+    def __init__(self, path, paths, models, heatmaps):
+        import h5py
+
+        self.path = path
+        self.manifest_path = path + ".manifest"
+        digest = _inputs_digest(paths, models, heatmaps)
+        if os.path.exists(path):
+            self.h5 = h5py.File(path, "r+")
+            if self.h5.attrs.get("inputs") != digest:
+                raise ValueError(f"{path} was written for other inputs or models; use a new --out path.")
+        else:
+            self.h5 = h5py.File(path, "w")
+            self.h5.attrs["inputs"] = digest
+            self.h5.attrs["models"] = json.dumps(models)
+            self.h5.create_dataset("paths", data=np.array(paths, dtype=object), dtype=h5py.string_dtype())
+            self.h5.create_dataset("labels", shape=(len(paths),), dtype=np.int8, fillvalue=-1)
+            self.h5.create_dataset("valid", shape=(len(paths),), dtype=bool)
+            if os.path.exists(self.manifest_path):
+                os.remove(self.manifest_path)
+        self.done = set()
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as fh:
+                for line in fh:
+                    if line.strip():
+                        self.done.add(json.loads(line)["chunk"])
+        self._manifest = open(self.manifest_path, "a")
+
+    def _dataset(self, name, shape, dtype):
+        if name not in self.h5:
+            n = len(self.h5["paths"])
+            chunks = (min(n, 256),) + tuple(shape)
+            self.h5.create_dataset(name, shape=(n,) + tuple(shape), dtype=dtype, chunks=chunks)
+        return self.h5[name]
+
+    def write(self, chunk_id, start, labels, valid, results):
+        stop = start + len(labels)
+        self.h5["labels"][start:stop] = labels
+        self.h5["valid"][start:stop] = valid
+        for name, arrays in results.items():
+            for key, array in arrays.items():
+                if array is not None:
+                    self._dataset(f"{name}/{key}", array.shape[1:], array.dtype)[start:stop] = array
+        self.h5.flush()
+        self._manifest.write(json.dumps({"chunk": chunk_id, "start": start, "stop": stop}) + "\n")
+        self._manifest.flush()
+        os.fsync(self._manifest.fileno())
+        self.done.add(chunk_id)
+
+    def close(self):
+        self._manifest.close()
+        self.h5.close()
+
+
+def run_job(inputs, models, out, workers=1, chunk_size=1024, batch_size="auto", heatmaps=True,
+            weights=None, untrained=False):
+    """Run (or resume) a job; returns the number of chunks processed in this call."""
+    sources, paths = plan_items(inputs)
+    if not paths:
+        raise ValueError("no input patches found")
+    chunks = plan_chunks(sources, chunk_size)
+    store = ResultStore(out, paths, list(models), heatmaps)
+    todo = [c for c in chunks if c[0] not in store.done]
+    log.info("%d patches in %d chunks, %d already done", len(paths), len(chunks), len(chunks) - len(todo))
+
+    context = multiprocessing.get_context("spawn")
+    worker_ids = context.Queue()
+    for i in range(workers):
+        worker_ids.put(i)
+    started, processed, patches = time.perf_counter(), 0, 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(worker_ids, workers, list(models), weights or {}, untrained,
+                                           batch_size, heatmaps)) as pool:
+            futures = [pool.submit(_run_chunk, c) for c in todo]
+            for future in as_completed(futures):
+                result = future.result()
+                store.write(*result)
+                processed += 1
+                patches += len(result[2])
+                log.info("chunk %d/%d done, %.0f patches/s", len(store.done), len(chunks),
+                         patches / (time.perf_counter() - started))
+    finally:
+        store.close()
+    return processed
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("inputs", nargs="+", help="globs of .npy patches and/or shard directories")
+    parser.add_argument("--models", nargs="+", default=["cnn", "resnet", "u_net"])
+    parser.add_argument("--out", required=True, help="HDF5 result store (resumed if it exists)")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--batch-size", default="auto", help='per worker; "auto" fits it to the memory budget')
+    parser.add_argument("--no-heatmaps", dest="heatmaps", action="store_false")
+    parser.add_argument("--weights", nargs="*", default=[], metavar="NAME=PATH",
+                        help="weights file per model, overriding models.WEIGHTS_PATHS")
+    parser.add_argument("--untrained", action="store_true", help="random weights, for smoke tests")
+    parser.add_argument("--log-level", default="INFO")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(name)s %(message)s")
+    weights = dict(w.split("=", 1) for w in args.weights)
+    run_job(args.inputs, args.models, args.out, args.workers, args.chunk_size, args.batch_size,
+            args.heatmaps, weights, args.untrained)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
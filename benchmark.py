@@ -0,0 +1,302 @@
+"""Throughput and latency benchmarks for every stage of the comparison pipeline.
+
+Runs on synthetic CW/CCW/saddle patches (see synthetic_flows.py), so it needs
+no Drive data and no trained weights; timings do not depend on the weights.
+For every thread count, batch size and model it measures:
+
+    load        FlowPatchLoader over .npy files in a temp directory
+    magnitude   magnitude_batch on U/V arrays
+    predict     model.predict
+    gradcam     GradCamEngine.compute (forward + backward)
+    colorize    colorize_heatmaps
+    render      render_panel in fast mode (batch size 1 only)
+
+and reports patches per second, p50/p99 latency per batch, and the peak
+resident memory during the stage together with its growth over the RSS the
+stage started from. On Linux the peak is reset before every stage (through
+/proc/self/clear_refs), so it is that stage's own peak; elsewhere only the
+process-lifetime peak is available and the growth is a lower bound.
+TensorFlow's thread pools can only be sized once per process, so each thread
+count runs in its own subprocess.
+
+    python benchmark.py --models cnn u_net --batch-sizes 1 8 32 --threads 1 4 \\
+        --out bench.json --baseline previous.json --threshold 0.15
+
+exits with status 1 if any stage is more than `threshold` slower than in the
+baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+STAGES = ("load", "magnitude", "predict", "gradcam", "colorize", "render")
+
+
+def _status_mb(field):
+    # VmHWM / VmRSS from /proc/self/status, None where there is no procfs
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """Peak resident memory since the last reset_peak_rss() (Linux) or since start."""
+    peak = _status_mb("VmHWM")
+    if peak is not None:
+        return peak
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb():
+    rss = _status_mb("VmRSS")
+    return peak_rss_mb() if rss is None else rss
+
+
+def reset_peak_rss():
+    """
+    Start a new peak-RSS window and return the current RSS in MB.
+
+    Writing 5 to /proc/self/clear_refs resets VmHWM (Linux 4.0+); where that
+    is not possible the window keeps the process-lifetime peak.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+    return current_rss_mb()
+
+
+def _summarize(stage, model, batch_size, threads, latencies, patches, rss_start):
+    latencies = np.asarray(latencies)
+    peak = peak_rss_mb()
+    return {
+        "stage": stage,
+        "model": model,
+        "batch_size": batch_size,
+        "threads": threads,
+        "patches": int(patches),
+        "patches_per_s": float(patches / latencies.sum()),
+        "p50_ms": float(np.percentile(latencies, 50) * 1e3),
+        "p99_ms": float(np.percentile(latencies, 99) * 1e3),
+        "peak_rss_mb": float(peak),
+        "rss_delta_mb": float(max(peak - rss_start, 0.0)),
+    }
+
+
+def _time_batches(fn, batches, warmup=1):
+    for batch in batches[:warmup]:
+        fn(batch)
+    latencies = []
+    for batch in batches:
+        start = time.perf_counter()
+        fn(batch)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _split(array, batch_size):
+    # The last batch may be short; every patch is timed
+    return [array[i:i + batch_size] for i in range(0, len(array), batch_size)]
+
+
+def _set_threads(threads):
+    # TensorFlow sizes its pools once, when the first op runs in the process
+    import tensorflow as tf
+
+    if not threads:
+        return
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    except RuntimeError:
+        if tf.config.threading.get_intra_op_parallelism_threads() != threads:
+            raise RuntimeError(f"TensorFlow already runs in this process, so it cannot switch to {threads} "
+                               "threads; use main() (one subprocess per thread count) or threads=None") from None
+
+
+def run_benchmarks(models, batch_sizes, threads=None, num_patches=256, stages=STAGES, seed=0):
+    """
+    Benchmark every stage in this process with `threads` TensorFlow threads.
+
+    threads=None keeps the process's current thread pools. A thread count
+    can only be set before TensorFlow first runs, which is why main() calls
+    this in a fresh subprocess per count.
+    """
+    if num_patches < 1 or min(batch_sizes) < 1:
+        raise ValueError("num_patches and every batch size must be at least 1")
+    _set_threads(threads)
+
+    from flow_data import FlowPatchLoader, magnitude_batch
+    from gradcam_engine import GradCamEngine
+    from heatmap_overlay import colorize_heatmaps
+    from models import get_model
+    from panel_renderer import render_panel
+    from synthetic_flows import flow_batch
+
+    uv, _ = flow_batch(num_patches, seed=seed)
+    mag = magnitude_batch(uv)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i, patch in enumerate(uv):
+            paths.append(os.path.join(tmp, f"{i}.npy"))
+            np.save(paths[-1], patch)
+
+        for batch_size in batch_sizes:
+            if "load" in stages:
+                rss_start = reset_peak_rss()
+                loader = FlowPatchLoader(paths, batch_size=batch_size, num_threads=threads)
+                latencies, start = [], time.perf_counter()
+                for _ in loader:
+                    now = time.perf_counter()
+                    latencies.append(now - start)
+                    start = now
+                results.append(_summarize("load", "-", batch_size, threads, latencies, len(paths),
+                                          rss_start))
+
+            if "magnitude" in stages:
+                rss_start = reset_peak_rss()
+                batches = _split(uv, batch_size)
+                latencies = _time_batches(magnitude_batch, batches)
+                results.append(_summarize("magnitude", "-", batch_size, threads, latencies,
+                                          len(uv), rss_start))
+
+            heatmaps = None
+            for name in models:
+                model = get_model(name, weights=None, logits=True)
+                batches = _split(mag, batch_size)
+                patches = len(mag)
+                if "predict" in stages:
+                    rss_start = reset_peak_rss()
+                    latencies = _time_batches(
+                        lambda b: model.predict(b, batch_size=batch_size, verbose=0), batches)
+                    results.append(_summarize("predict", name, batch_size, threads, latencies, patches,
+                                              rss_start))
+                if "gradcam" in stages or "colorize" in stages:
+                    rss_start = reset_peak_rss()
+                    engine = GradCamEngine(model, batch_size=batch_size)
+                    latencies = _time_batches(engine.compute, batches)
+                    if "gradcam" in stages:
+                        results.append(_summarize("gradcam", name, batch_size, threads, latencies, patches,
+                                                  rss_start))
+                    if heatmaps is None:
+                        heatmaps = engine.compute(mag)
+
+            if "colorize" in stages and heatmaps is not None:
+                rss_start = reset_peak_rss()
+                batches = _split(heatmaps, batch_size)
+                latencies = _time_batches(colorize_heatmaps, batches)
+                results.append(_summarize("colorize", "-", batch_size, threads, latencies,
+                                          len(heatmaps), rss_start))
+
+        if "render" in stages:
+            count = min(16, num_patches)
+            rss_start = reset_peak_rss()
+            overlays = np.random.default_rng(seed).random((count, 64, 64, 3), dtype=np.float32)
+            out_path = os.path.join(tmp, "panel.png")
+            latencies = _time_batches(
+                lambda i: render_panel({'path': paths[i], 'U': uv[i, 0], 'V': uv[i, 1],
+                                        'image': mag[i, :, :, 0], 'overlays': {'cnn': overlays[i]}},
+                                       out_path, fast=True),
+                list(range(count)))
+            results.append(_summarize("render", "-", 1, threads, latencies, count, rss_start))
+
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """Stages whose throughput fell more than `threshold` (a fraction) below the baseline."""
+    def key(r):
+        return (r["stage"], r["model"], r["batch_size"], r["threads"])
+
+    previous = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        old = previous.get(key(r))
+        if old is not None and r["patches_per_s"] < old["patches_per_s"] * (1.0 - threshold):
+            regressions.append({**r, "baseline_patches_per_s": old["patches_per_s"]})
+    return regressions
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--models", nargs="+", default=["cnn", "resnet", "u_net"])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--threads", nargs="+", type=int, default=[os.cpu_count() or 1])
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--patches", type=int, default=256)
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="allowed throughput drop against the baseline, as a fraction")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+
+    if args.worker:
+        results = run_benchmarks(args.models, args.batch_sizes, args.threads[0], args.patches, args.stages)
+        json.dump(results, sys.stdout)
+        return 0
+
+    results = []
+    for threads in args.threads:
+        cmd = [sys.executable, os.path.abspath(__file__), "--worker", "--threads", str(threads),
+               "--models", *args.models, "--batch-sizes", *map(str, args.batch_sizes),
+               "--stages", *args.stages, "--patches", str(args.patches)]
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.extend(json.loads(out))
+
+    import tensorflow as tf
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "tensorflow": tf.__version__,
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as fh:
+        json.dump(report, fh, indent=2)
+
+    for r in results:
+        print(f"{r['stage']:<10} {r['model']:<7} batch={r['batch_size']:<4} threads={r['threads']:<3} "
+              f"{r['patches_per_s']:10.1f} patches/s  p50={r['p50_ms']:8.2f} ms  p99={r['p99_ms']:8.2f} ms  "
+              f"rss={r['peak_rss_mb']:.0f} MB (+{r['rss_delta_mb']:.0f})")
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = find_regressions(results, json.load(fh), args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['stage']} {r['model']} batch={r['batch_size']} threads={r['threads']}: "
+                  f"{r['patches_per_s']:.1f} < {r['baseline_patches_per_s']:.1f} patches/s")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""Confidence-gated model cascade for bulk classification.
+
+Running CNN, ResNet101 and U-Net on every patch is wasteful when the small
+CNN is already sure. ModelCascade scores each batch with a predict-only
+(XLA-compiled) pass of the first model, and sends just the patches whose
+top-class probability (or top-two margin) is below a threshold on to the
+heavier models. With gradcam=True the first model's Grad-CAM pass gives
+both its heatmaps and the gating predictions for every patch, and the heavy
+models' heatmaps are computed for the escalated patches only; with
+gradcam=False no gradient step is built or run at all.
+
+e.g. cascade = ModelCascade({'cnn': get_model('cnn', logits=True),
+                             'resnet': get_model('resnet', logits=True),
+                             'u_net': get_model('u_net', logits=True)}, threshold=0.9)
+     result = cascade.classify(patches, gradcam=False)
+     print(cascade.report())
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from gradcam_engine import GradCamComparison, GradCamEngine, ModelExplanation
+from quantized_inference import XLARunner
+
+# classes/probabilities: final decision per patch. escalated: bool mask of
+# the patches that went past the first stage. explanations: model name ->
+# (indices into the batch, ModelExplanation for those patches)
+CascadeResult = namedtuple("CascadeResult", ["classes", "probabilities", "escalated", "explanations"])
+
+
+def _softmax(x):
+    x = x - x.max(axis=1, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+class ModelCascade:
+    """
+    First model scores everything, the rest only the uncertain patches.
+
+    models is an ordered dict: the first entry is the cheap model, the others
+    are the escalation stage. Every model gets an XLARunner for predictions;
+    with gradcam=True the first one also gets a GradCamEngine and the others
+    run together through one fused GradCamComparison. A patch escalates when
+    its first-stage top probability is below `threshold`, or when `margin` is
+    set and the gap between the top two probabilities is below it. Escalated
+    patches are decided by the mean probability of all models. Set
+    from_logits=False for models that end in a softmax. batch_size caps each
+    runner's and engine's batch; "auto" sizes them to the memory budget
+    instead, for offline runs over whole shards.
+    """
+    def __init__(self, models, threshold=0.9, margin=None, gradcam=True, batch_size=32,
+                 from_logits=True):
+        names = list(models)
+        self.first = names[0]
+        self.rest = names[1:]
+        self.threshold = threshold
+        self.margin = margin
+        self.gradcam = gradcam
+        self.from_logits = from_logits
+        self._runners = {name: XLARunner(models[name], batch_size=batch_size) for name in names}
+        self._first_engine = self._rest_comparison = None
+        if gradcam:
+            self._first_engine = GradCamEngine(models[self.first], batch_size=batch_size)
+            if self.rest:
+                self._rest_comparison = GradCamComparison({n: models[n] for n in self.rest},
+                                                          batch_size=batch_size)
+        self.stage_counts = {name: 0 for name in names}
+        self.patches = 0
+
+    def _probabilities(self, preds):
+        return _softmax(preds) if self.from_logits else np.asarray(preds)
+
+    def _uncertain(self, probs):
+        top2 = np.sort(probs, axis=1)[:, -2:]
+        uncertain = top2[:, 1] < self.threshold
+        if self.margin is not None:
+            uncertain |= (top2[:, 1] - top2[:, 0]) < self.margin
+        return uncertain
+
+    def _run_rest(self, img_array, gradcam):
+        # name -> ModelExplanation of the escalation models on img_array
+        if gradcam:
+            return self._rest_comparison.compute(img_array)
+        results = {}
+        for name in self.rest:
+            preds = self._runners[name].predict(img_array)
+            results[name] = ModelExplanation(preds, preds.argmax(axis=1), None)
+        return results
+
+    def classify(self, img_array, gradcam=None):
+        """
+        Run the cascade on a batch; returns a CascadeResult.
+
+        gradcam=False skips the heatmaps for this call (they are None in the
+        explanations); the default follows the constructor.
+        """
+        gradcam = self.gradcam and (gradcam is None or bool(gradcam))
+        img_array = np.asarray(img_array, dtype=np.float32)
+        n = len(img_array)
+        if gradcam:
+            # The tape's forward pass gives the gating predictions as well
+            heatmaps, preds, classes = self._first_engine.compute(img_array, return_predictions=True)
+        else:
+            preds = self._runners[self.first].predict(img_array)
+            heatmaps, classes = None, preds.argmax(axis=1)
+        first_probs = self._probabilities(preds)
+        if not n:
+            return CascadeResult(np.zeros(0, np.int64), first_probs, np.zeros(0, bool), {})
+        explanations = {self.first: (np.arange(n), ModelExplanation(preds, classes, heatmaps))}
+
+        escalated = self._uncertain(first_probs) if self.rest else np.zeros(n, bool)
+        probabilities = first_probs.copy()
+        index = np.flatnonzero(escalated)
+        if index.size:
+            results = self._run_rest(img_array[index], gradcam)
+            stacked = [first_probs[index]]
+            for name in self.rest:
+                r = results[name]
+                stacked.append(self._probabilities(r.predictions))
+                explanations[name] = (index, r)
+                self.stage_counts[name] += int(index.size)
+            probabilities[index] = np.mean(stacked, axis=0)
+
+        self.patches += n
+        self.stage_counts[self.first] += n
+        return CascadeResult(probabilities.argmax(axis=1), probabilities, escalated, explanations)
+
+    __call__ = classify
+
+    def full_ensemble(self, img_array):
+        """Mean probability of every model on every patch (predictions only), for comparison."""
+        img_array = np.asarray(img_array, dtype=np.float32)
+        return np.mean([self._probabilities(runner.predict(img_array)) for runner in self._runners.values()],
+                       axis=0)
+
+    def report(self):
+        lines = [f"{self.patches} patches"]
+        for name, count in self.stage_counts.items():
+            share = count / self.patches if self.patches else 0.0
+            lines.append(f"  {name:<8} ran on {count:>8} ({share:6.1%})")
+        return "\n".join(lines)
+
+
+def evaluate_cascade(cascade, batches):
+    """
+    Compare the cascade with always running the full ensemble.
+
+    batches yields tuples whose first item is the patches and last item the
+    labels as class indices (-1 for unlabeled), e.g. FlowShards.iter_batches
+    or zip(patches, labels) chunks. Returns a dict with the share
+    of escalated patches, the cascade and full-ensemble accuracies on the
+    labeled patches and how often the two agree. Only predictions are
+    computed; no Grad-CAM runs.
+    """
+    total = escalated = agree = labeled = cascade_correct = full_correct = 0
+    for batch in batches:
+        patches, labels = batch[0], np.asarray(batch[-1])
+        result = cascade.classify(patches, gradcam=False)
+        full = cascade.full_ensemble(patches).argmax(axis=1)
+        mask = labels >= 0
+        total += len(labels)
+        escalated += int(result.escalated.sum())
+        agree += int((result.classes == full).sum())
+        labeled += int(mask.sum())
+        cascade_correct += int((result.classes[mask] == labels[mask]).sum())
+        full_correct += int((full[mask] == labels[mask]).sum())
+    return {
+        "patches": total,
+        "escalated": escalated / total if total else 0.0,
+        "agreement": agree / total if total else 0.0,
+        "cascade_accuracy": cascade_correct / labeled if labeled else None,
+        "full_accuracy": full_correct / labeled if labeled else None,
+        "accuracy_change": (cascade_correct - full_correct) / labeled if labeled else None,
+    }
@@ -0,0 +1,363 @@
+"""Penultimate-layer embeddings and a k-NN index for similar-patch lookups.
+
+"Show me the 20 training patches most like this misclassified saddle":
+
+    extractor = EmbeddingExtractor(get_model('cnn'))          # Dense(512) features
+    index = EmbeddingIndex.create("emb-cnn", extractor.dim)
+    index_corpus(extractor, FlowShards("shards/"), index)     # skips what is indexed
+    paths, scores = index.neighbors(extractor.embed(patch), k=20)
+
+The embeddings live in an on-disk float16 matrix (embeddings.f16, opened as a
+np.memmap) next to index.json holding the source path of every row, so an
+index over hundreds of thousands of patches opens instantly and grows in
+place. Rows are stored L2 normalized (cosine similarity is all the search
+needs, and it keeps large activations inside the float16 range).
+
+Exact search scores every row. When a float32 copy of the matrix fits the
+memory budget it is kept resident and a batch of queries is one matrix
+product (about 40 ms for one query over 300k x 512 on one core); otherwise
+the memmap is read block by block and each block cast on its own (about
+250 ms). For millisecond lookups, build_lists() clusters the rows into
+inverted lists (spherical k-means, about sqrt(n) lists; a few seconds for
+300k rows) and query(..., nprobe=8) scores only the rows of the lists whose
+centroids are closest to each query (about 1 ms). That is approximate:
+recall grows with nprobe and depends on how clustered the embeddings are. The lists are saved next to the matrix (lists.npz) and new rows are
+assigned to them as they are added.
+"""
+
+import json
+import os
+
+import numpy as np
+from tensorflow import keras
+from tensorflow.keras import layers
+
+from flow_data import FlowPatchLoader, expand_paths
+from flow_shards import FlowShards
+from memory_budget import memory_budget
+from quantized_inference import XLARunner
+
+INDEX_FILE = "index.json"
+MATRIX_FILE = "embeddings.f16"
+LISTS_FILE = "lists.npz"
+
+
+def _producer(tensor):
+    return tensor._keras_history[0]
+
+
+def embedding_model(model, layer_name=None):
+    """
+    Sub-model returning the features that feed the classification head.
+
+    By default this walks back from the last Dense layer past Dropout, so the
+    cnn gives its Dense(512) output. A Flatten over a multi-channel feature
+    map (the ResNet101 trunk) is replaced by global average pooling; the
+    U-Net's single-channel map stays flattened. With `layer_name`, that
+    layer's output is used instead, pooled if it is a feature map.
+    """
+    if layer_name is not None:
+        features = model.get_layer(layer_name).output
+    else:
+        features = model.layers[-1].input
+        while isinstance(_producer(features), (layers.Dropout, layers.Flatten)):
+            layer = _producer(features)
+            if isinstance(layer, layers.Flatten) and layer.input.shape[-1] == 1:
+                break
+            features = layer.input
+    if len(features.shape) == 4:
+        features = layers.GlobalAveragePooling2D()(features)
+    return keras.Model(model.input, features)
+
+
+class EmbeddingExtractor:
+    """
+    Batched embedding pass for one model, compiled for a fixed batch size
+    (by default the largest that fits the memory budget).
+
+    e.g. vectors = EmbeddingExtractor(resnet, batch_size=512).embed(patches)  # (N, 2048)
+    """
+    def __init__(self, model, layer_name=None, batch_size="auto"):
+        self.model = embedding_model(model, layer_name)
+        self.dim = int(self.model.output.shape[-1])
+        self._runner = XLARunner(self.model, batch_size=batch_size)
+        self.batch_size = self._runner.batch_size
+
+    def embed(self, img_array):
+        img_array = np.asarray(img_array, dtype=np.float32)
+        if img_array.ndim == 3:
+            img_array = img_array[np.newaxis]
+        if not len(img_array):
+            return np.zeros((0, self.dim), np.float32)
+        return self._runner.predict(img_array)
+
+    __call__ = embed
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, rows, k):
+    # The k best (scores, rows) of every query, best first
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores, rows = np.take_along_axis(scores, keep, axis=1), np.take_along_axis(rows, keep, axis=1)
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(rows, order, axis=1)
+
+
+class EmbeddingIndex:
+    """
+    Growable memory-mapped embedding matrix with cosine k-NN.
+
+    add() appends rows (the file grows by doubling), query() answers a batch
+    of queries at once, exactly or, after build_lists(), approximately from
+    the nearest inverted lists. resident="auto" keeps a float32 copy of the
+    matrix in memory when it fits the memory budget (True / False force it).
+    Reopening the directory keeps everything added and flushed so far.
+    """
+    def __init__(self, directory, block_size=65536, resident="auto"):
+        self.directory = directory
+        self.block_size = int(block_size)
+        self.resident = resident
+        with open(os.path.join(directory, INDEX_FILE)) as fh:
+            meta = json.load(fh)
+        self.dim = meta["dim"]
+        self.meta = meta.get("meta", {})
+        self.paths = meta["paths"]
+        self._offset = {p: i for i, p in enumerate(self.paths)}
+        self._capacity = meta["capacity"]
+        self._matrix = self._open(self._capacity)
+        self._resident = None
+        self.centroids = None
+        self._assignment = np.zeros(0, np.int32)
+        self._members = None
+        lists_path = os.path.join(directory, LISTS_FILE)
+        if os.path.exists(lists_path):
+            with np.load(lists_path) as lists:
+                self.centroids = lists["centroids"]
+                # Rows added after the last flush of the lists are assigned now
+                self._assignment = lists["assignment"][:len(self.paths)]
+            self._assign(len(self._assignment), len(self.paths))
+
+    @classmethod
+    def create(cls, directory, dim, meta=None, capacity=4096, **kwargs):
+        """Start an empty index, or open the existing one in `directory`."""
+        if os.path.exists(os.path.join(directory, INDEX_FILE)):
+            index = cls(directory, **kwargs)
+            if index.dim != dim:
+                raise ValueError(f"{directory} holds {index.dim}-d embeddings, not {dim}-d")
+            return index
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, MATRIX_FILE), "wb") as fh:
+            fh.truncate(capacity * dim * 2)
+        with open(os.path.join(directory, INDEX_FILE), "w") as fh:
+            json.dump({"dim": int(dim), "capacity": int(capacity), "meta": meta or {}, "paths": []}, fh)
+        return cls(directory, **kwargs)
+
+    def _open(self, capacity):
+        return np.memmap(os.path.join(self.directory, MATRIX_FILE), dtype=np.float16, mode="r+",
+                         shape=(capacity, self.dim))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self._offset
+
+    def offset_of(self, path):
+        return self._offset[path]
+
+    @property
+    def vectors(self):
+        """(n, dim) float16 view of the stored, L2 normalized embeddings."""
+        return self._matrix[:len(self.paths)]
+
+    def add(self, vectors, paths):
+        """Append embeddings for `paths`; paths already in the index are skipped."""
+        vectors = _normalize(vectors)
+        keep = [i for i, p in enumerate(paths) if p not in self._offset]
+        if not keep:
+            return
+        vectors, paths = vectors[keep], [paths[i] for i in keep]
+        start, stop = len(self.paths), len(self.paths) + len(paths)
+        if stop > self._capacity:
+            self._matrix.flush()
+            self._capacity = max(stop, 2 * self._capacity)
+            del self._matrix
+            with open(os.path.join(self.directory, MATRIX_FILE), "r+b") as fh:
+                fh.truncate(self._capacity * self.dim * 2)
+            self._matrix = self._open(self._capacity)
+        self._matrix[start:stop] = vectors
+        for i, p in enumerate(paths):
+            self._offset[p] = start + i
+        self.paths.extend(paths)
+        if self._resident is not None:
+            if stop > len(self._resident):
+                # Grows by doubling like the file; only the first len(self) rows are used
+                grown = np.empty((max(stop, 2 * len(self._resident)), self.dim), np.float32)
+                grown[:start] = self._resident[:start]
+                self._resident = grown
+            self._resident[start:stop] = self._matrix[start:stop]
+        if self.centroids is not None:
+            self._assign(start, stop)
+
+    def flush(self):
+        """Write the matrix and the path index to disk."""
+        self._matrix.flush()
+        tmp = os.path.join(self.directory, INDEX_FILE + ".tmp")
+        with open(tmp, "w") as fh:
+            json.dump({"dim": self.dim, "capacity": self._capacity, "meta": self.meta, "paths": self.paths}, fh)
+        os.replace(tmp, os.path.join(self.directory, INDEX_FILE))
+        if self.centroids is not None:
+            tmp = os.path.join(self.directory, "lists.tmp.npz")
+            np.savez(tmp, centroids=self.centroids, assignment=self._assignment)
+            os.replace(tmp, os.path.join(self.directory, LISTS_FILE))
+
+    def _rows(self, start, stop):
+        # float32 rows start:stop, from the resident copy when there is one
+        if self._resident is not None:
+            return self._resident[start:stop]
+        return np.asarray(self._matrix[start:stop], np.float32)
+
+    def _load_resident(self):
+        if self._resident is None and self.resident:
+            size = len(self.paths) * self.dim * 4
+            if self.resident != "auto" or size <= memory_budget():
+                self._resident = np.asarray(self.vectors, np.float32)
+        return self._resident
+
+    def build_lists(self, lists=None, sample=65536, iterations=10, seed=0):
+        """
+        Cluster the rows into `lists` inverted lists (default about sqrt(n))
+        with spherical k-means on up to `sample` rows, for query(nprobe=...).
+        Rebuilding replaces the previous lists.
+        """
+        n = len(self.paths)
+        if not n:
+            raise ValueError("cannot build lists for an empty index")
+        lists = min(int(lists or max(1, round(np.sqrt(n)))), n)
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(n, size=min(sample, n), replace=False))
+        points = np.asarray(self._matrix[rows], np.float32)
+        centroids = points[rng.choice(len(points), size=lists, replace=False)]
+        for _ in range(iterations):
+            nearest = (points @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, nearest, points)
+            empty = np.bincount(nearest, minlength=lists) == 0
+            # An emptied list restarts from a random sample row
+            sums[empty] = points[rng.choice(len(points), size=int(empty.sum()))]
+            centroids = _normalize(sums)
+        self.centroids = centroids
+        self._assignment = np.zeros(0, np.int32)
+        self._assign(0, n)
+        return self
+
+    def _assign(self, start, stop):
+        # Nearest centroid of rows start:stop, block by block
+        parts = [self._assignment[:start]]
+        for base in range(start, stop, self.block_size):
+            block = self._rows(base, min(base + self.block_size, stop))
+            parts.append((block @ self.centroids.T).argmax(axis=1).astype(np.int32))
+        self._assignment = np.concatenate(parts)
+        self._members = None
+
+    def _lists(self):
+        # Rows of every list, as one array sorted by list and per-list offsets
+        if self._members is None:
+            order = np.argsort(self._assignment, kind="stable")
+            bounds = np.searchsorted(self._assignment[order], np.arange(len(self.centroids) + 1))
+            self._members = order, bounds
+        return self._members
+
+    def _query_lists(self, queries, k, exclude, nprobe):
+        order, bounds = self._lists()
+        sizes = np.diff(bounds)
+        scores_out = np.empty((len(queries), k), np.float32)
+        rows_out = np.empty((len(queries), k), np.int64)
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)
+        for i, query in enumerate(queries):
+            # At least nprobe lists, and enough of them to hold k candidates
+            enough = np.searchsorted(np.cumsum(sizes[probes[i]]), k + (exclude is not None), side="left") + 1
+            chosen = probes[i, :max(nprobe, enough)]
+            # Sorted rows keep the memmap reads in file order
+            rows = np.sort(np.concatenate([order[bounds[c]:bounds[c + 1]] for c in chosen]))
+            source = self._resident if self._resident is not None else self._matrix
+            scores = np.asarray(source[rows], np.float32) @ query
+            if exclude is not None:
+                scores[rows == exclude[i]] = -np.inf
+            s, r = _top_k(scores[np.newaxis], rows[np.newaxis], k)
+            scores_out[i], rows_out[i] = s[0], r[0]
+        return scores_out, rows_out
+
+    def query(self, vectors, k=20, exclude=None, nprobe=None):
+        """
+        Cosine similarity top-k for a batch of query vectors.
+
+        Returns (scores, rows), both (Q, k), best first. `exclude` is an
+        optional (Q,) array of rows to leave out, e.g. the queries' own rows.
+        nprobe (after build_lists()) searches only the rows of the nprobe
+        lists nearest each query instead of all of them.
+        """
+        queries = _normalize(np.atleast_2d(vectors))
+        q = len(queries)
+        k = min(k, len(self.paths) - (exclude is not None))
+        if k <= 0:
+            return np.zeros((q, 0), np.float32), np.zeros((q, 0), np.int64)
+        self._load_resident()
+        if nprobe is not None:
+            if self.centroids is None:
+                raise ValueError("nprobe needs inverted lists; call build_lists() first")
+            exclude = None if exclude is None else np.asarray(exclude)
+            return self._query_lists(queries, k, exclude, int(nprobe))
+        best_scores = np.full((q, 0), -np.inf, np.float32)
+        best_rows = np.zeros((q, 0), np.int64)
+        # One block, i.e. one matrix product, when the matrix is resident
+        block_size = len(self.paths) if self._resident is not None else self.block_size
+        for base in range(0, len(self.paths), block_size):
+            block = self._rows(base, min(base + block_size, len(self.paths)))
+            scores = queries @ block.T
+            if exclude is not None:
+                local = np.asarray(exclude) - base
+                inside = (local >= 0) & (local < len(block))
+                scores[np.flatnonzero(inside), local[inside]] = -np.inf
+            take = min(k, len(block))
+            top = np.argpartition(-scores, take - 1, axis=1)[:, :take]
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            best_rows = np.concatenate([best_rows, top + base], axis=1)
+            best_scores, best_rows = _top_k(best_scores, best_rows, k)
+        return best_scores, best_rows
+
+    def neighbors(self, vectors, k=20, exclude=None, nprobe=None):
+        """Like query(), but returns the neighbours' paths; one list per query."""
+        scores, rows = self.query(vectors, k, exclude, nprobe)
+        return [[self.paths[r] for r in row] for row in rows], scores
+
+
+def index_corpus(extractor, source, index, batch_size=1024, flush_every=64):
+    """
+    Embed every patch of `source` not yet in `index`.
+
+    source is a FlowShards or anything FlowPatchLoader accepts (a glob, a
+    path or a list of them). The index is flushed every `flush_every` batches
+    and at the end, so an interrupted run picks up where it stopped.
+    """
+    if isinstance(source, FlowShards):
+        batches = (
+            (mag, paths) for mag, paths, _ in source.iter_batches(batch_size)
+            if not all(p in index for p in paths)
+        )
+    else:
+        loader = FlowPatchLoader([p for p in expand_paths(source) if p not in index],
+                                 batch_size=batch_size)
+        batches = iter(loader)
+    for n, (patches, paths) in enumerate(batches, start=1):
+        index.add(extractor.embed(patches), paths)
+        if n % flush_every == 0:
+            index.flush()
+    index.flush()
+    return index
@@ -0,0 +1,149 @@
+"""Input pipeline for U/V flow patches.
+
+Each .npy patch holds a (2, 64, 64) array with the U and V velocity
+components. The classifiers see the velocity magnitude laid out the way
+get_data_test always produced it: np.swapaxes(np.stack([mag]), 0, 2), i.e. a
+transposed (64, 64, 1) image.
+
+FlowPatchLoader decodes files in parallel with tf.data, batches, prefetches
+and keeps a report of the files that failed to load instead of printing them.
+"""
+
+import glob
+
+import numpy as np
+import tensorflow as tf
+
+CLASS_NAMES = ["CCW", "CW", "SADDLE"]
+
+PATCH_SIZE = 64
+PATCH_SHAPE = (PATCH_SIZE, PATCH_SIZE, 1)
+UV_SHAPE = (2, PATCH_SIZE, PATCH_SIZE)
+
+
+def magnitude_patch(uv):
+    """(2, 64, 64) U/V patch -> (64, 64, 1) float32 magnitude, get_data_test layout."""
+    uv = np.asarray(uv, dtype=np.float32)
+    U = uv[0]
+    V = uv[1]
+    mag = np.sqrt(U * U + V * V)
+    return np.ascontiguousarray(mag.T[..., np.newaxis])
+
+
+def magnitude_batch(uv_batch):
+    """(N, 2, 64, 64) U/V patches -> (N, 64, 64, 1) float32 magnitudes."""
+    uv_batch = np.asarray(uv_batch, dtype=np.float32)
+    U = uv_batch[:, 0]
+    V = uv_batch[:, 1]
+    mag = np.sqrt(U * U + V * V)
+    return np.ascontiguousarray(np.swapaxes(mag, 1, 2)[..., np.newaxis])
+
+
+def expand_paths(paths):
+    """Accept a glob pattern, a single path or a list of either."""
+    if isinstance(paths, str):
+        paths = [paths]
+    expanded = []
+    for p in paths:
+        matches = sorted(glob.glob(p)) if glob.has_magic(p) else [p]
+        expanded.extend(matches)
+    return expanded
+
+
+class FlowPatchLoader:
+    """
+    Parallel, prefetching loader for .npy flow patches.
+
+    Iterating yields (patches, paths) with patches shaped (B, 64, 64, 1) and
+    paths a list of B strings. With repeat=False the loader makes one pass
+    and stops; with repeat=True it cycles forever like get_data_test did.
+    shuffle > 0 shuffles the paths with a buffer of that size, differently on
+    every pass. Patches come out in path order unless deterministic=False,
+    which lets a slow file be overtaken. with_uv=True yields (uv, patches,
+    paths) instead, with the (B, 2, 64, 64) U/V arrays the magnitudes were
+    computed from, like FlowShards.iter_batches. Files that fail to load are
+    skipped and collected in `bad_files`.
+
+    e.g. for f, paths in FlowPatchLoader("centered_CW/*.npy", batch_size=64): ...
+    """
+    def __init__(self, paths, batch_size=32, repeat=False, num_parallel_calls=tf.data.AUTOTUNE,
+                 prefetch=tf.data.AUTOTUNE, num_threads=None, deterministic=True, shuffle=0,
+                 with_uv=False):
+        self.paths = expand_paths(paths)
+        self.batch_size = int(batch_size)
+        self.repeat = repeat
+        self.num_parallel_calls = num_parallel_calls
+        self.prefetch = prefetch
+        self.num_threads = num_threads
+        self.deterministic = deterministic
+        self.shuffle = int(shuffle)
+        self.with_uv = bool(with_uv)
+        self.bad_files = {}
+
+    def _load(self, path):
+        path = path.decode() if isinstance(path, bytes) else str(path)
+        try:
+            uv = np.asarray(np.load(path), dtype=np.float32)
+            patch = magnitude_patch(uv)
+            if patch.shape != PATCH_SHAPE:
+                raise ValueError(f"expected a (2, {PATCH_SIZE}, {PATCH_SIZE}) patch, "
+                                 f"got magnitude shape {patch.shape[:2]}")
+            if self.with_uv:
+                return patch, np.ascontiguousarray(uv[:2]), True
+            return patch, True
+        except Exception as e:
+            self.bad_files[path] = repr(e)
+            patch = np.zeros(PATCH_SHAPE, np.float32)
+            if self.with_uv:
+                return patch, np.zeros(UV_SHAPE, np.float32), False
+            return patch, False
+
+    def _decode(self, path):
+        # Stateful: _load records failures in bad_files
+        if self.with_uv:
+            patch, uv, ok = tf.numpy_function(self._load, [path], [tf.float32, tf.float32, tf.bool],
+                                              stateful=True)
+            uv.set_shape(UV_SHAPE)
+        else:
+            patch, ok = tf.numpy_function(self._load, [path], [tf.float32, tf.bool], stateful=True)
+        patch.set_shape(PATCH_SHAPE)
+        ok.set_shape(())
+        if self.with_uv:
+            return uv, patch, path, ok
+        return patch, path, ok
+
+    def dataset(self):
+        """The underlying tf.data.Dataset of (patches, paths) or (uv, patches, paths) batches."""
+        ds = tf.data.Dataset.from_tensor_slices(tf.constant(self.paths, dtype=tf.string))
+        if self.shuffle:
+            ds = ds.shuffle(self.shuffle, reshuffle_each_iteration=True)
+        if self.repeat:
+            ds = ds.repeat()
+        ds = ds.map(self._decode, num_parallel_calls=self.num_parallel_calls,
+                    deterministic=self.deterministic)
+        ds = ds.filter(lambda *element: element[-1])
+        ds = ds.map(lambda *element: element[:-1])
+        ds = ds.batch(self.batch_size)
+        ds = ds.prefetch(self.prefetch)
+
+        options = tf.data.Options()
+        if self.num_threads:
+            options.threading.private_threadpool_size = int(self.num_threads)
+        return ds.with_options(options)
+
+    def __iter__(self):
+        if not self.paths:
+            return
+        for *arrays, paths in self.dataset().as_numpy_iterator():
+            yield (*arrays, [p.decode() for p in paths])
+
+    def __len__(self):
+        """Number of batches in one pass, assuming every file loads."""
+        return -(-len(self.paths) // self.batch_size)
+
+    def report(self):
+        """Summary of the files that failed to load so far."""
+        lines = [f"{len(self.bad_files)} of {len(self.paths)} files failed to load"]
+        for path, error in sorted(self.bad_files.items()):
+            lines.append(f"  {path}: {error}")
+        return "\n".join(lines)
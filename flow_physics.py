@@ -0,0 +1,277 @@
+"""Vectorized physics pre-filter for U/V flow patches.
+
+Most tiles of a real field contain no critical point at all, yet every patch
+used to go through all three networks. PhysicsFilter looks at the same (N, 2,
+H, W) U/V arrays the loaders read (x along columns, y along rows, as in the
+comparison streamplot) and, for a whole batch at once, computes
+
+    vorticity       dV/dx - dU/dy, at the slowest point and its extreme over the patch
+    Okubo-Weiss     strain^2 - vorticity^2, most negative in a vortex core
+    divergence      dU/dx + dV/dy at the slowest point
+    min speed       the smallest |(U, V)| and where it is
+    Poincare index  winding number of (U, V) around nested rings inside the
+                    patch: +1 around a vortex (or source/sink), -1 around
+                    a saddle; the outermost ring that winds is used
+    circulation     line integral of (U, V) around that ring; its sign gives
+                    the vortex's sense
+    roughness       share of the velocity below the smoothing scale
+    Jacobian        determinant and trace of the velocity gradient at the
+                    slowest point: det < 0 is a saddle, det > 0 with
+                    trace^2 < 4 det a vortex
+
+Patches without a critical point inside the rings (index 0, and no near-zero
+velocity with a vortex or saddle Jacobian) or dominated by pixel-scale noise
+are dropped before inference. The heuristic label (CCW 0, CW 1, SADDLE 2, -1
+for none) follows CLASS_NAMES, so it can be held against the classifiers'
+output.
+
+This is a weak pre-filter: it only asks whether the patch holds some critical
+point. On the synthetic patches (synthetic_flows.flow_batch) it keeps 99% or
+more of every class and its label matches 97-100% of them, and it drops
+white noise, but a smooth random field has critical points too and most such
+patches pass. Use it to skip empty tiles, not as a classifier.
+
+e.g. keep, labels, features = PhysicsFilter().apply(uv_batch)
+     preds = model.predict(magnitude_batch(uv_batch[keep]))
+     for mag, paths, labels, heuristic in filter_batches(shards.iter_batches(256, with_uv=True)): ...
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+FlowFeatures = namedtuple("FlowFeatures", [
+    "vorticity", "max_vorticity", "okubo_weiss", "core_vorticity", "divergence", "min_speed", "min_location",
+    "poincare_index", "ring_speed", "circulation", "det_jacobian", "trace_jacobian", "jacobian_norm",
+    "roughness",
+])
+
+
+def box_filter(array, size, axes):
+    """
+    Mean over a `size`-wide window along each of `axes`, repeating the edge
+    values past the border (scipy.ndimage.uniform_filter with mode="nearest").
+    """
+    array = np.asarray(array, dtype=np.float32)
+    before = size // 2
+    for axis in axes:
+        pad = [(0, 0)] * array.ndim
+        pad[axis] = (before + 1, size - 1 - before)
+        total = np.cumsum(np.pad(array, pad, mode="edge"), axis=axis, dtype=np.float64)
+        n = array.shape[axis]
+        upper = np.take(total, np.arange(size, size + n), axis=axis)
+        lower = np.take(total, np.arange(n), axis=axis)
+        array = ((upper - lower) / size).astype(np.float32)
+    return array
+
+
+def _ring(height, width, margin):
+    # Pixel indices of a closed, counter-clockwise loop (in x-right, y-up
+    # terms: rows grow with y) `margin` pixels inside the patch border
+    top, bottom, left, right = margin, height - 1 - margin, margin, width - 1 - margin
+    rows = np.concatenate([
+        np.full(right - left, top), np.arange(top, bottom),
+        np.full(right - left, bottom), np.arange(bottom, top, -1),
+    ])
+    cols = np.concatenate([
+        np.arange(left, right), np.full(bottom - top, right),
+        np.arange(right, left, -1), np.full(bottom - top, left),
+    ])
+    return rows, cols
+
+
+def poincare_index(uv_batch, margin=2):
+    """Winding number of the velocity around a ring `margin` pixels inside each patch, (N,) int."""
+    uv_batch = np.asarray(uv_batch, dtype=np.float32)
+    rows, cols = _ring(uv_batch.shape[2], uv_batch.shape[3], margin)
+    angle = np.arctan2(uv_batch[:, 1, rows, cols], uv_batch[:, 0, rows, cols])
+    # Close the loop and wrap every step into (-pi, pi]
+    step = np.diff(angle, axis=1, append=angle[:, :1])
+    step = (step + np.pi) % (2.0 * np.pi) - np.pi
+    return np.rint(step.sum(axis=1) / (2.0 * np.pi)).astype(np.int32)
+
+
+def ring_speed(uv_batch, margin=2):
+    """Slowest speed on the ring relative to the patch's mean speed, (N,) float."""
+    uv_batch = np.asarray(uv_batch, dtype=np.float32)
+    rows, cols = _ring(uv_batch.shape[2], uv_batch.shape[3], margin)
+    speed = np.hypot(uv_batch[:, 0], uv_batch[:, 1])
+    return speed[:, rows, cols].min(axis=1) / np.maximum(speed.mean(axis=(1, 2)), 1e-12)
+
+
+def circulation(uv_batch, margin=2, spacing=(1.0, 1.0)):
+    """Counter-clockwise line integral of the velocity around the same ring, (N,) float."""
+    uv_batch = np.asarray(uv_batch, dtype=np.float32)
+    rows, cols = _ring(uv_batch.shape[2], uv_batch.shape[3], margin)
+    step_x = np.diff(cols, append=cols[:1]) * spacing[0]
+    step_y = np.diff(rows, append=rows[:1]) * spacing[1]
+    return uv_batch[:, 0, rows, cols] @ step_x + uv_batch[:, 1, rows, cols] @ step_y
+
+
+def vorticity_field(uv_batch, smooth=1, spacing=(1.0, 1.0)):
+    """dV/dx - dU/dy at every pixel, (N, H, W), optionally box filtered over `smooth` pixels first."""
+    uv_batch = np.asarray(uv_batch, dtype=np.float32)
+    if smooth > 1:
+        uv_batch = box_filter(uv_batch, smooth, axes=(2, 3))
+    dx, dy = spacing
+    dU_dy = np.gradient(uv_batch[:, 0], dy, axis=1)
+    dV_dx = np.gradient(uv_batch[:, 1], dx, axis=2)
+    return dV_dx - dU_dy
+
+
+class PhysicsFilter:
+    """
+    Vectorized critical-point test over batches of U/V patches.
+
+    Velocities are box filtered over `smooth` pixels first, against noise;
+    patches whose roughness (the share of the velocity that filter removes)
+    is above max_roughness are rejected, and smooth=1 turns both off.
+    margins are the rings' distances from the border, outermost first; a
+    ring's winding number is ignored when its slowest point is below
+    min_ring_speed of the mean speed. min_speed_ratio: a patch also passes
+    when its slowest point is below this fraction of its mean speed and the
+    Jacobian there is a vortex or a saddle, which catches critical points
+    the rings miss. min_det_ratio rejects Jacobians closer to shear than
+    that (0 for shear, 1 for a pure vortex or saddle). Patches whose most
+    negative scaled Okubo-Weiss value is below -min_swirl count as vortices.
+    spacing is the grid step (dx, dy); it only scales the vorticity,
+    divergence and Jacobian values, not the decisions.
+    """
+    def __init__(self, margins=(2, 10, 20), smooth=5, min_speed_ratio=0.1, min_ring_speed=0.02, min_det_ratio=0.25,
+                 min_swirl=50.0, max_roughness=0.6, spacing=(1.0, 1.0)):
+        self.margins = tuple(int(m) for m in np.atleast_1d(margins))
+        self.smooth = int(smooth)
+        self.min_ring_speed = float(min_ring_speed)
+        self.min_swirl = float(min_swirl)
+        self.min_speed_ratio = float(min_speed_ratio)
+        self.min_det_ratio = float(min_det_ratio)
+        self.max_roughness = float(max_roughness)
+        self.spacing = spacing
+
+    def _ring_features(self, uv_batch):
+        # Winding number, speed and circulation of the first (outermost) ring
+        # that winds around something, or of the first ring where none does
+        height, width = uv_batch.shape[2:]
+        margins = [m for m in self.margins if 2 * m + 2 < min(height, width)]
+        index = np.stack([poincare_index(uv_batch, m) for m in margins])
+        speed = np.stack([ring_speed(uv_batch, m) for m in margins])
+        circ = np.stack([circulation(uv_batch, m, self.spacing) for m in margins])
+        ring = ((index != 0) & (speed >= self.min_ring_speed)).argmax(axis=0)
+        columns = np.arange(index.shape[1])
+        return {"poincare_index": index[ring, columns], "ring_speed": speed[ring, columns],
+                "circulation": circ[ring, columns]}
+
+    def features(self, uv_batch):
+        """FlowFeatures for an (N, 2, H, W) batch, every field an (N,) array."""
+        uv_batch = np.asarray(uv_batch, dtype=np.float32)
+        n = uv_batch.shape[0]
+        roughness = np.zeros(n, np.float32)
+        if self.smooth > 1:
+            smoothed = box_filter(uv_batch, self.smooth, axes=(2, 3))
+            # Share of the velocity's energy below the smoothing scale: ~1
+            # for white noise, a few percent for a resolved flow
+            roughness = np.sqrt(((uv_batch - smoothed) ** 2).reshape(n, -1).sum(axis=1)
+                                / np.maximum((uv_batch ** 2).reshape(n, -1).sum(axis=1), 1e-12))
+            uv_batch = smoothed
+        U = uv_batch[:, 0]
+        V = uv_batch[:, 1]
+        dx, dy = self.spacing
+        dU_dy, dU_dx = np.gradient(U, dy, dx, axis=(1, 2))
+        dV_dy, dV_dx = np.gradient(V, dy, dx, axis=(1, 2))
+        vorticity = dV_dx - dU_dy
+
+        speed = np.sqrt(U * U + V * V).reshape(n, -1)
+        flat_min = speed.argmin(axis=1)
+        at_min = (np.arange(n), flat_min)
+        ux, uy = dU_dx.reshape(n, -1)[at_min], dU_dy.reshape(n, -1)[at_min]
+        vx, vy = dV_dx.reshape(n, -1)[at_min], dV_dy.reshape(n, -1)[at_min]
+
+        flat_vorticity = vorticity.reshape(n, -1)
+        extreme = np.abs(flat_vorticity).argmax(axis=1)
+
+        # Okubo-Weiss: strain squared minus vorticity squared, negative where
+        # rotation dominates. Unlike the zero of the velocity it does not
+        # move with a uniform background flow.
+        # It is scaled by (mean speed / patch width)^2, so noise on a uniform
+        # flow stays near 0 while a vortex core reaches the hundreds.
+        okubo_weiss = ((dU_dx - dV_dy) ** 2 + (dV_dx + dU_dy) ** 2 - vorticity ** 2).reshape(n, -1)
+        gradient_scale = (speed.mean(axis=1) / (U.shape[2] * dx)) ** 2
+        core = okubo_weiss.argmin(axis=1)
+        return FlowFeatures(
+            vorticity=flat_vorticity[at_min],
+            max_vorticity=flat_vorticity[np.arange(n), extreme],
+            okubo_weiss=okubo_weiss[np.arange(n), core] / np.maximum(gradient_scale, 1e-12),
+            core_vorticity=flat_vorticity[np.arange(n), core],
+            divergence=ux + vy,
+            min_speed=speed[at_min] / np.maximum(speed.mean(axis=1), 1e-12),
+            min_location=np.stack(np.unravel_index(flat_min, U.shape[1:]), axis=1),
+            **self._ring_features(uv_batch),
+            det_jacobian=ux * vy - uy * vx,
+            trace_jacobian=ux + vy,
+            jacobian_norm=ux * ux + uy * uy + vx * vx + vy * vy,
+            roughness=roughness,
+        )
+
+    def label(self, features):
+        """Heuristic class per patch from its features: 0 CCW, 1 CW, 2 SADDLE, -1 none."""
+        det, trace = features.det_jacobian, features.trace_jacobian
+        # |det| is half the squared Frobenius norm for a pure rotation or a
+        # pure saddle and ~0 for shear, whose zero-velocity lines are not
+        # critical points
+        firm = np.abs(det) > self.min_det_ratio * 0.5 * features.jacobian_norm
+        spins = firm & (det > 0) & (trace * trace < 4.0 * det)
+        slow = features.min_speed < self.min_speed_ratio
+
+        # The winding number is meaningless where the ring itself passes
+        # through (near) zero velocity, e.g. across a shear layer
+        index = np.where(features.ring_speed < self.min_ring_speed, 0, features.poincare_index)
+        # Without a winding number, a strongly rotation-dominated core is a
+        # vortex even if a background flow moved its zero of velocity away
+        swirl = (index == 0) & (features.okubo_weiss < -self.min_swirl)
+        saddle = (index == -1) | ((index == 0) & ~swirl & slow & firm & (det < 0))
+        vortex = (index == 1) | swirl | ((index == 0) & slow & spins)
+        # The circulation around the ring decides the sense of a ringed
+        # vortex, the core's vorticity that of the others
+        rotation = np.where(index == 1, features.circulation,
+                            np.where(swirl, features.core_vorticity, features.vorticity))
+        labels = np.full(len(index), -1, np.int8)
+        labels[vortex] = np.where(rotation[vortex] > 0, 0, 1)
+        labels[saddle] = 2
+        # Velocity dominated by pixel-scale noise has critical points
+        # everywhere; none of them says anything about the patch
+        labels[features.roughness > self.max_roughness] = -1
+        return labels
+
+    def apply(self, uv_batch):
+        """(keep mask, heuristic labels, FlowFeatures) for an (N, 2, H, W) batch."""
+        features = self.features(uv_batch)
+        labels = self.label(features)
+        return labels >= 0, labels, features
+
+    __call__ = apply
+
+
+def filter_batches(batches, prefilter=None):
+    """
+    Drop non-candidate patches from FlowShards.iter_batches(..., with_uv=True).
+
+    Yields (magnitudes, paths, labels, heuristic labels) for the patches that
+    pass, skipping batches where none do.
+    """
+    prefilter = prefilter or PhysicsFilter()
+    for uv, mag, paths, labels in batches:
+        keep, heuristic, _ = prefilter.apply(uv)
+        if not keep.any():
+            continue
+        index = np.flatnonzero(keep)
+        yield mag[index], [paths[i] for i in index], labels[index], heuristic[index]
+
+
+def agreement(predicted, heuristic):
+    """Share of patches with a heuristic label where the classifier agrees with it."""
+    predicted = np.asarray(predicted)
+    heuristic = np.asarray(heuristic)
+    labeled = heuristic >= 0
+    if not labeled.any():
+        return None
+    return float((predicted[labeled] == heuristic[labeled]).mean())
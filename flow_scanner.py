@@ -0,0 +1,214 @@
+"""Sliding-window classification and Grad-CAM over whole flow fields.
+
+FieldScanner tiles a large U/V field, shaped (2, H, W) like the patches and
+typically a np.load(..., mmap_mode='r') of a full simulation frame, with
+64 x 64 windows every `stride` pixels:
+
+    scanner = FieldScanner(get_model('cnn', logits=True), stride=16)
+    result = scanner.scan("frame_0042.npy", out_dir="scan_0042")
+    result.probabilities      # (rows, cols, 3), window (i, j) at field [i*stride, j*stride]
+    result.heatmap            # (H, W) Grad-CAM, averaged where windows overlap
+
+The field is read in bands of `block_tiles` window rows, so only one band of
+U/V, its magnitude (computed once per band, not once per window) and its
+windows are in memory at a time. With `out_dir` the outputs are .npy memmaps
+as well, which makes frames larger than RAM work end to end.
+
+By default every window is cut out and classified exactly like a patch.
+shared_trunk=True is an opt-in approximation for models that are a plain
+chain of layers (the cnn): the conv trunk in front of the Grad-CAM layer runs
+once over each block of overlapping windows, and only the Grad-CAM layer and
+the head run per window, explained through their own GradCamEngine. Inside
+the trunk windows see their real neighbours instead of zero padding at their
+borders, so results differ near window edges from classifying the cut-out
+patches.
+"""
+
+import os
+from collections import namedtuple
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from flow_data import magnitude_patch
+from gradcam_engine import GradCamEngine, get_last_conv_layer
+from heatmap_overlay import resize_heatmaps
+from memory_budget import resolve_batch_size
+
+ScanResult = namedtuple("ScanResult", ["probabilities", "heatmap", "coverage", "stride"])
+
+
+def _is_chain(model):
+    # Every layer consumes exactly the output of the layer before it
+    for previous, layer in zip(model.layers, model.layers[1:]):
+        nodes = layer._inbound_nodes
+        if len(nodes) != 1 or len(nodes[0].input_tensors) != 1:
+            return False
+        if nodes[0].input_tensors[0]._keras_history[0] is not previous:
+            return False
+    return True
+
+
+def split_trunk(model, last_conv_layer_name=None):
+    """
+    Split a chain model just before its Grad-CAM layer.
+
+    Returns (trunk, head, factor): trunk maps a (B, H, W, 1) input of any
+    size to the activations feeding the Grad-CAM layer, head maps one window
+    of those activations through the Grad-CAM layer to the predictions, and
+    factor is the trunk's downsampling.
+    """
+    last_conv_layer_name = last_conv_layer_name or get_last_conv_layer(model)
+    split = [layer.name for layer in model.layers].index(last_conv_layer_name)
+
+    inputs = keras.Input(shape=(None, None) + tuple(model.inputs[0].shape[3:]))
+    x = inputs
+    for layer in model.layers[1:split]:
+        x = layer(x)
+    trunk = keras.Model(inputs, x)
+
+    window = tuple(model.layers[split].input.shape[1:])
+    features = keras.Input(shape=window)
+    x = features
+    for layer in model.layers[split:]:
+        # Fresh copies, so the head's Grad-CAM layer has a single graph node
+        clone = type(layer).from_config(layer.get_config())
+        x = clone(x)
+        clone.set_weights(layer.get_weights())
+    head = keras.Model(features, x)
+    return trunk, head, model.inputs[0].shape[1] // window[0]
+
+
+def _open_output(out_dir, name, shape):
+    if out_dir is None:
+        return np.zeros(shape, np.float32)
+    return np.lib.format.open_memmap(os.path.join(out_dir, name + ".npy"), mode="w+",
+                                     dtype=np.float32, shape=shape)
+
+
+class FieldScanner:
+    """
+    Classify and explain every `window` x `window` tile of a flow field.
+
+    Windows run one by one through the model, matching the per-patch
+    results. shared_trunk=True opts in to the faster, approximate shared conv
+    trunk; it needs a plain chain model and a stride that is a multiple of
+    the trunk's downsampling. Set from_logits=False for models that end in a
+    softmax. batch_size="auto" fits the Grad-CAM batch to the memory budget.
+    """
+    def __init__(self, model, stride=16, batch_size="auto", block_tiles=8, shared_trunk=False,
+                 last_conv_layer_name=None, from_logits=True):
+        self.window = int(model.inputs[0].shape[1])
+        self.stride = int(stride)
+        self.block_tiles = int(block_tiles)
+        self.from_logits = from_logits
+        # Sized for the whole network, also when only the head is explained
+        batch_size = resolve_batch_size(batch_size, model, "gradcam")
+
+        self.shared_trunk = bool(shared_trunk)
+        if self.shared_trunk:
+            if not _is_chain(model):
+                raise ValueError("shared_trunk needs a model that is a plain chain of layers.")
+            last_conv_layer_name = last_conv_layer_name or get_last_conv_layer(model)
+            trunk, head, self.factor = split_trunk(model, last_conv_layer_name)
+            if self.stride % self.factor:
+                raise ValueError(f"stride must be a multiple of {self.factor} for the shared trunk.")
+            self._trunk = tf.function(lambda x: trunk(x, training=False), reduce_retracing=True)
+            self.engine = GradCamEngine(head, last_conv_layer_name, batch_size=batch_size)
+            self._cells = self.window // self.factor
+        else:
+            self.engine = GradCamEngine(model, last_conv_layer_name, batch_size=batch_size)
+
+    def _grid(self, height, width):
+        return (height - self.window) // self.stride + 1, (width - self.window) // self.stride + 1
+
+    def _explain_band(self, image, rows, cols, class_index):
+        # image is the band's magnitude in the classifiers' (transposed)
+        # layout: axis 0 runs along field columns, axis 1 along field rows
+        if not self.shared_trunk:
+            windows = np.lib.stride_tricks.sliding_window_view(image, (self.window, self.window), axis=(0, 1))
+            tiles = windows[np.ix_(cols * self.stride, rows * self.stride)]
+            tiles = np.moveaxis(tiles, 2, -1).transpose(1, 0, 2, 3, 4).reshape(-1, self.window, self.window, 1)
+            return self.engine.compute(tiles, class_index, return_predictions=True)
+
+        heatmaps, preds, classes = [], [], []
+        cell_stride = self.stride // self.factor
+        for lo in range(0, len(cols), self.block_tiles):
+            block_cols = cols[lo:lo + self.block_tiles]
+            c0 = block_cols[0] * self.stride
+            c1 = block_cols[-1] * self.stride + self.window
+            r1 = rows[-1] * self.stride + self.window
+            features = self._trunk(tf.constant(image[np.newaxis, c0:c1, :r1])).numpy()[0]
+            windows = np.lib.stride_tricks.sliding_window_view(features, (self._cells, self._cells), axis=(0, 1))
+            tiles = windows[np.ix_((block_cols - block_cols[0]) * cell_stride, rows * cell_stride)]
+            tiles = np.moveaxis(tiles, 2, -1)
+            # (block cols, rows, ...) -> row-major window order within the band
+            tiles = tiles.transpose(1, 0, 2, 3, 4)
+            n = tiles.shape[0] * tiles.shape[1]
+            h, p, c = self.engine.compute(tiles.reshape((n,) + tiles.shape[2:]), class_index,
+                                          return_predictions=True)
+            shape = (len(rows), len(block_cols))
+            heatmaps.append(h.reshape(shape + h.shape[1:]))
+            preds.append(p.reshape(shape + p.shape[1:]))
+            classes.append(c.reshape(shape))
+        heatmaps = np.concatenate(heatmaps, axis=1)
+        preds = np.concatenate(preds, axis=1)
+        classes = np.concatenate(classes, axis=1)
+        return (heatmaps.reshape((-1,) + heatmaps.shape[2:]), preds.reshape((-1, preds.shape[-1])),
+                classes.reshape(-1))
+
+    def scan(self, uv, class_index=None, out_dir=None):
+        """
+        Scan a (2, H, W) U/V field, or the path of one saved as .npy.
+
+        class_index is None (explain each window's top class) or one class
+        for every window, e.g. 2 to map where saddles are. Returns a
+        ScanResult; heatmap pixels not covered by any window stay 0 and
+        have coverage 0.
+        """
+        if isinstance(uv, (str, os.PathLike)):
+            uv = np.load(uv, mmap_mode="r")
+        _, height, width = uv.shape
+        rows, cols = self._grid(height, width)
+        if rows < 1 or cols < 1:
+            raise ValueError(f"field {height}x{width} is smaller than one {self.window}x{self.window} window")
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+
+        num_classes = int(self.engine.grad_model.outputs[1].shape[-1])
+        probabilities = _open_output(out_dir, "probabilities", (rows, cols, num_classes))
+        heatmap = _open_output(out_dir, "heatmap", (height, width))
+        coverage = _open_output(out_dir, "coverage", (height, width))
+        all_cols = np.arange(cols)
+
+        for i0 in range(0, rows, self.block_tiles):
+            band_rows = np.arange(i0, min(i0 + self.block_tiles, rows))
+            r0 = i0 * self.stride
+            r1 = band_rows[-1] * self.stride + self.window
+            # Magnitude once for the whole band, in the classifiers' layout
+            image = magnitude_patch(uv[:, r0:r1, :])
+            heatmaps, preds, _ = self._explain_band(image, band_rows - i0, all_cols, class_index)
+
+            if self.from_logits:
+                preds = tf.nn.softmax(preds).numpy()
+            probabilities[band_rows] = preds.reshape(len(band_rows), cols, num_classes)
+
+            # Back to field orientation: tile axes are (field col, field row)
+            heatmaps = resize_heatmaps(heatmaps, (self.window, self.window)).transpose(0, 2, 1)
+            for k, (i, j) in enumerate(np.ndindex(len(band_rows), cols)):
+                r = r0 + i * self.stride
+                c = j * self.stride
+                heatmap[r:r + self.window, c:c + self.window] += heatmaps[k]
+                coverage[r:r + self.window, c:c + self.window] += 1.0
+
+        for r in range(0, height, self.block_tiles * self.stride):
+            band = slice(r, r + self.block_tiles * self.stride)
+            np.divide(heatmap[band], coverage[band], out=heatmap[band], where=coverage[band] > 0)
+
+        if out_dir is not None:
+            for array in (probabilities, heatmap, coverage):
+                array.flush()
+        return ScanResult(probabilities, heatmap, coverage, self.stride)
+
+    __call__ = scan
@@ -0,0 +1,192 @@
+"""Packed, memory-mapped shards of flow patches.
+
+A directory of thousands of tiny (2, 64, 64) .npy files costs one open and one
+header parse per patch. pack_flow_patches copies them into a few contiguous
+.npy shards instead:
+
+    out_dir/
+      index.json                 shard table, source paths, skipped files
+      shard-00000.uv.npy         (n, 2, 64, 64) float32 U/V
+      shard-00000.mag.npy        (n, 64, 64, 1) float32 magnitude (optional)
+      shard-00000.labels.npy     (n,) int8 class index from the directory name
+
+FlowShards opens the shards with mmap_mode='r', so slicing a batch out of one
+shard is a view onto the page cache rather than a copy.
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from flow_data import CLASS_NAMES, PATCH_SHAPE, PATCH_SIZE, expand_paths, magnitude_batch
+
+INDEX_FILE = "index.json"
+UV_SHAPE = (2, PATCH_SIZE, PATCH_SIZE)
+
+
+def label_from_path(path):
+    """
+    Class index taken from the patch's directory name, -1 if unknown.
+
+    e.g. .../centered_CW/17.npy -> 1, .../centered_SAD/3.npy -> 2
+    """
+    directory = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    for token in reversed(directory.upper().replace("-", "_").split("_")):
+        if token == "CCW":
+            return 0
+        if token == "CW":
+            return 1
+        if token.startswith("SAD"):
+            return 2
+    return -1
+
+
+def _load_uv(path):
+    try:
+        uv = np.load(path)
+        if uv.shape != UV_SHAPE:
+            raise ValueError(f"expected shape {UV_SHAPE}, got {uv.shape}")
+        return path, uv.astype(np.float32, copy=False), None
+    except Exception as e:
+        return path, None, repr(e)
+
+
+def pack_flow_patches(paths, out_dir, shard_size=65536, store_magnitude=True, num_workers=8):
+    """
+    Pack a glob (or list of globs/paths) of U/V patches into shards under out_dir.
+
+    Files are read with a thread pool, which hides most of the latency of
+    network-mounted storage. Returns the FlowShards reader for the new shards.
+    """
+    paths = expand_paths(paths)
+    os.makedirs(out_dir, exist_ok=True)
+
+    shards, kept_paths, skipped = [], [], {}
+    for start in range(0, len(paths), shard_size):
+        chunk = paths[start:start + shard_size]
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            loaded = list(pool.map(_load_uv, chunk))
+        good = [(p, uv) for p, uv, err in loaded if err is None]
+        skipped.update({p: err for p, _, err in loaded if err is not None})
+        if not good:
+            continue
+
+        name = f"shard-{len(shards):05d}"
+        uv = np.lib.format.open_memmap(os.path.join(out_dir, name + ".uv.npy"), mode="w+",
+                                       dtype=np.float32, shape=(len(good),) + UV_SHAPE)
+        for i, (_, patch) in enumerate(good):
+            uv[i] = patch
+        labels = np.array([label_from_path(p) for p, _ in good], dtype=np.int8)
+        np.save(os.path.join(out_dir, name + ".labels.npy"), labels)
+
+        shard = {"name": name, "count": len(good), "magnitude": bool(store_magnitude)}
+        if store_magnitude:
+            mag = np.lib.format.open_memmap(os.path.join(out_dir, name + ".mag.npy"), mode="w+",
+                                            dtype=np.float32, shape=(len(good),) + PATCH_SHAPE)
+            for i in range(0, len(good), 4096):
+                mag[i:i + 4096] = magnitude_batch(uv[i:i + 4096])
+            mag.flush()
+            del mag
+        uv.flush()
+        del uv
+
+        shards.append(shard)
+        kept_paths.extend(p for p, _ in good)
+
+    index = {"version": 1, "classes": CLASS_NAMES, "shards": shards,
+             "paths": kept_paths, "skipped": skipped}
+    with open(os.path.join(out_dir, INDEX_FILE), "w") as fh:
+        json.dump(index, fh)
+    return FlowShards(out_dir)
+
+
+class FlowShards:
+    """
+    Read-only, memory-mapped view of a shard directory.
+
+    Rows are numbered globally in pack order. Slices that stay inside one
+    shard are zero-copy views; iter_batches never crosses a shard boundary.
+
+    e.g. shards = FlowShards(out_dir)
+         mag, paths, labels = shards.batch(shards.offset_of(path), 64)
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, INDEX_FILE)) as fh:
+            index = json.load(fh)
+        self.classes = index["classes"]
+        self.shards = index["shards"]
+        self.paths = index["paths"]
+        self.skipped = index.get("skipped", {})
+        self._offset = {p: i for i, p in enumerate(self.paths)}
+        self._starts = np.cumsum([0] + [s["count"] for s in self.shards])
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _array(self, shard_id, kind):
+        key = (shard_id, kind)
+        if key not in self._arrays:
+            name = self.shards[shard_id]["name"]
+            self._arrays[key] = np.load(os.path.join(self.shard_dir, f"{name}.{kind}.npy"),
+                                        mmap_mode="r")
+        return self._arrays[key]
+
+    def _locate(self, start, stop):
+        shard_id = int(np.searchsorted(self._starts, start, side="right")) - 1
+        local = start - self._starts[shard_id]
+        return shard_id, local, min(stop, self._starts[shard_id + 1]) - self._starts[shard_id]
+
+    def _gather(self, kind, start, stop):
+        parts = []
+        while start < stop:
+            shard_id, lo, hi = self._locate(start, stop)
+            if kind == "mag" and not self.shards[shard_id]["magnitude"]:
+                parts.append(magnitude_batch(self._array(shard_id, "uv")[lo:hi]))
+            else:
+                parts.append(self._array(shard_id, kind)[lo:hi])
+            start += hi - lo
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def offset_of(self, path):
+        return self._offset[path]
+
+    def __contains__(self, path):
+        return path in self._offset
+
+    def uv(self, start, stop):
+        """(n, 2, 64, 64) U/V rows [start, stop)."""
+        return self._gather("uv", start, min(stop, len(self)))
+
+    def magnitude(self, start, stop):
+        """(n, 64, 64, 1) magnitude rows [start, stop), computed if not stored."""
+        return self._gather("mag", start, min(stop, len(self)))
+
+    def labels(self, start, stop):
+        return self._gather("labels", start, min(stop, len(self)))
+
+    def batch(self, start, batch_size):
+        """(magnitudes, paths, labels) for rows [start, start + batch_size)."""
+        stop = min(start + batch_size, len(self))
+        return self.magnitude(start, stop), self.paths[start:stop], self.labels(start, stop)
+
+    def iter_batches(self, batch_size, with_uv=False):
+        """
+        Yield (magnitudes, paths, labels) batches, or (uv, magnitudes, paths,
+        labels) with `with_uv`. Batches are cut at shard boundaries so every
+        array is a view into the shard.
+        """
+        for shard_id, shard in enumerate(self.shards):
+            base = int(self._starts[shard_id])
+            for lo in range(0, shard["count"], batch_size):
+                start, stop = base + lo, base + min(lo + batch_size, shard["count"])
+                mag, paths, labels = self.batch(start, stop - start)
+                if with_uv:
+                    yield self.uv(start, stop), mag, paths, labels
+                else:
+                    yield mag, paths, labels
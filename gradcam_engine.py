@@ -0,0 +1,503 @@
+"""Batched Grad-CAM for the vortex classifiers.
+
+make_gradcam_heatmap in grad_cam.py used to rebuild the gradient sub-model and
+run an eager tape for every single patch. The engine here builds the
+(conv-output, predictions) sub-model once per (model, layer) pair and runs the
+tape step as a tf.function traced once for any batch, so a whole batch of
+(N, 64, 64, 1) patches is explained in one call. compute_all_classes gives the
+maps of every class (Grad-CAM or Grad-CAM++) from one tape via a batched
+Jacobian instead of one pass per class. MultiLayerGradCam taps any number of
+layers, including the ones inside the nested ResNet101, and explains all of
+them from one tape.
+
+GradCamComparison does the same for several networks at once: one forward and
+one backward pass per network gives the predictions, the predicted classes and
+the heatmaps that the comparison loop used to compute with six forward passes.
+"""
+
+import weakref
+from collections import namedtuple
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+
+from memory_budget import bucket_size, resolve_batch_size
+
+
+# Instead of hardcoding in the specific name of the last layer, we identify the
+#   last layer based on it's layer type (Conv2D). This ensures that the
+#   make_grad_cam_heatmap method finds the correct last layer for each model
+
+def get_last_conv_layer(model):
+  for layer in reversed(model.layers):
+    if isinstance(layer, layers.Conv2D):
+      return layer.name
+  raise ValueError("No Conv2D layer found in the model.")
+
+
+def _select_class(preds, class_index):
+    # A negative class index means "explain the top predicted class"
+    top_index = tf.argmax(preds, axis=1, output_type=tf.int32)
+    class_index = tf.where(class_index < 0, top_index, class_index)
+    return class_index, tf.gather(preds, class_index, axis=1, batch_dims=1)
+
+
+def _gradcam_heatmap(last_conv_layer_output, grads):
+    # Mean intensity of the gradient over each feature map channel
+    pooled_grads = tf.reduce_mean(grads, axis=(1, 2))
+
+    # Weight every channel by "how important this channel is" with regard
+    # to the chosen class, then sum the channels to obtain the heatmap
+    heatmap = tf.einsum("nhwc,nc->nhw", last_conv_layer_output, pooled_grads)
+
+    # For visualization purpose, we normalize each heatmap between 0 & 1
+    heatmap = tf.maximum(heatmap, 0)
+    heatmap_max = tf.reduce_max(heatmap, axis=(1, 2), keepdims=True)
+    return tf.math.divide_no_nan(heatmap, heatmap_max)
+
+
+def _class_activation_maps(last_conv_layer_output, jacobian, method):
+    # jacobian holds d(class score k)/d(activations), shaped (N, K, h, w, c)
+    if method == "gradcam":
+        weights = tf.reduce_mean(jacobian, axis=(2, 3))
+    elif method == "gradcam++":
+        # Grad-CAM++ (Chattopadhyay et al. 2018) with the usual exponential
+        # score, which turns the higher derivatives into powers of the gradient
+        grads_2 = tf.square(jacobian)
+        grads_3 = grads_2 * jacobian
+        activation_sum = tf.reduce_sum(last_conv_layer_output, axis=(1, 2))[:, tf.newaxis, tf.newaxis, tf.newaxis, :]
+        alpha = tf.math.divide_no_nan(grads_2, 2.0 * grads_2 + activation_sum * grads_3)
+        weights = tf.reduce_sum(alpha * tf.nn.relu(jacobian), axis=(2, 3))
+    else:
+        raise ValueError(f"Unknown method {method!r}, expected 'gradcam' or 'gradcam++'.")
+
+    maps = tf.nn.relu(tf.einsum("nhwc,nkc->nkhw", last_conv_layer_output, weights))
+    maps_max = tf.reduce_max(maps, axis=(2, 3), keepdims=True)
+    return tf.math.divide_no_nan(maps, maps_max)
+
+
+def _class_indices(pred_index, n):
+    if pred_index is None:
+        return np.full(n, -1, dtype=np.int32)
+    pred_index = np.asarray(pred_index, dtype=np.int32)
+    if pred_index.ndim == 0:
+        return np.full(n, int(pred_index), dtype=np.int32)
+    if pred_index.shape != (n,):
+        raise ValueError("pred_index must be None, an int or one index per image.")
+    return pred_index
+
+
+def _padded_batches(img_array, pred_index, batch_size, input_shape):
+    # Split into batches of batch_size, zero padding the last one only up to
+    # its power-of-two bucket: a short request runs at its own size, and the
+    # steps see a handful of batch shapes however the inputs are split
+    img_array = np.asarray(img_array, dtype=np.float32)
+    if img_array.ndim == len(input_shape):
+        img_array = img_array[np.newaxis]
+    n = img_array.shape[0]
+    class_index = _class_indices(pred_index, n)
+    for start in range(0, n, batch_size):
+        batch = img_array[start:start + batch_size]
+        batch_index = class_index[start:start + batch_size]
+        valid = batch.shape[0]
+        pad = bucket_size(valid, batch_size) - valid
+        if pad:
+            batch = np.concatenate([batch, np.zeros((pad,) + batch.shape[1:], batch.dtype)])
+            batch_index = np.concatenate([batch_index, np.full(pad, -1, np.int32)])
+        yield tf.constant(batch), tf.constant(batch_index), valid
+
+
+def _stack(parts, shape, dtype=np.float32):
+    # Per-batch results joined along the batch; an empty input gives (0, *shape)
+    if not parts:
+        return np.zeros((0,) + tuple(shape), dtype)
+    return np.concatenate(parts)
+
+
+class GradCamEngine:
+    """
+    Grad-CAM for one model and one conv layer, run in batches of at most batch_size.
+
+    Inputs of any length are split into batches of `batch_size`; the last
+    one is zero padded to the smallest power-of-two bucket that holds it,
+    so a single patch runs at batch 1.
+    The default, batch_size="auto", picks the largest one that fits the
+    memory budget (see memory_budget.batch_size_for).
+
+    e.g. heatmaps = GradCamEngine(classifier_cnn).compute(patches)  # (N, h, w)
+    """
+    def __init__(self, model, last_conv_layer_name=None, batch_size="auto"):
+        self.last_conv_layer_name = last_conv_layer_name or get_last_conv_layer(model)
+        self.batch_size = resolve_batch_size(batch_size, model, "gradcam")
+        self.input_shape = tuple(model.inputs[0].shape[1:])
+
+        # Model that maps the input image to the activations of the last conv
+        # layer as well as the output predictions. Built once, reused for
+        # every batch.
+        self.grad_model = tf.keras.models.Model(
+            model.input, [model.get_layer(self.last_conv_layer_name).output, model.output]
+        )
+        self._map_shape = tuple(self.grad_model.outputs[0].shape[1:3])
+        self._num_classes = int(self.grad_model.outputs[1].shape[-1])
+        self._step = tf.function(
+            self._gradcam_step,
+            input_signature=[
+                tf.TensorSpec((None,) + self.input_shape, tf.float32),
+                tf.TensorSpec((None,), tf.int32),
+            ],
+        )
+        self._all_class_steps = {}
+
+    def _gradcam_step(self, img_batch, class_index):
+        with tf.GradientTape() as tape:
+            last_conv_layer_output, preds = self.grad_model(img_batch, training=False)
+            class_index, class_channel = _select_class(preds, class_index)
+
+        # Samples do not interact in inference mode, so the gradient of the
+        # summed class scores gives every sample its own gradient
+        grads = tape.gradient(class_channel, last_conv_layer_output)
+        return _gradcam_heatmap(last_conv_layer_output, grads), preds, class_index
+
+    def compute(self, img_array, pred_index=None, return_predictions=False):
+        """
+        Heatmaps for a batch of images.
+
+        pred_index may be None (top predicted class), a single class for every
+        image or one class per image. Returns an (N, h, w) float32 array, plus
+        the (N, num_classes) predictions and explained classes if
+        `return_predictions` is set.
+        """
+        heatmaps, preds, explained = [], [], []
+        for batch, batch_index, valid in _padded_batches(img_array, pred_index, self.batch_size,
+                                                         self.input_shape):
+            h, p, c = self._step(batch, batch_index)
+            heatmaps.append(h.numpy()[:valid])
+            preds.append(p.numpy()[:valid])
+            explained.append(c.numpy()[:valid])
+
+        heatmaps = _stack(heatmaps, self._map_shape)
+        if return_predictions:
+            return (heatmaps, _stack(preds, (self._num_classes,)),
+                    _stack(explained, (), np.int32))
+        return heatmaps
+
+    __call__ = compute
+
+    def _all_class_step(self, img_batch, classes, method):
+        with tf.GradientTape() as tape:
+            last_conv_layer_output, preds = self.grad_model(img_batch, training=False)
+            class_scores = tf.gather(preds, classes, axis=1)
+
+        # One tape, one vectorized Jacobian: the gradients of every requested
+        # class score with respect to the conv activations, sample by sample
+        jacobian = tape.batch_jacobian(class_scores, last_conv_layer_output)
+        return _class_activation_maps(last_conv_layer_output, jacobian, method), preds
+
+    def compute_all_classes(self, img_array, classes=None, method="gradcam", return_predictions=False):
+        """
+        Class activation maps for several classes from a single pass.
+
+        classes defaults to every output class. method is "gradcam" or
+        "gradcam++"; both are computed from the same gradients. Returns an
+        (N, num_classes, h, w) float32 array, plus the (N, num_outputs)
+        predictions if `return_predictions` is set.
+        """
+        num_outputs = self._num_classes
+        classes = np.arange(num_outputs) if classes is None else np.atleast_1d(classes)
+        classes = tf.constant(classes, dtype=tf.int32)
+
+        if method not in self._all_class_steps:
+            self._all_class_steps[method] = tf.function(
+                lambda img_batch, classes: self._all_class_step(img_batch, classes, method),
+                input_signature=[
+                    tf.TensorSpec((None,) + self.input_shape, tf.float32),
+                    tf.TensorSpec((None,), tf.int32),
+                ],
+            )
+        step = self._all_class_steps[method]
+
+        maps, preds = [], []
+        for batch, _, valid in _padded_batches(img_array, None, self.batch_size, self.input_shape):
+            m, p = step(batch, classes)
+            maps.append(m.numpy()[:valid])
+            preds.append(p.numpy()[:valid])
+
+        maps = _stack(maps, (int(classes.shape[0]),) + self._map_shape)
+        if return_predictions:
+            return maps, _stack(preds, (num_outputs,))
+        return maps
+
+
+# One engine per (model, layer, batch size). Keyed weakly on the model so
+# engines go away together with the network they explain.
+_engines = weakref.WeakKeyDictionary()
+
+
+def get_gradcam_engine(model, last_conv_layer_name=None, batch_size="auto"):
+    if last_conv_layer_name is None:
+        last_conv_layer_name = get_last_conv_layer(model)
+    per_model = _engines.setdefault(model, {})
+    # "auto" follows the available memory; resolve it once so the key and
+    # the engine's compiled batch agree
+    batch_size = resolve_batch_size(batch_size, model, "gradcam")
+    key = (last_conv_layer_name, batch_size)
+    if key not in per_model:
+        per_model[key] = GradCamEngine(model, last_conv_layer_name, batch_size)
+    return per_model[key]
+
+
+# Predictions, explained classes and heatmaps of one network for a batch
+ModelExplanation = namedtuple("ModelExplanation", ["predictions", "classes", "heatmaps"])
+
+
+class GradCamComparison:
+    """
+    Predictions and Grad-CAM heatmaps for several networks from one tape.
+
+    Every network runs its forward pass exactly once per batch; the
+    predictions are returned alongside the heatmaps instead of being
+    recomputed with predict(). batch_size="auto" sizes the batch for all the
+    networks on the tape together.
+
+    e.g. comparison = GradCamComparison({'cnn': classifier_cnn, 'resnet': classifier_resnet})
+         results = comparison.compute(patches)
+         results['cnn'].classes, results['cnn'].heatmaps
+    """
+    def __init__(self, models, last_conv_layer_names=None, batch_size="auto"):
+        last_conv_layer_names = last_conv_layer_names or {}
+        self.names = list(models)
+        self.batch_size = resolve_batch_size(batch_size, models, "gradcam")
+        self.input_shape = tuple(models[self.names[0]].inputs[0].shape[1:])
+        self.last_conv_layer_names = {}
+        self.grad_models = []
+        for name in self.names:
+            model = models[name]
+            if tuple(model.inputs[0].shape[1:]) != self.input_shape:
+                raise ValueError("All compared models must take the same input shape.")
+            layer_name = last_conv_layer_names.get(name) or get_last_conv_layer(model)
+            self.last_conv_layer_names[name] = layer_name
+            self.grad_models.append(tf.keras.models.Model(
+                model.input, [model.get_layer(layer_name).output, model.output]
+            ))
+        self._step = tf.function(
+            self._comparison_step,
+            input_signature=[
+                tf.TensorSpec((None,) + self.input_shape, tf.float32),
+                tf.TensorSpec((None,), tf.int32),
+            ],
+        )
+
+    def _comparison_step(self, img_batch, class_index):
+        with tf.GradientTape() as tape:
+            conv_outputs, all_preds, all_classes, targets = [], [], [], []
+            for grad_model in self.grad_models:
+                last_conv_layer_output, preds = grad_model(img_batch, training=False)
+                explained, class_channel = _select_class(preds, class_index)
+                conv_outputs.append(last_conv_layer_output)
+                all_preds.append(preds)
+                all_classes.append(explained)
+                targets.append(tf.reduce_sum(class_channel))
+            # The networks share nothing, so the gradient of the summed scores
+            # with respect to one network's activations is that network's own
+            target = tf.add_n(targets)
+
+        all_grads = tape.gradient(target, conv_outputs)
+        heatmaps = [_gradcam_heatmap(a, g) for a, g in zip(conv_outputs, all_grads)]
+        return all_preds, all_classes, heatmaps
+
+    def compute(self, img_array, pred_index=None):
+        """
+        Dict of model name -> ModelExplanation for a batch of images.
+
+        pred_index follows GradCamEngine.compute and applies to every model;
+        None explains each model's own top predicted class.
+        """
+        collected = {name: ([], [], []) for name in self.names}
+        for batch, batch_index, valid in _padded_batches(img_array, pred_index, self.batch_size,
+                                                         self.input_shape):
+            all_preds, all_classes, heatmaps = self._step(batch, batch_index)
+            for k, name in enumerate(self.names):
+                preds, classes, maps = collected[name]
+                preds.append(all_preds[k].numpy()[:valid])
+                classes.append(all_classes[k].numpy()[:valid])
+                maps.append(heatmaps[k].numpy()[:valid])
+
+        explanations = {}
+        for grad_model, name in zip(self.grad_models, self.names):
+            preds, classes, maps = collected[name]
+            explanations[name] = ModelExplanation(
+                _stack(preds, (int(grad_model.outputs[1].shape[-1]),)),
+                _stack(classes, (), np.int32),
+                _stack(maps, tuple(grad_model.outputs[0].shape[1:3])),
+            )
+        return explanations
+
+    __call__ = compute
+
+
+def _is_submodel(layer):
+    return isinstance(layer, tf.keras.Model)
+
+
+def select_layers(model, selector=layers.Conv2D, nested=True):
+    """
+    Names of the layers picked by `selector`, in forward order.
+
+    selector is a list of layer names, a layer class (or tuple of classes) or
+    a predicate taking a layer. Layers inside a nested model such as the
+    ResNet101 in get_model('resnet') are named "<submodel>/<layer>" and are
+    only searched when `nested` is set.
+
+    e.g. select_layers(classifier_resnet, layers.Conv2D)
+         -> ['conv2d', 'resnet101/conv1_conv', ..., 'resnet101/conv5_block3_3_conv']
+    """
+    if isinstance(selector, (list, tuple)) and all(isinstance(n, str) for n in selector):
+        return list(selector)
+    if isinstance(selector, type) or isinstance(selector, tuple):
+        layer_types = selector
+        selector = lambda layer: isinstance(layer, layer_types)
+
+    names = []
+    for layer in model.layers:
+        if _is_submodel(layer):
+            if nested:
+                names.extend(f"{layer.name}/{inner.name}" for inner in layer.layers
+                             if selector(inner) and len(inner.output.shape) == 4)
+        elif selector(layer) and len(layer.output.shape) == 4:
+            names.append(layer.name)
+    return names
+
+
+class MultiLayerGradCam:
+    """
+    Grad-CAM for several layers of one model from a single tape.
+
+    Every tapped layer gets its own heatmap, upsampled to the input size, so a
+    layer sweep costs about one forward and one backward pass per batch. The
+    maps can optionally be fused into one by averaging or taking the maximum.
+
+    Layers inside one nested submodel (e.g. "resnet101/conv4_block23_out")
+    are tapped by splitting the outer graph around that submodel.
+
+    e.g. sweep = MultiLayerGradCam(classifier_resnet, select_layers(classifier_resnet))
+         maps = sweep.compute(patches)            # (N, num_layers, 64, 64)
+    """
+    def __init__(self, model, layer_names=None, batch_size="auto", fuse=None):
+        if layer_names is None:
+            layer_names = select_layers(model)
+        if fuse not in (None, "mean", "max"):
+            raise ValueError(f"Unknown fuse mode {fuse!r}, expected None, 'mean' or 'max'.")
+        self.layer_names = list(layer_names)
+        self.batch_size = resolve_batch_size(batch_size, model, "gradcam")
+        self.fuse = fuse
+        self.input_shape = tuple(model.inputs[0].shape[1:])
+        self._num_classes = int(model.outputs[0].shape[-1])
+        self._build(model)
+        self._step = tf.function(
+            self._multi_layer_step,
+            input_signature=[
+                tf.TensorSpec((None,) + self.input_shape, tf.float32),
+                tf.TensorSpec((None,), tf.int32),
+            ],
+        )
+
+    def _build(self, model):
+        outer = [n for n in self.layer_names if "/" not in n]
+        inner = [n for n in self.layer_names if "/" in n]
+        submodel_names = {n.split("/", 1)[0] for n in inner}
+        if len(submodel_names) > 1:
+            raise ValueError("Layers can be tapped inside at most one nested submodel per call.")
+
+        if not inner:
+            self._stages = [tf.keras.models.Model(
+                model.input, [model.get_layer(n).output for n in outer] + [model.output]
+            )]
+            self._order = list(outer)
+            return
+
+        submodel = model.get_layer(submodel_names.pop())
+        # A nested model's own .input/.output refer to its inner graph; the
+        # tensors it was called on in the outer graph live on its call node
+        node = submodel._inbound_nodes[0]
+        sub_in, sub_out = node.input_tensors[0], node.output_tensors[0]
+
+        upstream, downstream = [], []
+        for n in outer:
+            try:
+                tf.keras.models.Model(sub_out, model.get_layer(n).output)
+                downstream.append(n)
+            except ValueError:
+                upstream.append(n)
+
+        try:
+            post = tf.keras.models.Model(
+                sub_out, [model.output] + [model.get_layer(n).output for n in downstream]
+            )
+        except ValueError:
+            raise ValueError(f"The output of {model.name} does not depend on {submodel.name} "
+                             "alone, so its layers cannot be tapped from the outer graph.")
+        inner_local = [n.split("/", 1)[1] for n in inner]
+        self._stages = [
+            tf.keras.models.Model(model.input, [model.get_layer(n).output for n in upstream] + [sub_in]),
+            tf.keras.models.Model(submodel.input,
+                                  [submodel.get_layer(n).output for n in inner_local] + [submodel.output]),
+            post,
+        ]
+        self._order = upstream + inner + downstream
+
+    def _forward(self, img_batch):
+        # Single-output stages return a bare tensor rather than a list
+        def run(stage, x):
+            out = stage(x, training=False)
+            return list(out) if isinstance(out, (list, tuple)) else [out]
+
+        if len(self._stages) == 1:
+            *taps, preds = run(self._stages[0], img_batch)
+            return taps, preds
+        pre, sub, post = self._stages
+        *up_taps, sub_in = run(pre, img_batch)
+        *inner_taps, sub_out = run(sub, sub_in)
+        preds, *down_taps = run(post, sub_out)
+        return up_taps + inner_taps + down_taps, preds
+
+    def _multi_layer_step(self, img_batch, class_index):
+        with tf.GradientTape() as tape:
+            taps, preds = self._forward(img_batch)
+            class_index, class_channel = _select_class(preds, class_index)
+
+        # Layers that do not reach the output (e.g. the unused conv7/conv8
+        # branch of the U-Net) get zero gradients and an empty map
+        all_grads = tape.gradient(class_channel, taps,
+                                  unconnected_gradients=tf.UnconnectedGradients.ZERO)
+        size = self.input_shape[:2]
+        heatmaps = {}
+        for name, activations, grads in zip(self._order, taps, all_grads):
+            heatmap = _gradcam_heatmap(activations, grads)[..., tf.newaxis]
+            heatmaps[name] = tf.image.resize(heatmap, size, method="bilinear")[..., 0]
+        heatmaps = tf.stack([heatmaps[name] for name in self.layer_names], axis=1)
+        return heatmaps, preds, class_index
+
+    def compute(self, img_array, pred_index=None, return_predictions=False):
+        """
+        (N, num_layers, H, W) heatmaps in `layer_names` order, or (N, H, W) if
+        the instance fuses the layers. pred_index follows GradCamEngine.compute.
+        """
+        heatmaps, preds, explained = [], [], []
+        for batch, batch_index, valid in _padded_batches(img_array, pred_index, self.batch_size,
+                                                         self.input_shape):
+            h, p, c = self._step(batch, batch_index)
+            heatmaps.append(h.numpy()[:valid])
+            preds.append(p.numpy()[:valid])
+            explained.append(c.numpy()[:valid])
+
+        heatmaps = _stack(heatmaps, (len(self.layer_names),) + self.input_shape[:2])
+        if self.fuse is not None:
+            heatmaps = heatmaps.mean(axis=1) if self.fuse == "mean" else heatmaps.max(axis=1)
+            peak = heatmaps.max(axis=(1, 2), keepdims=True)
+            heatmaps = np.divide(heatmaps, peak, out=np.zeros_like(heatmaps), where=peak > 0)
+        if return_predictions:
+            return heatmaps, _stack(preds, (self._num_classes,)), _stack(explained, (), np.int32)
+        return heatmaps
+
+    __call__ = compute
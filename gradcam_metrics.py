@@ -0,0 +1,360 @@
+"""Batched, figure-free evaluation of the Grad-CAM explanations.
+
+The comparison figures only let one patch at a time be checked by eye.
+GradCamEvaluator scores the heatmaps of every network (the ones
+make_gradcam_heatmap gives, computed for all networks from one tape by
+GradCamComparison) against the U/V field itself, a whole batch at a time:
+
+    core_energy     share of the heatmap's mass on the low-speed core (the
+                    slowest `core_fraction` of the pixels), where a vortex
+                    centre or saddle point sits
+    core_iou        IoU of the heatmap's top `top_fraction` pixels with that core
+    vorticity_corr  Pearson correlation of the heatmap with |vorticity|
+    deletion_auc    mean probability of the explained class while the most
+                    salient pixels are replaced by the baseline, in `steps`
+                    steps (lower is better)
+    insertion_auc   the same while they are put back into the baseline
+                    image (higher is better)
+
+and, for every pair of networks, heatmap correlation, top-pixel IoU and
+whether they predict the same class. Deletion and insertion re-run the
+network on the masked copies of a batch, built and run one fixed-batch
+XLA chunk at a time.
+
+Scores are summed per model and class in a MetricTable as batches stream
+through, so tens of thousands of patches need no more memory than a batch:
+
+    python gradcam_metrics.py shards/ "patches/centered_*/*.npy" --out metrics.csv
+
+e.g. evaluator = GradCamEvaluator({'cnn': cnn, 'resnet': resnet, 'u_net': u_net})
+     table = evaluator.evaluate(FlowShards("shards/").iter_batches(256, with_uv=True))
+     print(table.format())
+"""
+
+import argparse
+import csv
+import itertools
+import logging
+import os
+import sys
+
+import numpy as np
+
+from flow_data import CLASS_NAMES, FlowPatchLoader, expand_paths, magnitude_batch
+from flow_physics import box_filter, vorticity_field
+from gradcam_engine import GradCamComparison
+from heatmap_overlay import resize_heatmaps
+from quantized_inference import XLARunner
+
+log = logging.getLogger(__name__)
+
+MODEL_METRICS = ("core_energy", "core_iou", "vorticity_corr", "deletion_auc", "insertion_auc")
+PAIR_METRICS = ("heatmap_corr", "top_iou", "class_agreement")
+
+
+def _softmax(x):
+    x = x - x.max(axis=1, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def _flat(maps):
+    return maps.reshape(len(maps), -1)
+
+
+def pearson(a, b):
+    """Row-wise Pearson correlation of two (N, ...) batches, 0 where either is constant."""
+    a = _flat(np.asarray(a, dtype=np.float64))
+    b = _flat(np.asarray(b, dtype=np.float64))
+    a = a - a.mean(axis=1, keepdims=True)
+    b = b - b.mean(axis=1, keepdims=True)
+    norm = np.sqrt((a * a).sum(axis=1) * (b * b).sum(axis=1))
+    return np.divide((a * b).sum(axis=1), norm, out=np.zeros(len(a)), where=norm > 0)
+
+
+def top_mask(maps, fraction):
+    """Boolean (N, ...) mask of each map's top `fraction` pixels."""
+    flat = _flat(maps)
+    k = max(int(round(fraction * flat.shape[1])), 1)
+    # Ranks from a stable argsort, so ties don't grow the mask
+    order = np.argsort(-flat, axis=1, kind="stable")
+    mask = np.zeros(flat.shape, bool)
+    np.put_along_axis(mask, order[:, :k], True, axis=1)
+    return mask.reshape(maps.shape)
+
+
+def iou(a, b):
+    a, b = _flat(a), _flat(b)
+    union = (a | b).sum(axis=1)
+    return np.divide((a & b).sum(axis=1), union, out=np.zeros(len(a)), where=union > 0)
+
+
+def low_speed_core(speed, fraction=0.05):
+    """The slowest `fraction` of the pixels of each (N, H, W) speed map."""
+    return top_mask(-np.asarray(speed), fraction)
+
+
+def core_energy(heatmaps, core):
+    total = _flat(heatmaps).sum(axis=1)
+    inside = _flat(heatmaps * core).sum(axis=1)
+    return np.divide(inside, total, out=np.zeros(len(total)), where=total > 0)
+
+
+class CurveScorer:
+    """
+    Deletion and insertion curves for one logits model.
+
+    Pixels are ranked by the heatmap; step k of `steps` replaces (deletion)
+    or restores (insertion) the top k/steps of them. The baseline is each
+    patch's mean magnitude ("mean"), a zero image ("zero") or a box-blurred
+    copy ("blur"); zero reads as a low-speed core to these networks, so it
+    is not the default. The masked copies are made one runner batch at a
+    time, so memory stays at a batch however many steps there are.
+    """
+    def __init__(self, model, steps=10, baseline="mean", batch_size=32):
+        if baseline not in ("mean", "zero", "blur"):
+            raise ValueError(f"Unknown baseline {baseline!r}, expected 'mean', 'zero' or 'blur'.")
+        self.steps = int(steps)
+        self.baseline = baseline
+        self._runner = XLARunner(model, batch_size=batch_size)
+
+    def _baseline(self, patches):
+        if self.baseline == "zero":
+            return np.zeros_like(patches)
+        if self.baseline == "mean":
+            return np.broadcast_to(patches.mean(axis=(1, 2, 3), keepdims=True), patches.shape)
+        return box_filter(patches, 9, axes=(1, 2))
+
+    def curves(self, patches, heatmaps, classes):
+        """(deletion, insertion) probabilities of `classes`, each (N, steps + 1)."""
+        patches = np.asarray(patches, dtype=np.float32)
+        n = len(patches)
+        if not n:
+            return np.zeros((0, self.steps + 1), np.float32), np.zeros((0, self.steps + 1), np.float32)
+        pixels = patches.shape[1] * patches.shape[2]
+        # rank[i, p] = position of pixel p in patch i's saliency order
+        order = np.argsort(-_flat(heatmaps), axis=1, kind="stable")
+        rank = np.empty_like(order)
+        np.put_along_axis(rank, order, np.arange(pixels)[np.newaxis], axis=1)
+        rank = rank.reshape(patches.shape[:3] + (1,))
+
+        cutoffs = np.rint(np.linspace(0, pixels, self.steps + 1)).astype(np.int64)
+        baseline = self._baseline(patches)
+        classes = np.asarray(classes)
+        # Copy j of the 2 * (steps + 1) * N masked ones is curve j // ((steps + 1) * N)
+        #   (deletion, insertion), step j // N % (steps + 1), patch j % N; they are
+        #   built one runner batch at a time instead of all at once
+        total = 2 * (self.steps + 1) * n
+        chosen = np.empty(total, np.float32)
+        for start in range(0, total, self._runner.batch_size):
+            j = np.arange(start, min(start + self._runner.batch_size, total))
+            curve, rest = np.divmod(j, (self.steps + 1) * n)
+            step, i = np.divmod(rest, n)
+            top = rank[i] < cutoffs[step][:, np.newaxis, np.newaxis, np.newaxis]
+            # Deletion keeps the unranked pixels, insertion the top ones
+            keep = top == (curve == 1)[:, np.newaxis, np.newaxis, np.newaxis]
+            masked = np.where(keep, patches[i], baseline[i])
+            probabilities = _softmax(self._runner.predict(masked))
+            chosen[start:start + len(j)] = probabilities[np.arange(len(j)), classes[i]]
+        chosen = chosen.reshape(2, self.steps + 1, n)
+        return chosen[0].T, chosen[1].T
+
+
+def auc(curve):
+    """Normalized area under (N, steps + 1) curves sampled at evenly spaced fractions."""
+    curve = np.asarray(curve, dtype=np.float64)
+    return (curve[:, 1:] + curve[:, :-1]).sum(axis=1) / (2.0 * (curve.shape[1] - 1))
+
+
+class MetricTable:
+    """
+    Running per-class means of per-patch scores.
+
+    add(key, groups, scores) sums each (N,) score array into the rows
+    (key, group) for the group of every patch, plus (key, "all").
+    """
+    def __init__(self):
+        self._sums = {}
+        self._counts = {}
+
+    def add(self, key, groups, scores):
+        groups = np.asarray(groups)
+        for group in itertools.chain(np.unique(groups), ["all"]):
+            rows = slice(None) if group == "all" else groups == group
+            count = len(groups) if group == "all" else int(rows.sum())
+            row = (key, str(group))
+            sums = self._sums.setdefault(row, {})
+            for name, values in scores.items():
+                sums[name] = sums.get(name, 0.0) + float(np.sum(values[rows]))
+            self._counts[row] = self._counts.get(row, 0) + count
+
+    def rows(self):
+        """One dict per (key, group): key, class, count and the mean of every score."""
+        out = []
+        for (key, group), sums in sorted(self._sums.items(), key=lambda item: (item[0][0], item[0][1] == "all",
+                                                                               item[0][1])):
+            count = self._counts[(key, group)]
+            out.append({"model": key, "class": group, "count": count,
+                        **{name: total / max(count, 1) for name, total in sums.items()}})
+        return out
+
+    def format(self):
+        lines = []
+        for columns in (MODEL_METRICS, PAIR_METRICS):
+            rows = [r for r in self.rows() if columns[0] in r]
+            if not rows:
+                continue
+            lines.append(f"{'model':<14} {'class':<10} {'count':>7} " + " ".join(f"{c:>15}" for c in columns))
+            for r in rows:
+                lines.append(f"{r['model']:<14} {r['class']:<10} {r['count']:>7} "
+                             + " ".join(f"{r[c]:>15.3f}" for c in columns))
+            lines.append("")
+        return "\n".join(lines)
+
+    def write_csv(self, path):
+        rows = self.rows()
+        columns = ["model", "class", "count", *MODEL_METRICS, *PAIR_METRICS]
+        with open(path, "w", newline="") as fh:
+            writer = csv.DictWriter(fh, columns, restval="")
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+class GradCamEvaluator:
+    """
+    Scores every network's Grad-CAM heatmaps over batches of U/V patches.
+
+    models is a name -> logits model dict. Each patch is explained for the
+    class its network predicts; steps=0 skips the deletion/insertion
+    curves, the expensive part (2 * (steps + 1) forward passes per patch
+    and network).
+    """
+    def __init__(self, models, steps=10, core_fraction=0.05, top_fraction=0.05, smooth=3, baseline="mean",
+                 batch_size=32):
+        self.names = list(models)
+        self.steps = int(steps)
+        self.core_fraction = core_fraction
+        self.top_fraction = top_fraction
+        self.smooth = smooth
+        self.comparison = GradCamComparison(models, batch_size=batch_size)
+        self.scorers = {name: CurveScorer(model, steps, baseline, batch_size)
+                        for name, model in models.items()} if self.steps else {}
+
+    def score(self, uv_batch, patches=None):
+        """
+        Per-patch scores for an (N, 2, 64, 64) U/V batch.
+
+        Returns ({name: {metric: (N,)}}, {"a~b": {metric: (N,)}}, {name:
+        (N,) predicted classes}). patches are the magnitudes, computed from
+        uv_batch if not given.
+        """
+        uv_batch = np.asarray(uv_batch, dtype=np.float32)
+        if patches is None:
+            patches = magnitude_batch(uv_batch)
+        explained = self.comparison.compute(patches)
+
+        # Field maps in the classifiers' (transposed) layout, like the heatmaps
+        speed = np.asarray(patches, dtype=np.float32)[..., 0]
+        core = low_speed_core(speed, self.core_fraction)
+        swirl = np.abs(vorticity_field(uv_batch, self.smooth)).transpose(0, 2, 1)
+
+        heatmaps, tops, classes, scores = {}, {}, {}, {}
+        for name in self.names:
+            heatmaps[name] = resize_heatmaps(explained[name].heatmaps, speed.shape[1:])
+            tops[name] = top_mask(heatmaps[name], self.top_fraction)
+            classes[name] = np.asarray(explained[name].classes)
+            scores[name] = {
+                "core_energy": core_energy(heatmaps[name], core),
+                "core_iou": iou(tops[name], core),
+                "vorticity_corr": pearson(heatmaps[name], swirl),
+            }
+            if self.steps:
+                deletion, insertion = self.scorers[name].curves(patches, heatmaps[name], classes[name])
+                scores[name]["deletion_auc"] = auc(deletion)
+                scores[name]["insertion_auc"] = auc(insertion)
+
+        pairs = {}
+        for a, b in itertools.combinations(self.names, 2):
+            pairs[f"{a}~{b}"] = {
+                "heatmap_corr": pearson(heatmaps[a], heatmaps[b]),
+                "top_iou": iou(tops[a], tops[b]),
+                "class_agreement": (classes[a] == classes[b]).astype(np.float64),
+            }
+        return scores, pairs, classes
+
+    def evaluate(self, batches, table=None, limit=None):
+        """
+        Fold FlowShards.iter_batches(..., with_uv=True) style batches of
+        (uv, magnitudes, paths, labels) into a MetricTable, grouped by the
+        label from the directory name ("unlabeled" where there is none).
+        """
+        table = table or MetricTable()
+        seen = 0
+        for uv, patches, _, labels in batches:
+            if limit is not None:
+                uv, patches, labels = uv[:limit - seen], patches[:limit - seen], labels[:limit - seen]
+            scores, pairs, _ = self.score(uv, patches)
+            groups = np.array([CLASS_NAMES[int(l)] if l >= 0 else "unlabeled" for l in labels])
+            for key, values in itertools.chain(scores.items(), pairs.items()):
+                table.add(key, groups, values)
+            seen += len(labels)
+            log.info("%d patches scored", seen)
+            if limit is not None and seen >= limit:
+                break
+        return table
+
+
+def iter_uv_batches(inputs, batch_size=256):
+    """(uv, magnitudes, paths, labels) batches from shard directories and/or .npy globs; bad files are skipped."""
+    from flow_shards import INDEX_FILE, FlowShards, label_from_path
+
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    files = []
+    for item in inputs:
+        if os.path.isdir(item) and os.path.exists(os.path.join(item, INDEX_FILE)):
+            yield from FlowShards(item).iter_batches(batch_size, with_uv=True)
+        else:
+            files.extend(expand_paths(item))
+    loader = FlowPatchLoader(files, batch_size=batch_size, with_uv=True)
+    for uv, patches, paths in loader:
+        yield uv, patches, paths, np.array([label_from_path(p) for p in paths], np.int8)
+    for path, error in sorted(loader.bad_files.items()):
+        log.warning("skipped %s: %s", path, error)
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("inputs", nargs="+", help="shard directories and/or globs of .npy patches")
+    parser.add_argument("--models", nargs="+", default=["cnn", "resnet", "u_net"])
+    parser.add_argument("--steps", type=int, default=10, help="deletion/insertion steps; 0 to skip the curves")
+    parser.add_argument("--baseline", choices=("mean", "zero", "blur"), default="mean")
+    parser.add_argument("--batch-size", type=int, default=256, help="patches read per batch")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--out", help="write the per-class table as CSV")
+    parser.add_argument("--weights", nargs="*", default=[], metavar="NAME=PATH")
+    parser.add_argument("--untrained", action="store_true", help="random weights, for smoke tests")
+    parser.add_argument("--log-level", default="INFO")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(name)s %(message)s")
+
+    from models import get_model, set_weights_path
+
+    for name, path in (w.split("=", 1) for w in args.weights):
+        set_weights_path(name, path)
+    models = {name: get_model(name, weights=None, logits=True) if args.untrained else get_model(name, logits=True)
+              for name in args.models}
+    evaluator = GradCamEvaluator(models, steps=args.steps, baseline=args.baseline, batch_size="auto")
+    table = evaluator.evaluate(iter_uv_batches(args.inputs, args.batch_size), limit=args.limit)
+    print(table.format())
+    if args.out:
+        table.write_csv(args.out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""Batched colorization and overlay of Grad-CAM heatmaps.
+
+The comparison loop used to colorize each heatmap on its own: np.uint8 scaling,
+a fresh cm.get_cmap("jet") lookup table, a PIL round trip to resize and a
+conversion back to an array. Here a whole (N, h, w) batch of heatmaps is
+resized with tf.image.resize and mapped through a lookup table that is built
+once per colormap.
+"""
+
+import functools
+
+import matplotlib
+import numpy as np
+import tensorflow as tf
+
+
+@functools.lru_cache(maxsize=None)
+def get_lut(cmap="jet", levels=256):
+    """(levels, 3) float32 RGB lookup table for a matplotlib colormap, built once."""
+    colormap = matplotlib.colormaps[cmap]
+    lut = colormap(np.linspace(0.0, 1.0, levels))[:, :3].astype(np.float32)
+    lut.setflags(write=False)
+    return lut
+
+
+def resize_heatmaps(heatmaps, size=(64, 64), method="bilinear"):
+    """(N, h, w) heatmaps -> (N, *size) float32, resized as one tensor op."""
+    heatmaps = np.asarray(heatmaps, dtype=np.float32)
+    if heatmaps.shape[1:3] == tuple(size):
+        return heatmaps
+    resized = tf.image.resize(heatmaps[..., np.newaxis], size, method=method)
+    return resized.numpy()[..., 0]
+
+
+def colorize_heatmaps(heatmaps, size=(64, 64), cmap="jet"):
+    """
+    (N, h, w) heatmaps in [0, 1] -> (N, *size, 3) float32 RGB in [0, 1].
+
+    The heatmaps are resized first and then indexed into the LUT, so the
+    result only contains colors from the colormap.
+    """
+    lut = get_lut(cmap)
+    heatmaps = resize_heatmaps(heatmaps, size)
+    index = np.clip(heatmaps * (len(lut) - 1) + 0.5, 0, len(lut) - 1).astype(np.intp)
+    return lut[index]
+
+
+def overlay_heatmaps(heatmaps, background, alpha=0.4, cmap="jet"):
+    """
+    Blend colorized heatmaps over grey-scale backgrounds.
+
+    background is (N, H, W) or (N, H, W, 1), e.g. the magnitude patches fed to
+    the classifiers; each image is min-max scaled on its own. Returns
+    (N, H, W, 3) float32 RGB in [0, 1].
+    """
+    background = np.asarray(background, dtype=np.float32)
+    if background.ndim == 4:
+        background = background[..., 0]
+    lo = background.min(axis=(1, 2), keepdims=True)
+    span = background.max(axis=(1, 2), keepdims=True) - lo
+    grey = np.divide(background - lo, span, out=np.zeros_like(background), where=span > 0)
+
+    colored = colorize_heatmaps(heatmaps, size=background.shape[1:3], cmap=cmap)
+    return (1.0 - alpha) * grey[..., np.newaxis] + alpha * colored
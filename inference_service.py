@@ -0,0 +1,357 @@
+"""Long-running local inference service with dynamic micro-batching.
+
+Tools that want one patch classified used to reload every network and run a
+batch-of-1 predict. This service keeps the models warm and batches whatever
+arrives concurrently: requests wait in an asyncio queue, and the batcher
+takes up to `max_batch_size` of them, waiting at most `max_wait_ms` after the
+first one, and runs them through all models at once (in a worker thread, so
+the event loop keeps accepting requests meanwhile).
+
+    python inference_service.py --port 8765 --models cnn resnet u_net
+    python inference_service.py --unix /tmp/flow.sock
+
+HTTP/1.1 with JSON bodies, stdlib only:
+
+    POST /predict   {"uv": <(2, 64, 64) nested list, or base64 float32 bytes>,
+                     "heatmaps": false}
+                    -> {"models": {name: {"probabilities": [...], "class": "CW",
+                                          "heatmap": [[...]]}}, "latency_ms": ...}
+    GET  /metrics   queue depth, batch sizes and latency percentiles
+    GET  /health
+
+predict() below is a small client for the same protocol.
+"""
+
+import argparse
+import asyncio
+import base64
+import http.client
+import json
+import logging
+import socket
+import time
+
+import numpy as np
+
+from flow_data import CLASS_NAMES, PATCH_SIZE, magnitude_batch
+from gradcam_engine import GradCamComparison
+from instrumentation import Tracer
+from memory_budget import bucket_sizes, resolve_batch_size
+from quantized_inference import XLARunner
+
+log = logging.getLogger(__name__)
+
+UV_SHAPE = (2, PATCH_SIZE, PATCH_SIZE)
+
+
+def _softmax(x):
+    x = x - x.max(axis=1, keepdims=True)
+    e = np.exp(x)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def decode_patch(value):
+    """(2, 64, 64) float32 U/V patch from a nested list or base64 float32 bytes."""
+    if isinstance(value, str):
+        uv = np.frombuffer(base64.b64decode(value), dtype=np.float32)
+    else:
+        uv = np.asarray(value, dtype=np.float32)
+    if uv.size != np.prod(UV_SHAPE):
+        raise ValueError(f"expected a {UV_SHAPE} U/V patch, got {uv.size} values")
+    return uv.reshape(UV_SHAPE)
+
+
+class _Request:
+    __slots__ = ("uv", "heatmaps", "future", "enqueued")
+
+    def __init__(self, uv, heatmaps, future):
+        self.uv = uv
+        self.heatmaps = heatmaps
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-patch requests into batches for all models.
+
+    Predictions of every model come from one XLA forward pass each; when
+    any request in the batch asks for heatmaps, the batch goes through a
+    GradCamComparison instead, which gives predictions and heatmaps from
+    one tape. Both pad a batch only up to the smallest power-of-two bucket
+    that holds it, so a lone request runs at batch 1. models is a dict of
+    name -> logits model. max_batch_size caps how many requests are
+    collected ("auto": the largest predict batch that fits the memory
+    budget); the Grad-CAM tape is further capped by its own budget.
+    """
+    def __init__(self, models, max_batch_size=32, max_wait_ms=5.0, tracer=None):
+        self.names = list(models)
+        self.max_batch_size = resolve_batch_size(max_batch_size, models, "predict")
+        self.gradcam_batch_size = min(self.max_batch_size, resolve_batch_size("auto", models, "gradcam"))
+        self.max_wait = max_wait_ms / 1e3
+        self.tracer = tracer or Tracer()
+        self._runners = {name: XLARunner(model, batch_size=self.max_batch_size) for name, model in models.items()}
+        self._comparison = GradCamComparison(models, batch_size=self.gradcam_batch_size)
+        self._queue = None
+        self._task = None
+        self.in_flight = 0
+
+    async def start(self, warmup=True):
+        if warmup:
+            # Compile every bucket of both paths before the first real request
+            await asyncio.get_running_loop().run_in_executor(None, self._warm_up)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, uv, heatmaps=False):
+        """Result dict for one (2, 64, 64) patch, once its batch has run."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(uv, heatmaps, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            started = time.perf_counter()
+            for request in batch:
+                self.tracer.record("queue_wait", request.enqueued, started)
+            self.in_flight = len(batch)
+            try:
+                results = await loop.run_in_executor(None, self._compute, batch)
+            except Exception as e:
+                log.exception("batch of %d failed", len(batch))
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            finally:
+                self.in_flight = 0
+            self.tracer.record("compute", started, time.perf_counter())
+            self.tracer.count("batches")
+            self.tracer.count("patches", len(batch))
+            done = time.perf_counter()
+            for request, result in zip(batch, results):
+                self.tracer.record("request", request.enqueued, done)
+                if not request.future.done():
+                    request.future.set_result(result)
+
+    def _warm_up(self):
+        patches = np.zeros((self.max_batch_size,) + self._comparison.input_shape, np.float32)
+        for size in bucket_sizes(self.max_batch_size):
+            for runner in self._runners.values():
+                runner.predict(patches[:size])
+        for size in bucket_sizes(self.gradcam_batch_size):
+            self._comparison.compute(patches[:size])
+
+    def _compute(self, batch):
+        patches = magnitude_batch(np.stack([request.uv for request in batch]))
+        heatmaps = {}
+        if any(request.heatmaps for request in batch):
+            explained = self._comparison.compute(patches)
+            preds = {name: explained[name].predictions for name in self.names}
+            heatmaps = {name: explained[name].heatmaps for name in self.names}
+        else:
+            preds = {name: runner.predict(patches) for name, runner in self._runners.items()}
+
+        results = [{} for _ in batch]
+        for name in self.names:
+            probabilities = _softmax(preds[name])
+            for k, request in enumerate(batch):
+                entry = {
+                    "probabilities": probabilities[k].tolist(),
+                    "class": CLASS_NAMES[int(probabilities[k].argmax())],
+                }
+                if request.heatmaps:
+                    entry["heatmap"] = heatmaps[name][k].tolist()
+                results[k][name] = entry
+        return results
+
+    def metrics(self):
+        stats = self.tracer.stats()
+        counters = dict(self.tracer.counters)
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "max_batch_size": self.max_batch_size,
+            "gradcam_batch_size": self.gradcam_batch_size,
+            "max_wait_ms": self.max_wait * 1e3,
+            "mean_batch_size": counters.get("patches", 0) / max(counters.get("batches", 0), 1),
+            "counters": counters,
+            "latency_ms": {name: {k: v for k, v in s.items() if k.endswith("_ms") or k == "count"}
+                           for name, s in stats.items()},
+        }
+
+
+class InferenceServer:
+    """Minimal keep-alive HTTP/1.1 front end for a MicroBatcher, on TCP or a Unix socket."""
+    def __init__(self, batcher, host="127.0.0.1", port=8765, unix_path=None):
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self.unix_path = unix_path
+        self._server = None
+
+    async def start(self):
+        await self.batcher.start()
+        if self.unix_path:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.unix_path)
+        else:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        log.info("serving %s on %s", ", ".join(self.batcher.names), self.unix_path or f"{self.host}:{self.port}")
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self.batcher.stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self._route(method, path, body)
+                data = json.dumps(payload).encode()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {http.client.responses[status]}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "models": self.batcher.names}
+        if method == "GET" and path == "/metrics":
+            return 200, self.batcher.metrics()
+        if method == "POST" and path == "/predict":
+            start = time.perf_counter()
+            try:
+                request = json.loads(body)
+                uv = decode_patch(request["uv"])
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {"error": str(e)}
+            try:
+                result = await self.batcher.submit(uv, bool(request.get("heatmaps", False)))
+            except Exception as e:
+                return 500, {"error": repr(e)}
+            return 200, {"models": result, "latency_ms": (time.perf_counter() - start) * 1e3}
+        return 404, {"error": f"no route for {method} {path}"}
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def connect(host="127.0.0.1", port=8765, unix_path=None, timeout=60):
+    """http.client connection to a running service; reuse it for keep-alive."""
+    if unix_path:
+        return _UnixHTTPConnection(unix_path, timeout=timeout)
+    return http.client.HTTPConnection(host, port, timeout=timeout)
+
+
+def predict(connection, uv, heatmaps=False):
+    """
+    Classify one (2, 64, 64) U/V patch on a running service.
+
+    e.g. conn = connect(port=8765)
+         result = predict(conn, np.load(path), heatmaps=True)
+         result["models"]["cnn"]["class"]
+    """
+    body = json.dumps({
+        "uv": base64.b64encode(np.ascontiguousarray(uv, dtype=np.float32).tobytes()).decode(),
+        "heatmaps": heatmaps,
+    })
+    connection.request("POST", "/predict", body, {"Content-Type": "application/json"})
+    response = connection.getresponse()
+    payload = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError(f"{response.status}: {payload.get('error')}")
+    return payload
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--models", nargs="+", default=["cnn", "resnet", "u_net"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="listen on this Unix socket path instead of TCP")
+    parser.add_argument("--max-batch-size", default=32,
+                        help='requests per micro-batch; "auto" fits it to the memory budget')
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--log-level", default="INFO")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+
+    from models import get_model
+
+    models = {name: get_model(name, logits=True) for name in args.models}
+    batcher = MicroBatcher(models, args.max_batch_size, args.max_wait_ms)
+    server = InferenceServer(batcher, args.host, args.port, args.unix)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Lightweight spans, counters and histograms for the analysis loop.
+
+    tracer = Tracer(trace=True)
+    with tracer.span("load"):
+        batch = next(loader)
+    tracer.count("patches", len(batch))
+    ...
+    print(tracer.summary())
+    tracer.write_chrome_trace("trace.json")   # open in chrome://tracing or Perfetto
+
+A disabled Tracer (Tracer(enabled=False)) hands out one shared no-op span, so
+the instrumentation can stay in production code. profile_steps() turns the
+TensorFlow profiler on for a window of loop steps.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Tracer:
+    """
+    Named spans with per-name duration histograms and simple counters.
+
+    Each name keeps its last `window` durations in a ring buffer, so a
+    long-running process uses bounded memory: count, total and max cover
+    every span, the percentiles the most recent `window`. trace=True also
+    keeps every span as a Chrome trace event; leave it off for long runs
+    where only the histograms are wanted.
+    """
+    def __init__(self, enabled=True, trace=False, window=10000):
+        self.enabled = enabled
+        self.trace = trace
+        self.window = int(window)
+        self.durations = {}
+        self.counters = {}
+        # name -> [count, total seconds, max seconds] over every span
+        self._totals = {}
+        self.events = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._profile_window = None
+        self._profiling = False
+        self._step = 0
+
+    def span(self, name):
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name)
+
+    def record(self, name, start, stop):
+        duration = stop - start
+        with self._lock:
+            if name not in self.durations:
+                self.durations[name] = collections.deque(maxlen=self.window)
+                self._totals[name] = [0, 0.0, 0.0]
+            self.durations[name].append(duration)
+            totals = self._totals[name]
+            totals[0] += 1
+            totals[1] += duration
+            totals[2] = max(totals[2], duration)
+            if self.trace:
+                self.events.append({
+                    "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                    "ts": (start - self._origin) * 1e6, "dur": (stop - start) * 1e6,
+                })
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def profile_steps(self, start, stop, logdir):
+        """Run the TensorFlow profiler from loop step `start` up to (not including) `stop`."""
+        self._profile_window = (start, stop, logdir)
+
+    def step(self):
+        """Mark the end of one loop iteration; drives profile_steps."""
+        self._step += 1
+        if self._profile_window is None:
+            return
+        start, stop, logdir = self._profile_window
+        if self._step == start:
+            import tensorflow as tf
+            log.info("TensorFlow profiler on at step %d, writing to %s", self._step, logdir)
+            tf.profiler.experimental.start(logdir)
+            self._profiling = True
+        elif self._step == stop:
+            self.close()
+
+    def close(self):
+        """Stop the TensorFlow profiler if the run ended inside its window."""
+        if self._profiling:
+            import tensorflow as tf
+            tf.profiler.experimental.stop()
+            log.info("TensorFlow profiler off at step %d", self._step)
+            self._profiling = False
+        self._profile_window = None
+
+    def stats(self):
+        """
+        name -> {count, total_s, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}; the
+        percentiles are over the last `window` spans, the rest over all.
+        """
+        with self._lock:
+            durations = {name: np.asarray(d) for name, d in self.durations.items()}
+            totals = {name: tuple(t) for name, t in self._totals.items()}
+        stats = {}
+        for name, d in durations.items():
+            count, total, longest = totals[name]
+            p50, p95, p99 = np.percentile(d, [50, 95, 99]) * 1e3
+            stats[name] = {
+                "count": int(count), "total_s": float(total), "mean_ms": float(total / count * 1e3),
+                "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99),
+                "max_ms": float(longest * 1e3),
+            }
+        return stats
+
+    def summary(self):
+        """Text table of the span histograms and counters, slowest total first."""
+        stats = self.stats()
+        lines = [f"{'span':<24}{'count':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"]
+        for name, s in sorted(stats.items(), key=lambda item: -item[1]["total_s"]):
+            lines.append(f"{name:<24}{s['count']:>8}{s['total_s']:>10.2f}{s['p50_ms']:>10.2f}"
+                         f"{s['p95_ms']:>10.2f}{s['p99_ms']:>10.2f}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<24}{value:>8}")
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w") as fh:
+            json.dump({"spans": self.stats(), "counters": self.counters}, fh, indent=2)
+
+    def write_chrome_trace(self, path):
+        """Write the recorded spans in the Chrome trace event format."""
+        with self._lock:
+            events = list(self.events)
+        with open(path, "w") as fh:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fh)
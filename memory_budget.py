@@ -0,0 +1,351 @@
+"""Activation memory estimates and automatic batch sizes for the classifiers.
+
+The cnn's first Conv2D(512) runs at the full 64 x 64 resolution (8 MB of
+float32 activations per patch, twice that with its ReLU), the U-Net keeps
+its encoder maps alive for the skip connections, and a Grad-CAM tape holds
+every intermediate until the backward pass. footprint() walks a model's
+graph (into nested models such as the ResNet101 trunk) and estimates, per
+sample:
+
+    predict   peak of the tensors alive at once in a forward pass: each one
+              lives from the layer that makes it to its last consumer
+    gradcam   everything the tape keeps (every layer output) plus gradient
+              buffers for the two largest tensors
+    train     every layer output kept for backprop plus a gradient for each
+              of them (twice the tape), with the weights, their gradients
+              and two Adam slots (four times the weights) as a fixed cost
+
+batch_size_for() turns that into the largest power-of-two batch that fits a
+memory budget (a share of the available host memory, or an explicit number
+of bytes), and probe_batch_size() runs the real compiled step at that size,
+halving on ResourceExhaustedError. Running out of host memory kills the
+process instead of raising, so on CPU the budget's safety fraction is what
+keeps a batch safe; on a GPU the probe catches what the estimate misses.
+
+The throughput paths (GradCamEngine, GradCamComparison, MultiLayerGradCam,
+TFLiteRunner, FieldScanner, EmbeddingExtractor, batch_job, benchmark and
+train) default to batch_size="auto" and resolve it once, in their
+constructor. XLARunner, ModelCascade, CurveScorer and MicroBatcher answer
+small batches and default to 32 instead. XLARunner and the Grad-CAM
+engines pad a short chunk only up to its bucket_size(), the smallest power
+of two that holds it. TFLite interpreters are measured with
+interpreter_footprint() instead of the Keras graph walk.
+
+    python memory_budget.py --models cnn resnet u_net --budget-gb 8
+
+e.g. footprint(get_model('cnn')).gradcam      # bytes per patch
+     batch_size_for([cnn, resnet, u_net], "gradcam")
+"""
+
+import argparse
+import os
+import sys
+import weakref
+from collections import namedtuple
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+MODES = ("predict", "gradcam", "train")
+
+# Share of the available memory an automatic batch may use
+DEFAULT_FRACTION = 0.5
+
+# Per-sample bytes for each mode, the weights' bytes and the largest tensor
+Footprint = namedtuple("Footprint", ["params", "predict", "gradcam", "train", "largest", "largest_layer"])
+
+_footprints = weakref.WeakKeyDictionary()
+
+
+def _tensor_bytes(tensor):
+    # Per sample: the batch dimension is left out
+    size = int(np.prod([d for d in tensor.shape[1:]]))
+    return size * np.dtype(keras.backend.standardize_dtype(tensor.dtype)).itemsize
+
+
+def _graph(model):
+    # Public layer.input / layer.output are the tensors of the graph a layer
+    # was first called in. A nested model's call isn't public: its outputs are
+    # the consumed tensors no other layer produced, matched by shape
+    layers = [layer for layer in model.layers if not isinstance(layer, keras.layers.InputLayer)]
+    produced = {id(t) for t in model.inputs}
+    graph = []
+    for layer in layers:
+        if isinstance(layer, keras.Model):
+            graph.append((layer, [], []))
+            continue
+        outputs = keras.tree.flatten(layer.output)
+        produced.update(id(t) for t in outputs)
+        graph.append((layer, keras.tree.flatten(layer.input), outputs))
+    orphans = {}
+    for tensor in [t for _, inputs, _ in graph for t in inputs] + list(model.outputs):
+        if id(tensor) not in produced:
+            orphans[id(tensor)] = tensor
+    for layer, _, outputs in graph:
+        if isinstance(layer, keras.Model):
+            for inner in keras.tree.flatten(layer.output):
+                key = next((k for k, t in orphans.items() if t.shape[1:] == inner.shape[1:]), None)
+                if key is not None:
+                    outputs.append(orphans.pop(key))
+    return graph, not orphans
+
+
+def _walk(model, sizes, prefix=""):
+    """
+    Peak live bytes of one forward pass through `model`.
+
+    Every layer output is added to `sizes` (layer name -> bytes), nested
+    models included as "<submodel>/<layer>", for the tape estimate.
+    """
+    graph, complete = _graph(model)
+    if not complete:
+        # Its layers were first called in another graph (e.g. a split-off
+        # trunk): walk a fresh copy instead
+        model = keras.models.clone_model(model)
+        graph, _ = _graph(model)
+    inputs = {id(t) for t in model.inputs}
+    last_use = {}
+    for step, (_, tensors, _) in enumerate(graph):
+        for tensor in tensors:
+            last_use[id(tensor)] = step
+    for tensor in model.outputs:
+        last_use[id(tensor)] = len(graph)
+
+    live = {id(t): _tensor_bytes(t) for t in model.inputs}
+    peak = sum(live.values())
+    for step, (layer, _, outputs) in enumerate(graph):
+        current = sum(live.values())
+        if isinstance(layer, keras.Model):
+            # The nested model's own peak already includes its input
+            inner = _walk(layer, sizes, f"{prefix}{layer.name}/")
+            peak = max(peak, current + inner)
+        else:
+            name = prefix + layer.name
+            sizes[name] = sizes.get(name, 0) + sum(_tensor_bytes(t) for t in outputs)
+        for tensor in outputs:
+            live[id(tensor)] = _tensor_bytes(tensor)
+        peak = max(peak, sum(live.values()))
+        for key in [k for k in live if k not in inputs and last_use.get(k, -1) <= step]:
+            del live[key]
+        for key in [k for k in inputs if k in live and last_use.get(k, -1) <= step]:
+            del live[key]
+    return peak
+
+
+def footprint(model):
+    """Footprint of a Keras model (bytes; predict, gradcam and train are per sample)."""
+    if model not in _footprints:
+        sizes = {}
+        peak = _walk(model, sizes)
+        tape = sum(sizes.values()) + sum(_tensor_bytes(t) for t in model.inputs)
+        largest_layer = max(sizes, key=sizes.get)
+        two_largest = sum(sorted(sizes.values())[-2:])
+        params = sum(int(np.prod(w.shape)) * np.dtype(keras.backend.standardize_dtype(w.dtype)).itemsize
+                     for w in model.weights)
+        _footprints[model] = Footprint(
+            params=params,
+            predict=peak,
+            gradcam=tape + two_largest,
+            train=2 * tape,
+            largest=sizes[largest_layer],
+            largest_layer=largest_layer,
+        )
+    return _footprints[model]
+
+
+def _fixed_and_per_sample(models, mode):
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}.")
+    prints = [footprint(m) for m in models]
+    params = sum(p.params for p in prints)
+    if mode == "predict":
+        # The models run one after the other; only the weights add up
+        return params, max(p.predict for p in prints)
+    if mode == "gradcam":
+        # GradCamComparison keeps every network on one tape
+        return params, sum(p.gradcam for p in prints)
+    # Weights, gradients and Adam's two slots
+    return 4 * params, sum(p.train for p in prints)
+
+
+def available_memory():
+    """Bytes of host memory currently available (MemAvailable, or total physical memory)."""
+    try:
+        with open("/proc/meminfo") as fh:
+            for line in fh:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def memory_budget(fraction=DEFAULT_FRACTION, share=1):
+    """Bytes an automatic batch may use: `fraction` of the available memory, split `share` ways."""
+    return int(available_memory() * fraction / max(int(share), 1))
+
+
+def _as_list(models):
+    if isinstance(models, dict):
+        return list(models.values())
+    if isinstance(models, (list, tuple)):
+        return list(models)
+    return [models]
+
+
+def batch_size_for(models, mode="predict", budget=None, limit=1024, minimum=1):
+    """
+    Largest power-of-two batch of `mode` for `models` that fits `budget` bytes.
+
+    models is one model, a list or a name -> model dict (run together, as
+    in GradCamComparison). budget defaults to memory_budget(). The result is
+    clamped to [minimum, limit].
+    """
+    models = _as_list(models)
+    budget = memory_budget() if budget is None else int(budget)
+    fixed, per_sample = _fixed_and_per_sample(models, mode)
+    return _fit(budget, fixed, per_sample, limit, minimum)
+
+
+def _fit(budget, fixed, per_sample, limit, minimum):
+    # Largest power of two that fits, clamped to [minimum, limit]
+    fits = max((budget - fixed) // max(per_sample, 1), 1)
+    batch_size = 1 << (int(fits).bit_length() - 1)
+    return int(min(max(batch_size, minimum), limit))
+
+
+def bucket_size(n, batch_size):
+    """Smallest power of two that holds `n` samples, capped at `batch_size`."""
+    return int(min(batch_size, 1 << max(int(n) - 1, 0).bit_length()))
+
+
+def bucket_sizes(batch_size):
+    """Every bucket_size() a batch of up to `batch_size` samples can get, smallest first."""
+    return sorted({bucket_size(1 << i, batch_size) for i in range(int(batch_size).bit_length() + 1)})
+
+
+def interpreter_footprint(model_path):
+    """
+    (fixed, per-sample) bytes of a .tflite model's tensors.
+
+    The model is allocated at batch 1 and 2 without the default delegates
+    (XNNPACK hides the intermediate tensors it fuses); tensors that grow with
+    the batch are activations, the rest (weights, constants) is fixed. The
+    interpreter's arena reuses memory between layers, so this is an upper
+    bound.
+    """
+    from quantized_inference import Interpreter, OpResolverType
+
+    interpreter = Interpreter(model_path=model_path,
+                              experimental_op_resolver_type=OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES)
+    details = interpreter.get_input_details()[0]
+    sizes = []
+    for batch in (1, 2):
+        interpreter.resize_tensor_input(details["index"], [batch, *details["shape"][1:]])
+        interpreter.allocate_tensors()
+        sizes.append(sum(int(np.prod(t["shape"])) * np.dtype(t["dtype"]).itemsize
+                         for t in interpreter.get_tensor_details()))
+    per_sample = sizes[1] - sizes[0]
+    return sizes[0] - per_sample, per_sample
+
+
+def interpreter_batch_size(model_path, budget=None, limit=1024, minimum=1):
+    """Largest power-of-two batch for a .tflite model that fits `budget` bytes."""
+    budget = memory_budget() if budget is None else int(budget)
+    fixed, per_sample = interpreter_footprint(model_path)
+    return _fit(budget, fixed, per_sample, limit, minimum)
+
+
+def _run_once(models, mode, batch_size):
+    # Build and run the real compiled step once at this batch size
+    from gradcam_engine import GradCamComparison
+    from quantized_inference import XLARunner
+
+    models = _as_list(models)
+    x = np.zeros((batch_size,) + tuple(models[0].inputs[0].shape[1:]), np.float32)
+    if mode == "gradcam":
+        GradCamComparison({f"m{i}": m for i, m in enumerate(models)}, batch_size=batch_size).compute(x)
+    elif mode == "predict":
+        for model in models:
+            XLARunner(model, batch_size=batch_size).predict(x)
+    else:
+        raise ValueError("only the predict and gradcam steps can be probed")
+
+
+def probe_batch_size(models, mode="predict", batch_size=None, minimum=1, **kwargs):
+    """
+    Run the real `mode` step at `batch_size` (default: batch_size_for(models,
+    mode, **kwargs)) and halve it until that no longer runs out of memory.
+    """
+    if batch_size is None:
+        batch_size = batch_size_for(models, mode, minimum=minimum, **kwargs)
+    while True:
+        try:
+            _run_once(models, mode, batch_size)
+            return batch_size
+        except tf.errors.ResourceExhaustedError:
+            if batch_size <= minimum:
+                raise
+            batch_size = max(batch_size // 2, minimum)
+
+
+def resolve_batch_size(batch_size, models, mode="predict", **kwargs):
+    """batch_size as an int; "auto" (or None) picks batch_size_for(models, mode, **kwargs)."""
+    if batch_size is None or batch_size == "auto":
+        return batch_size_for(models, mode, **kwargs)
+    return int(batch_size)
+
+
+def report(models, budget=None):
+    """
+    One row per model: weights, per-sample predict / Grad-CAM / train
+    memory, the largest layer output and the batch size each mode gets.
+    """
+    budget = memory_budget() if budget is None else int(budget)
+    rows = []
+    for name, model in models.items():
+        fp = footprint(model)
+        rows.append({
+            "model": name,
+            "params_mb": fp.params / 2**20,
+            "predict_mb": fp.predict / 2**20,
+            "gradcam_mb": fp.gradcam / 2**20,
+            "train_mb": fp.train / 2**20,
+            "largest_layer": fp.largest_layer,
+            "largest_mb": fp.largest / 2**20,
+            **{f"{mode}_batch": batch_size_for(model, mode, budget) for mode in MODES},
+        })
+    return rows
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--models", nargs="+", default=["cnn", "resnet", "u_net"])
+    parser.add_argument("--budget-gb", type=float, default=None,
+                        help=f"memory budget; default {DEFAULT_FRACTION:.0%} of the available memory")
+    parser.add_argument("--probe", action="store_true", help="also run the predict and Grad-CAM steps")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from models import get_model
+
+    args = _parse_args(argv)
+    budget = int(args.budget_gb * 2**30) if args.budget_gb else memory_budget()
+    models = {name: get_model(name, weights=None, logits=True) for name in args.models}
+    print(f"budget {budget / 2**30:.1f} GB")
+    for r in report(models, budget):
+        print(f"{r['model']:<7} weights {r['params_mb']:7.1f} MB  per patch: predict {r['predict_mb']:6.2f} MB  "
+              f"gradcam {r['gradcam_mb']:6.2f} MB  train {r['train_mb']:6.2f} MB  "
+              f"largest {r['largest_layer']} {r['largest_mb']:.2f} MB")
+        print(f"{'':<7} batch sizes: predict {r['predict_batch']}  gradcam {r['gradcam_batch']}  "
+              f"train {r['train_batch']}")
+    if args.probe:
+        for mode in ("predict", "gradcam"):
+            print(f"all models, {mode}: {probe_batch_size(models, mode, budget=budget)} after probing")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
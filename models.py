@@ -0,0 +1,246 @@
+"""Vortex classifier architectures and a lazy, per-process model registry.
+
+build_model(name) builds a fresh, untrained network. get_model(name) builds
+each architecture on first use, loads its weights from the configured path
+and hands the same instance to every later caller in the process. With an
+artifact directory configured, the built model is also saved as a .keras
+file and reloaded from there on the next start.
+
+Nothing here is built, loaded or mounted at import time.
+"""
+
+import hashlib
+import os
+import threading
+
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+
+MODEL_NAMES = ('cnn', 'resnet', 'u_net')
+
+initializer = tf.keras.initializers.RandomNormal(mean=0.0, stddev=1.0, seed=1234)
+
+# Method that sets up the (untrained) networks and returns the model based on parameter 'name'.
+#   Use get_model below to get a cached instance with its weights loaded.
+
+def build_model(name):
+  # CNN
+  if name == 'cnn':
+
+    # Single channel input grey scale
+    input_cube = keras.Input(shape = (64,64,1))
+
+    x = layers.Conv2D(512, (3,3), activation=None, padding='same', kernel_initializer=initializer)(input_cube)
+    x = layers.Activation('relu')(x)
+    x = layers.BatchNormalization()(x)
+    x = layers.MaxPooling2D((2,2), padding='same')(x)
+    x = layers.Conv2D(256, (3,3), activation=None, padding='same',kernel_initializer=initializer)(x)
+    x = layers.Activation('relu')(x)
+    x = layers.BatchNormalization()(x)
+    x = layers.MaxPooling2D((2,2), padding='same')(x)
+    x = layers.Conv2D(128, (3,3), activation=None, padding='same',kernel_initializer=initializer)(x)
+    x = layers.Activation('relu')(x)
+    x = layers.BatchNormalization()(x)
+    x = layers.MaxPooling2D((2,2), padding='same')(x)
+
+    x = layers.Flatten()(x)
+
+    x = layers.Dense(1024, activation='relu',kernel_initializer=initializer)(x)
+    x = layers.Dropout(0.2, seed=1234)(x)
+    x = layers.Dense(512, activation='relu',kernel_initializer=initializer)(x)
+    x = layers.Dropout(0.2, seed=1234)(x)
+    output = layers.Dense(3, activation='softmax',kernel_initializer=initializer)(x)
+
+    model = keras.Model(input_cube, output)
+
+    model.compile(optimizer='adam', loss=tf.keras.losses.CategoricalCrossentropy(
+        reduction=tf.keras.losses.Reduction.SUM),metrics=['accuracy'])
+
+    return model
+
+  elif name == 'resnet':
+    # ResNet
+
+        # input layer takes single channel
+        input_cube = keras.Input(shape=(64, 64, 1))
+        # this layer converts the input from a single channel to three channels
+        #   reason being ResNet expects three-channel input (RGB)
+        x = layers.Conv2D(3, (3, 3), padding='same')(input_cube)
+        r_model = tf.keras.applications.ResNet101(include_top=False, weights=None, input_shape=(64, 64, 3))
+
+
+        x = r_model(x)
+        x = layers.Flatten()(x)
+        output = layers.Dense(3, activation='softmax', kernel_initializer=initializer)(x)
+
+        model = tf.keras.Model(inputs=input_cube, outputs=output)
+        opt = keras.optimizers.Adam(learning_rate=0.001)
+        model.compile(optimizer=opt, loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+
+        return model
+  elif name == "u_net":
+    #input_size = (64,64,2)
+    input_cube = keras.Input(shape=(64, 64, 1))
+    conv1 = keras.layers.Conv2D(64, 3, activation = 'relu', padding = 'same')(input_cube)
+    conv1 = keras.layers.Conv2D(64, 3, activation = 'relu', padding = 'same')(conv1)
+    drop1 = keras.layers.Dropout(0.01)(conv1)
+    pool1 = keras.layers.MaxPooling2D(pool_size=(2, 2))(drop1)
+
+    conv2 = keras.layers.Conv2D(128, 3, activation = 'relu', padding = 'same')(pool1)
+    conv2 = keras.layers.Conv2D(128, 3, activation = 'relu', padding = 'same')(conv2)
+    drop2 = keras.layers.Dropout(0.01)(conv2)
+    pool2 = keras.layers.MaxPooling2D(pool_size=(2, 2))(drop2)
+
+    conv3 = keras.layers.Conv2D(256, 3, activation = 'relu', padding = 'same')(pool2)
+    conv3 = keras.layers.Conv2D(256, 3, activation = 'relu', padding = 'same')(conv3)
+    # pool3 = MaxPooling2D(pool_size=(2, 2))(conv3)
+    # conv4 = Conv2D(512, 3, activation = 'relu', padding = 'same')(pool3)
+    # conv4 = Conv2D(512, 3, activation = 'relu', padding = 'same')(conv4)
+
+    drop3 = keras.layers.Dropout(0.01)(conv3)
+    pool3 = keras.layers.MaxPooling2D(pool_size=(2, 2))(drop3)
+
+    conv4 = keras.layers.Conv2D(512, 3, activation = 'relu', padding = 'same')(pool3)
+    conv4 = keras.layers.Conv2D(512, 3, activation = 'relu', padding = 'same')(conv4)
+    #drop4 = Dropout(0.01)(conv4)
+    #pool4 = MaxPooling2D(pool_size=(2, 2))(drop4)
+    # up6 = Conv2D(512, 2, activation = 'relu', padding = 'same')(UpSampling2D(size = (2,2))(drop5))
+    # merge6 = concatenate([drop4,up6], axis = 3)
+    # conv6 = Conv2D(512, 3, activation = 'relu', padding = 'same')(merge6)
+    # conv6 = Conv2D(512, 3, activation = 'relu', padding = 'same')(conv6)
+
+    up7 = keras.layers.Conv2D(256, 2, activation = 'relu', padding = 'same')(keras.layers.UpSampling2D(size = (2,2))(conv4))
+    merge7 = keras.layers.concatenate([conv3,up7], axis = 3)
+    drop7 = keras.layers.Dropout(0.01)(merge7)
+    conv7 = keras.layers.Conv2D(256, 3, activation = 'relu', padding = 'same')(drop7)
+    conv7 = keras.layers.Conv2D(256, 3, activation = 'relu', padding = 'same')(conv7)
+
+    #pool7 = MaxPooling2D(pool_size=(2, 2))(drop3)
+
+    up8 = keras.layers.Conv2D(128, 2, activation = 'relu', padding = 'same')(keras.layers.UpSampling2D(size = (2,2))(drop7))
+    merge8 = keras.layers.concatenate([conv2,up8], axis = 3)
+    drop8 = keras.layers.Dropout(0.01)(merge8)
+    conv8 = keras.layers.Conv2D(128, 3, activation = 'relu', padding = 'same')(drop8)
+    conv8 = keras.layers.Conv2D(128, 3, activation = 'relu', padding = 'same')(conv8)
+
+    up9 = keras.layers.Conv2D(64, 2, activation = 'relu', padding = 'same')(keras.layers.UpSampling2D(size = (2,2))(drop8))
+    merge9 = keras.layers.concatenate([conv1,up9], axis = 3)
+    drop9 = keras.layers.Dropout(0.01)(merge9)
+    conv9 = keras.layers.Conv2D(64, 3, activation = 'relu', padding = 'same')(drop9)
+    conv9 = keras.layers.Conv2D(64, 3, activation = 'relu', padding = 'same')(conv9)
+
+    #conv9 = Conv2D(2, 3, activation = 'relu', padding = 'same')(conv9)
+    #drop9 = Dropout(0.01)(conv9)
+
+    conv10 = keras.layers.Conv2D(1, 1, activation = 'sigmoid')(conv9)
+
+    flat_output = keras.layers.Flatten()(conv10)
+    dense_output = keras.layers.Dense(3, activation='softmax')(flat_output)
+
+
+    model = keras.Model(inputs = input_cube, outputs = dense_output)
+    opt = keras.optimizers.Adam(learning_rate=0.001)
+    model.compile(optimizer = opt, loss = 'binary_crossentropy', metrics = ['accuracy'])
+    #model.compile(optimizer = opt, loss = dice_coef_loss, metrics = ['accuracy'])
+    #model.compile(optimizer = opt, loss = dice_loss, metrics = ['accuracy'])
+
+    # model.compile(optimizer = opt, loss = u_net_loss, metrics = ['accuracy'])
+
+    #model.compile(optimizer=opt, loss=tversky_loss, metrics=['accuracy'])
+    #model.compile(optimmizer=opt, metrics=[tf.keras.metrics.MeanIoU(num_classes=2)]))
+    #model.summary()
+    return model
+  else:
+    raise ValueError(f"I don't recognize the name of that model: {name!r}")
+
+
+# Where the trained weights live. FLOW_PATCHES_DIR points at the shared
+#   __FLOW_PATCHES folder (the Drive copy on Colab); individual paths can be
+#   overridden with set_weights_path.
+FLOW_PATCHES_DIR = os.environ.get("FLOW_PATCHES_DIR", "/content/drive/MyDrive/__FLOW_PATCHES")
+
+WEIGHTS_PATHS = {
+    'cnn': os.path.join(FLOW_PATCHES_DIR, "model_mag", "30.h5"),
+    'resnet': None,
+    'u_net': None,
+}
+
+# Optional directory of serialized .keras models for faster warm starts
+ARTIFACT_DIR = os.environ.get("FLOW_MODEL_ARTIFACTS") or None
+
+_DEFAULT = object()
+_models = {}
+_lock = threading.Lock()
+
+
+def set_weights_path(name, path):
+    """Use the weights at `path` for get_model(name); None means untrained."""
+    if name not in MODEL_NAMES:
+        raise ValueError(f"I don't recognize the name of that model: {name!r}")
+    WEIGHTS_PATHS[name] = path
+
+
+def set_artifact_dir(path):
+    """Save built models to, and reload them from, `path`; None turns it off."""
+    global ARTIFACT_DIR
+    ARTIFACT_DIR = path
+
+
+def _fingerprint(weights):
+    if weights is None:
+        return "untrained"
+    stat = os.stat(weights)
+    key = f"{os.path.abspath(weights)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def _load(name, weights, logits):
+    artifact = None
+    if ARTIFACT_DIR:
+        suffix = "-logits" if logits else ""
+        artifact = os.path.join(ARTIFACT_DIR, f"{name}{suffix}-{_fingerprint(weights)}.keras")
+        if os.path.exists(artifact):
+            return keras.models.load_model(artifact)
+
+    model = build_model(name)
+    if weights is not None:
+        model.load_weights(weights) # removed by_name = True - was causing inefficient weight error. Discrepancies with weights associated with layer names.
+    if logits:
+        # Grad-CAM wants the raw class scores rather than the softmax
+        model.layers[-1].activation = keras.activations.linear
+
+    if artifact is not None:
+        os.makedirs(ARTIFACT_DIR, exist_ok=True)
+        model.save(artifact)
+    return model
+
+
+def get_model(name, weights=_DEFAULT, logits=False):
+    """
+    Cached model for `name`, built and loaded on first use.
+
+    weights defaults to the configured WEIGHTS_PATHS entry; pass a path to
+    load other weights or None for an untrained network. logits=True gives a
+    separate instance whose last Dense layer has no softmax, as used for
+    Grad-CAM. The instances are shared, so don't modify them in place.
+    """
+    if name not in MODEL_NAMES:
+        raise ValueError(f"I don't recognize the name of that model: {name!r}")
+    if weights is _DEFAULT:
+        weights = WEIGHTS_PATHS[name]
+    if weights is not None and not os.path.exists(weights):
+        raise FileNotFoundError(f"No weights for {name!r} at {weights}; "
+                                "see set_weights_path or pass weights=None.")
+
+    key = (name, weights, bool(logits))
+    with _lock:
+        if key not in _models:
+            _models[key] = _load(name, weights, logits)
+        return _models[key]
+
+
+def clear_models():
+    """Forget every cached model, e.g. after changing the weight paths."""
+    with _lock:
+        _models.clear()
@@ -0,0 +1,180 @@
+"""Headless, parallel rendering of the Grad-CAM comparison panels.
+
+Drawing the 3x4 comparison figure took longer than running the three
+networks, and plt.show() blocked the loop on every patch. PanelRenderer
+draws the same panels with the Agg canvas in a pool of worker processes and
+writes them to disk, so inference never waits for matplotlib.
+
+This module only depends on numpy and matplotlib. The workers are spawned,
+so they re-import the main script (as __mp_main__) but not its
+`if __name__ == "__main__"` block: keep that script's top-level imports free
+of TensorFlow, as grad_cam.py does, or every worker pays for importing it.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib.colors as colors
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+
+class MidpointNormalize(colors.Normalize):
+    """
+    Normalise the colorbar so that diverging bars work there way either side from a prescribed midpoint value)
+
+    e.g. im=ax1.imshow(array, norm=MidpointNormalize(midpoint=0.,vmin=-100, vmax=100))
+    """
+    def __init__(self, vmin=None, vmax=None, midpoint=None, clip=False):
+        self.midpoint = midpoint
+        colors.Normalize.__init__(self, vmin, vmax, clip)
+
+    def __call__(self, value, clip=None):
+        #I'm ignoring masked values and all kinds of edge cases to make a
+        # simple example...
+        x, y = [self.vmin, self.midpoint, self.vmax], [0, 0.5, 1]
+        return np.ma.masked_array(np.interp(value, x, y), np.isnan(value))
+
+
+MODEL_TITLES = {'cnn': "CNN", 'resnet': "ResNet", 'u_net': "U-Net"}
+
+
+def _diverging(ax, array, title, colorbar=False):
+    image = ax.imshow(array, cmap="coolwarm",
+                      norm=MidpointNormalize(midpoint=0, vmin=np.min(array), vmax=np.max(array)))
+    if colorbar:
+        ax.figure.colorbar(image, ax=ax, fraction=0.046, pad=0.04)
+    ax.set_title(title)
+
+
+def render_panel(item, out_path, fast=False, dpi=100):
+    """
+    Draw one comparison panel and write it to out_path (.png or .pdf).
+
+    item is a dict with
+      path      source of the patch, only used for the title
+      U, V      optional (64, 64) velocity components
+      image     (64, 64) grey-scale input the classifiers saw, f[0, :, :, 0]
+      overlays  model name -> (64, 64, 3) jet-colored heatmap in [0, 1]
+      classes   model name -> predicted class name
+    Everything is drawn from these arrays; nothing is read from disk.
+    Without U and V the streamplot and component panels are left out and
+    the magnitude is the image in the patch's own layout. fast skips the
+    streamplot, which is by far the slowest panel.
+    """
+    U, V = item.get('U'), item.get('V')
+    has_uv = U is not None and V is not None
+    # The three magnitude maps of the old figure were identical; compute once
+    mag = np.sqrt(U * U + V * V) if has_uv else np.asarray(item['image']).T
+
+    fig = Figure(figsize=(18, 10))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(3, 4).ravel()
+
+    # Original image with each model's heatmap
+    for k, (name, overlay) in enumerate(item['overlays'].items()):
+        ax = axes[k]
+        ax.imshow(item['image'], cmap="gray")
+        ax.imshow(overlay, alpha=0.4)
+        title = f"{MODEL_TITLES.get(name, name)} Heatmap"
+        if name in item.get('classes', {}):
+            title += f" ({item['classes'][name]})"
+        ax.set_title(title)
+    k = len(item['overlays'])
+
+    _diverging(axes[k], mag, "Magnitude Map")
+    k += 1
+
+    if has_uv and not fast:
+        nx, ny = U.shape[1], U.shape[0]
+        x = np.linspace(-5, 5, nx)
+        y = np.linspace(-5, 5, ny)
+        axes[k].invert_yaxis()
+        axes[k].streamplot(x, y, U, V)
+        axes[k].set_title("Streamplot")
+        k += 1
+
+    locs = np.linspace(0, mag.shape[0] - 1, 9)
+    labels = ["%.1f" % l for l in np.linspace(-4, 4, 9)]
+    for component, title in ((U, "U component"), (V, "V component")) if has_uv else ():
+        _diverging(axes[k], component, title, colorbar=True)
+        axes[k].set_xticks(locs, labels)
+        axes[k].set_yticks(locs, labels)
+        k += 1
+
+    for ax in axes[k:]:
+        ax.set_axis_off()
+
+    fig.suptitle(f"Comparison of Grad-Cam Heatmaps and Magnitude Maps - {item['path']}")
+    fig.tight_layout()
+    fig.savefig(out_path, dpi=dpi)
+    return out_path
+
+
+class PanelRenderer:
+    """
+    Process pool that renders comparison panels to out_dir off the main loop.
+
+    submit() returns right away unless `max_pending` panels are still being
+    drawn, in which case it waits for one to finish so a slow disk cannot
+    pile up unbounded arrays in memory. Use as a context manager, or call
+    close() to wait for the remaining panels.
+
+    e.g. with PanelRenderer("panels/", fast=True) as renderer:
+             renderer.submit(item, name=str(i))
+    """
+    def __init__(self, out_dir, num_workers=None, fmt="png", fast=False, dpi=100, max_pending=None):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.fast = fast
+        self.dpi = dpi
+        num_workers = num_workers or max(1, (os.cpu_count() or 2) - 1)
+        self._slots = threading.BoundedSemaphore(max_pending or 4 * num_workers)
+        self._pool = ProcessPoolExecutor(max_workers=num_workers,
+                                         mp_context=multiprocessing.get_context("spawn"))
+        # Only unfinished panels are kept; finished ones leave their path or error
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.written = []
+        self.errors = []
+
+    def _done(self, future, out_path):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is None:
+                self.written.append(future.result())
+            else:
+                self.errors.append((out_path, future.exception()))
+        self._slots.release()
+
+    def submit(self, item, name):
+        out_path = os.path.join(self.out_dir, f"{name}.{self.fmt}")
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(render_panel, item, out_path, self.fast, self.dpi)
+        except BaseException:
+            # Nothing was queued (e.g. the pool is shut down or broken)
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(lambda f: self._done(f, out_path))
+        return future
+
+    def close(self):
+        """
+        Wait for every submitted panel; returns the written paths. Panels
+        that failed are listed in `errors` as (path, exception).
+        """
+        self._pool.shutdown(wait=True)
+        return list(self.written)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
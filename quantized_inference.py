@@ -0,0 +1,197 @@
+"""CPU-optimized inference backends for the vortex classifiers.
+
+fp32 Keras predict() on the 512-filter CNN and the full ResNet101 is the main
+cost on CPU-only nodes. This module exports get_model networks to TFLite
+(dynamic-range, float16 or full int8 quantization calibrated on flow patches)
+or compiles them with XLA, and wraps the result in a runner with the same
+predict(x, batch_size) interface as a Keras model. accuracy_drift compares a
+runner against the fp32 model on a labeled shard before it is trusted.
+
+e.g. path = export_tflite(get_model('cnn'), "cnn-int8.tflite", mode="int8",
+                          calibration=shards.magnitude(0, 512))
+     runner = TFLiteRunner(path, num_threads=8)
+     print(accuracy_drift(get_model('cnn'), runner, FlowShards(shard_dir)))
+"""
+
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from memory_budget import bucket_size, interpreter_batch_size, resolve_batch_size
+
+try:
+    from ai_edge_litert.interpreter import Interpreter, OpResolverType
+except ImportError:
+    Interpreter = tf.lite.Interpreter
+    OpResolverType = tf.lite.experimental.OpResolverType
+
+QUANTIZATION_MODES = ("none", "dynamic", "float16", "int8")
+
+
+def export_tflite(model, out_path, mode="dynamic", calibration=None, calibration_steps=256):
+    """
+    Convert a Keras model to a .tflite file and return its path.
+
+    mode is "none" (plain fp32 TFLite), "dynamic" (int8 weights, float
+    activations), "float16" (half-precision weights) or "int8" (int8 weights
+    and activations). "int8" needs `calibration`, an (N, 64, 64, 1) array of
+    representative magnitude patches; inputs and outputs stay float32.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode {mode!r}, expected one of {QUANTIZATION_MODES}.")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if mode != "none":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == "int8":
+        if calibration is None:
+            raise ValueError("Full int8 quantization needs calibration patches.")
+        calibration = np.asarray(calibration, dtype=np.float32)[:calibration_steps]
+
+        def representative_dataset():
+            for patch in calibration:
+                yield [patch[np.newaxis]]
+
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    flatbuffer = converter.convert()
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, "wb") as fh:
+        fh.write(flatbuffer)
+    return out_path
+
+
+def export_all(out_dir, names=("cnn", "resnet", "u_net"), mode="dynamic", calibration=None):
+    """Export the registry's networks (weights loaded) to out_dir/<name>-<mode>.tflite."""
+    from models import get_model
+
+    return {
+        name: export_tflite(get_model(name), os.path.join(out_dir, f"{name}-{mode}.tflite"),
+                            mode=mode, calibration=calibration)
+        for name in names
+    }
+
+
+class TFLiteRunner:
+    """
+    predict() over a .tflite model, resized to a fixed batch so the
+    interpreter allocates its tensors only once.
+
+    batch_size="auto" sizes the batch to the memory budget from the
+    interpreter's own tensors (memory_budget.interpreter_footprint).
+    """
+    def __init__(self, model_path, num_threads=None, batch_size="auto"):
+        self.model_path = model_path
+        if batch_size is None or batch_size == "auto":
+            self.batch_size = interpreter_batch_size(model_path)
+        else:
+            self.batch_size = int(batch_size)
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads or os.cpu_count())
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.input_shape = tuple(self._input["shape"][1:])
+        self.output_shape = tuple(self._output["shape"][1:])
+        self.interpreter.resize_tensor_input(self._input["index"], [self.batch_size, *self.input_shape])
+        self.interpreter.allocate_tensors()
+
+    def predict(self, x, batch_size=None, verbose=0):
+        x = np.asarray(x, dtype=np.float32)
+        if not len(x):
+            return np.zeros((0,) + self.output_shape, np.float32)
+        outputs = []
+        for start in range(0, len(x), self.batch_size):
+            batch = x[start:start + self.batch_size]
+            valid = len(batch)
+            if valid < self.batch_size:
+                batch = np.concatenate([batch, np.zeros((self.batch_size - valid,) + batch.shape[1:], np.float32)])
+            self.interpreter.set_tensor(self._input["index"], batch)
+            self.interpreter.invoke()
+            outputs.append(self.interpreter.get_tensor(self._output["index"])[:valid].copy())
+        return np.concatenate(outputs)
+
+    __call__ = predict
+
+
+class XLARunner:
+    """
+    predict() through an XLA-compiled forward pass.
+
+    Inputs run in chunks of batch_size; the last chunk is padded only up to
+    the smallest power-of-two bucket that holds it, so a single patch runs
+    at batch 1 (XLA compiles each bucket once, on first use). The default
+    suits interactive callers; throughput jobs pass batch_size="auto" to
+    size the chunks to the memory budget.
+    """
+    def __init__(self, model, batch_size=32):
+        self.model = model
+        self.batch_size = resolve_batch_size(batch_size, model, "predict")
+        self.input_shape = tuple(model.inputs[0].shape[1:])
+        self.output_shape = tuple(model.outputs[0].shape[1:])
+        self._forward = tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec((None,) + self.input_shape, tf.float32)],
+            jit_compile=True,
+        )
+
+    def predict(self, x, batch_size=None, verbose=0):
+        x = np.asarray(x, dtype=np.float32)
+        if not len(x):
+            return np.zeros((0,) + self.output_shape, np.float32)
+        outputs = []
+        for start in range(0, len(x), self.batch_size):
+            batch = x[start:start + self.batch_size]
+            valid = len(batch)
+            padded = bucket_size(valid, self.batch_size)
+            if valid < padded:
+                batch = np.concatenate([batch, np.zeros((padded - valid,) + batch.shape[1:], np.float32)])
+            outputs.append(self._forward(tf.constant(batch)).numpy()[:valid])
+        return np.concatenate(outputs)
+
+    __call__ = predict
+
+
+def _timed_predict(predictor, x, batch_size):
+    start = time.perf_counter()
+    preds = predictor.predict(x, batch_size=batch_size, verbose=0)
+    return np.asarray(preds), time.perf_counter() - start
+
+
+def accuracy_drift(reference, runner, shards, limit=2048, batch_size=32):
+    """
+    Compare `runner` against the fp32 `reference` model on a labeled FlowShards.
+
+    Both run on the first `limit` patches (a warm-up batch is excluded from
+    the timings). Returns a dict with both accuracies over the patches that
+    carry a label, the top-1 agreement between the two, the largest absolute
+    output difference and the measured speedup.
+    """
+    limit = min(limit, len(shards))
+    x = np.asarray(shards.magnitude(0, limit), dtype=np.float32)
+    labels = np.asarray(shards.labels(0, limit))
+
+    warm_up = x[:batch_size]
+    reference.predict(warm_up, batch_size=batch_size, verbose=0)
+    runner.predict(warm_up, batch_size=batch_size, verbose=0)
+    ref_preds, ref_seconds = _timed_predict(reference, x, batch_size)
+    run_preds, run_seconds = _timed_predict(runner, x, batch_size)
+
+    ref_classes = ref_preds.argmax(axis=1)
+    run_classes = run_preds.argmax(axis=1)
+    labeled = labels >= 0
+    n_labeled = int(labeled.sum())
+    return {
+        "patches": int(limit),
+        "labeled": n_labeled,
+        "fp32_accuracy": float((ref_classes[labeled] == labels[labeled]).mean()) if n_labeled else None,
+        "accuracy": float((run_classes[labeled] == labels[labeled]).mean()) if n_labeled else None,
+        "agreement": float((ref_classes == run_classes).mean()),
+        "max_abs_diff": float(np.abs(ref_preds - run_preds).max()),
+        "fp32_patches_per_s": limit / ref_seconds,
+        "patches_per_s": limit / run_seconds,
+        "speedup": ref_seconds / run_seconds,
+    }
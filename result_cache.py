@@ -0,0 +1,199 @@
+"""Content-addressed on-disk cache for predictions and Grad-CAM heatmaps.
+
+Re-running the comparison over the same patches with the same weights used to
+recompute everything. ResultCache keys every result on a hash of the patch
+contents, the model name, a fingerprint of the model weights, the explained
+layer and the class index, so only new or changed patches are computed.
+
+Results live in one SQLite file (WAL mode), which makes the cache safe to
+share between worker processes. Predictions are stored as float32 and
+heatmaps as float16. Once the cache grows past `max_bytes`, the least
+recently used entries are evicted.
+
+e.g. cache = ResultCache("gradcam-cache.sqlite", max_bytes=2 << 30)
+     comparison = CachedComparison(GradCamComparison(models), cache)
+     results = comparison.compute(patches)      # same API as GradCamComparison
+"""
+
+import contextlib
+import hashlib
+import sqlite3
+import time
+import weakref
+
+import numpy as np
+
+from gradcam_engine import ModelExplanation
+
+_fingerprints = weakref.WeakKeyDictionary()
+
+
+def model_fingerprint(model):
+    """Hash of a model's weights and activations, computed once per model."""
+    if model not in _fingerprints:
+        digest = hashlib.sha256()
+        for weight in model.weights:
+            digest.update(np.ascontiguousarray(weight.numpy()).tobytes())
+        # The logits and softmax variants share weights but not outputs
+        for layer in model.layers:
+            activation = getattr(layer, "activation", None)
+            digest.update(getattr(activation, "__name__", str(activation)).encode())
+        _fingerprints[model] = digest.hexdigest()[:32]
+    return _fingerprints[model]
+
+
+def result_key(patch, model_name, fingerprint, layer_name, class_index=-1):
+    """Cache key for one patch; class_index -1 means "the top predicted class"."""
+    patch = np.ascontiguousarray(patch, dtype=np.float32)
+    digest = hashlib.sha256(patch.tobytes())
+    digest.update(f"|{patch.shape}|{model_name}|{fingerprint}|{layer_name}|{int(class_index)}".encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Size-bounded LRU store of (predictions, explained class, heatmap) per key.
+
+    Every write (a batch of inserts or of access-time updates) runs in one
+    explicit transaction, so any number of processes can open the same file
+    and a batch costs one commit rather than one per row.
+    """
+    def __init__(self, path, max_bytes=1 << 30, timeout=60.0):
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, predictions BLOB, class INTEGER, heatmap BLOB,"
+            " height INTEGER, width INTEGER, size INTEGER, last_access REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_lru ON results (last_access)")
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        """key -> ModelExplanation of a single patch, for the keys that are cached."""
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._db.execute(
+                f"SELECT key, predictions, class, heatmap, height, width FROM results "
+                f"WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            for key, preds, cls, heatmap, height, width in rows:
+                found[key] = ModelExplanation(
+                    np.frombuffer(preds, np.float32),
+                    int(cls),
+                    np.frombuffer(heatmap, np.float16).reshape(height, width).astype(np.float32),
+                )
+        if found:
+            now = time.time()
+            with self._transaction():
+                self._db.executemany("UPDATE results SET last_access = ? WHERE key = ?",
+                                     [(now, key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """Store (key, predictions, class, heatmap) tuples, then evict down to max_bytes."""
+        now = time.time()
+        rows = []
+        for key, preds, cls, heatmap in items:
+            preds = np.asarray(preds, np.float32).tobytes()
+            heatmap = np.asarray(heatmap, np.float16)
+            blob = heatmap.tobytes()
+            rows.append((key, preds, int(cls), blob, heatmap.shape[0], heatmap.shape[1],
+                         len(preds) + len(blob), now))
+        with self._transaction():
+            self._db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._evict()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # The connection is in autocommit mode; group a batch into one commit
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        while total > self.max_bytes:
+            victims = []
+            for key, size in self._db.execute(
+                    "SELECT key, size FROM results ORDER BY last_access LIMIT 256"):
+                if total <= self.max_bytes:
+                    break
+                victims.append((key,))
+                total -= size
+            if not victims:
+                break
+            self._db.executemany("DELETE FROM results WHERE key = ?", victims)
+
+    def size_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+class CachedComparison:
+    """
+    GradCamComparison (or anything with the same compute API) in front of a
+    ResultCache: only the patches missing for at least one model are run
+    through the networks.
+    """
+    def __init__(self, comparison, cache):
+        self.comparison = comparison
+        self.cache = cache
+        self.names = list(comparison.names)
+        # The gradient sub-models carry the same weights as the networks
+        self._fingerprints = {
+            name: model_fingerprint(grad_model)
+            for name, grad_model in zip(self.names, comparison.grad_models)
+        }
+
+    def compute(self, img_array, pred_index=None):
+        img_array = np.asarray(img_array, dtype=np.float32)
+        n = len(img_array)
+        class_index = np.full(n, -1) if pred_index is None else np.broadcast_to(pred_index, (n,))
+        keys = {
+            name: [result_key(img_array[k], name, self._fingerprints[name],
+                              self.comparison.last_conv_layer_names[name], class_index[k])
+                   for k in range(n)]
+            for name in self.names
+        }
+        cached = {name: self.cache.get_many(keys[name]) for name in self.names}
+
+        missing = [k for k in range(n) if any(keys[name][k] not in cached[name] for name in self.names)]
+        if missing:
+            fresh = self.comparison.compute(img_array[missing],
+                                            None if pred_index is None else class_index[missing])
+            for name in self.names:
+                items = []
+                for j, k in enumerate(missing):
+                    result = ModelExplanation(fresh[name].predictions[j], int(fresh[name].classes[j]),
+                                              fresh[name].heatmaps[j])
+                    cached[name][keys[name][k]] = result
+                    items.append((keys[name][k],) + tuple(result))
+                self.cache.put_many(items)
+
+        return {
+            name: ModelExplanation(
+                np.stack([cached[name][key].predictions for key in keys[name]]),
+                np.array([cached[name][key].classes for key in keys[name]]),
+                np.stack([cached[name][key].heatmaps for key in keys[name]]),
+            )
+            for name in self.names
+        }
+
+    __call__ = compute
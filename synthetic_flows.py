@@ -0,0 +1,77 @@
+"""Analytic U/V flow patches for benchmarks and sanity checks.
+
+The patches follow the layout of the __FLOW_PATCHES .npy files: a (2, 64, 64)
+float32 array with U in [0] and V in [1], indexed [row, column] = [y, x] on
+the same [-5, 5] grid the comparison streamplot uses. Classes follow
+CLASS_NAMES: 0 = CCW vortex, 1 = CW vortex, 2 = saddle.
+
+No Drive data is needed, so anything built on these runs anywhere.
+"""
+
+import numpy as np
+
+from flow_data import PATCH_SIZE
+
+GRID_EXTENT = 5.0
+
+
+def _grid(size=PATCH_SIZE):
+    axis = np.linspace(-GRID_EXTENT, GRID_EXTENT, size, dtype=np.float32)
+    return np.meshgrid(axis, axis)
+
+
+def flow_patch(kind, center=(0.0, 0.0), strength=1.0, core=1.5, background=(0.0, 0.0),
+               noise=0.0, rng=None, size=PATCH_SIZE):
+    """
+    One (2, size, size) patch around a critical point at `center`.
+
+    kind is 0/"CCW", 1/"CW" (Lamb-Oseen style vortices with core radius
+    `core`) or 2/"SADDLE" (a linear saddle damped outside the core), plus an
+    optional uniform background flow and Gaussian noise.
+    """
+    kind = {"CCW": 0, "CW": 1, "SADDLE": 2}.get(kind, kind)
+    x, y = _grid(size)
+    dx, dy = x - center[0], y - center[1]
+    r2 = dx * dx + dy * dy
+
+    if kind in (0, 1):
+        # Tangential velocity of a Lamb-Oseen vortex, written as (-dy, dx) / r2
+        swirl = strength * (1.0 - np.exp(-r2 / core ** 2)) / np.maximum(r2, 1e-6) * core
+        sign = 1.0 if kind == 0 else -1.0
+        U, V = -sign * dy * swirl, sign * dx * swirl
+    elif kind == 2:
+        damping = strength * np.exp(-r2 / (4.0 * core ** 2))
+        U, V = dx * damping, -dy * damping
+    else:
+        raise ValueError(f"Unknown flow kind {kind!r}")
+
+    uv = np.stack([U + background[0], V + background[1]]).astype(np.float32)
+    if noise:
+        rng = rng if rng is not None else np.random.default_rng()
+        uv += rng.normal(0.0, noise, uv.shape).astype(np.float32)
+    return uv
+
+
+def flow_batch(n, seed=0, max_offset=1.5, noise=0.02, size=PATCH_SIZE):
+    """
+    n random patches with balanced classes.
+
+    Returns (uv, labels) with uv shaped (n, 2, size, size) float32 and labels
+    an (n,) int8 array of class indices.
+    """
+    rng = np.random.default_rng(seed)
+    labels = (np.arange(n) % 3).astype(np.int8)
+    rng.shuffle(labels)
+    uv = np.empty((n, 2, size, size), dtype=np.float32)
+    for i, kind in enumerate(labels):
+        uv[i] = flow_patch(
+            int(kind),
+            center=rng.uniform(-max_offset, max_offset, 2),
+            strength=rng.uniform(0.5, 2.0),
+            core=rng.uniform(0.8, 2.5),
+            background=rng.normal(0.0, 0.1, 2),
+            noise=noise,
+            rng=rng,
+            size=size,
+        )
+    return uv, labels
@@ -0,0 +1,72 @@
+"""Shared fixtures: synthetic flow patches and small, seeded networks.
+
+Nothing here needs the Drive data or trained weights; the networks are either
+a tiny conv net or the real architectures with random weights.
+"""
+
+import os
+import sys
+
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+
+from flow_data import magnitude_batch
+from synthetic_flows import flow_batch
+
+
+def make_tiny_model(seed=0):
+    """A small conv classifier with the patches' (64, 64, 1) input and 3 logits."""
+    init = keras.initializers.GlorotUniform(seed=seed)
+    inputs = keras.Input(shape=(64, 64, 1))
+    x = layers.Conv2D(8, 3, padding="same", activation="relu", kernel_initializer=init)(inputs)
+    x = layers.MaxPooling2D(2)(x)
+    x = layers.Conv2D(16, 3, padding="same", activation="relu", kernel_initializer=init)(x)
+    x = layers.MaxPooling2D(2)(x)
+    x = layers.Flatten()(x)
+    outputs = layers.Dense(3, kernel_initializer=init)(x)
+    return keras.Model(inputs, outputs)
+
+
+@pytest.fixture(scope="session")
+def tiny_model():
+    return make_tiny_model(0)
+
+
+@pytest.fixture(scope="session")
+def other_tiny_model():
+    return make_tiny_model(1)
+
+
+@pytest.fixture(scope="session")
+def cnn():
+    from models import get_model
+    return get_model("cnn", weights=None, logits=True)
+
+
+@pytest.fixture(scope="session")
+def flows():
+    """(uv, labels) for 12 balanced synthetic patches."""
+    return flow_batch(12, seed=0)
+
+
+@pytest.fixture(scope="session")
+def patches(flows):
+    return magnitude_batch(flows[0])
+
+
+@pytest.fixture
+def patch_dir(tmp_path, flows):
+    """centered_{CCW,CW,SAD}/<i>.npy files like the __FLOW_PATCHES folders; returns the glob."""
+    uv, labels = flows
+    names = {0: "centered_CCW", 1: "centered_CW", 2: "centered_SAD"}
+    for i, (patch, label) in enumerate(zip(uv, labels)):
+        directory = tmp_path / "patches" / names[int(label)]
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / f"{i:03d}.npy", patch)
+    return str(tmp_path / "patches" / "centered_*" / "*.npy")
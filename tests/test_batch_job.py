@@ -0,0 +1,59 @@
+import json
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from batch_job import ResultStore, plan_chunks, plan_items, run_job
+from flow_shards import pack_flow_patches
+
+
+def test_chunks_cover_every_row_once(patch_dir, tmp_path):
+    shards = pack_flow_patches(patch_dir, str(tmp_path / "shards"))
+    sources, paths = plan_items([patch_dir, shards.shard_dir])
+    assert len(paths) == 24
+    chunks = plan_chunks(sources, 5)
+    rows = np.concatenate([np.arange(start, start + hi - lo) for _, _, _, lo, hi, start in chunks])
+    np.testing.assert_array_equal(rows, np.arange(24))
+
+
+def test_store_reports_finished_chunks(tmp_path):
+    out = str(tmp_path / "results.h5")
+    store = ResultStore(out, ["a", "b", "c"], ["cnn"], False)
+    probabilities = np.full((2, 3), 1 / 3, np.float32)
+    store.write(0, 0, np.array([0, 1], np.int8), np.array([True, True]),
+                {"cnn": {"probabilities": probabilities, "classes": np.zeros(2, np.int8), "heatmaps": None}})
+    store.close()
+
+    assert ResultStore(out, ["a", "b", "c"], ["cnn"], False).done == {0}
+    with pytest.raises(ValueError):
+        ResultStore(out, ["a", "b", "x"], ["cnn"], False)
+
+
+def test_interrupted_job_resumes(patch_dir, tmp_path):
+    bad = os.path.join(os.path.dirname(os.path.dirname(patch_dir)), "centered_CW", "bad.npy")
+    np.save(bad, np.zeros((3, 3), np.float32))
+    out = str(tmp_path / "results.h5")
+    kwargs = dict(models=["cnn"], out=out, chunk_size=5, batch_size=4, heatmaps=False, untrained=True)
+
+    assert run_job([patch_dir], **kwargs) == 3
+    with h5py.File(out, "r") as h5:
+        expected = h5["cnn/probabilities"][:]
+        valid = h5["valid"][:]
+        paths = [p.decode() for p in h5["paths"][:]]
+    assert valid.sum() == 12 and not valid[paths.index(bad)]
+    assert run_job([patch_dir], **kwargs) == 0
+
+    # Lose the last two chunks, as if the run had been killed after the first
+    manifest = out + ".manifest"
+    with open(manifest) as fh:
+        first = [line for line in fh if json.loads(line)["chunk"] == 0]
+    with open(manifest, "w") as fh:
+        fh.writelines(first)
+    with h5py.File(out, "r+") as h5:
+        h5["cnn/probabilities"][5:] = 0
+
+    assert run_job([patch_dir], **kwargs) == 2
+    with h5py.File(out, "r") as h5:
+        np.testing.assert_allclose(h5["cnn/probabilities"][:], expected, atol=1e-6)
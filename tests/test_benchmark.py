@@ -0,0 +1,53 @@
+import json
+import sys
+
+import numpy as np
+import pytest
+
+import benchmark
+
+
+def test_split_keeps_the_partial_batch():
+    batches = benchmark._split(np.arange(10), 4)
+    assert [len(b) for b in batches] == [4, 4, 2]
+    assert [len(b) for b in benchmark._split(np.arange(3), 8)] == [3]
+
+
+def test_fewer_patches_than_the_batch_size():
+    results = benchmark.run_benchmarks([], [8], None, num_patches=5, stages=("load", "magnitude"))
+    assert [r["stage"] for r in results] == ["load", "magnitude"]
+    for r in results:
+        assert r["patches"] == 5
+        assert np.isfinite(r["patches_per_s"]) and r["rss_delta_mb"] >= 0
+
+
+def test_bad_configuration_is_rejected():
+    with pytest.raises(ValueError):
+        benchmark.run_benchmarks([], [0], None, num_patches=5, stages=("magnitude",))
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs /proc/self/clear_refs")
+def test_peak_rss_is_per_window():
+    block = np.ones(64 * 2**20 // 8)
+    before = benchmark.peak_rss_mb()
+    del block
+    benchmark.reset_peak_rss()
+    assert benchmark.peak_rss_mb() < before - 32
+
+
+def test_cli_runs_each_thread_count_in_its_own_process(tmp_path):
+    out = tmp_path / "bench.json"
+    assert benchmark.main(["--models", "cnn", "--batch-sizes", "4", "--threads", "1", "2",
+                           "--stages", "magnitude", "--patches", "8", "--out", str(out)]) == 0
+    results = json.loads(out.read_text())["results"]
+    assert [(r["stage"], r["threads"]) for r in results] == [("magnitude", 1), ("magnitude", 2)]
+
+
+def test_thread_count_cannot_change_once_tensorflow_runs():
+    import tensorflow as tf
+
+    tf.constant(1.0) + 1.0
+    if tf.config.threading.get_intra_op_parallelism_threads() == 3:
+        pytest.skip("this process already runs with 3 threads")
+    with pytest.raises(RuntimeError):
+        benchmark.run_benchmarks([], [4], 3, num_patches=4, stages=("magnitude",))
@@ -0,0 +1,72 @@
+import numpy as np
+
+from cascade import ModelCascade, evaluate_cascade
+from gradcam_engine import GradCamEngine
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def test_escalation_and_decisions(tiny_model, other_tiny_model, patches):
+    cascade = ModelCascade({"a": tiny_model, "b": other_tiny_model}, threshold=0.9, batch_size=4)
+    result = cascade.classify(patches)
+
+    first = _softmax(tiny_model.predict(patches, verbose=0))
+    second = _softmax(other_tiny_model.predict(patches, verbose=0))
+    escalated = first.max(axis=1) < 0.9
+    np.testing.assert_array_equal(result.escalated, escalated)
+    expected = np.where(escalated[:, None], (first + second) / 2, first)
+    np.testing.assert_allclose(result.probabilities, expected, atol=1e-5)
+    np.testing.assert_array_equal(result.classes, expected.argmax(axis=1))
+
+    index, explanation = result.explanations["a"]
+    assert len(index) == len(patches)
+    np.testing.assert_allclose(explanation.heatmaps, GradCamEngine(tiny_model, batch_size=4).compute(patches),
+                               atol=1e-5)
+    if escalated.any():
+        index, explanation = result.explanations["b"]
+        np.testing.assert_array_equal(index, np.flatnonzero(escalated))
+        assert explanation.heatmaps.shape[0] == escalated.sum()
+    assert cascade.stage_counts == {"a": len(patches), "b": int(escalated.sum())}
+
+
+def test_predict_only_cascade_builds_no_gradcam(tiny_model, other_tiny_model, patches):
+    cascade = ModelCascade({"a": tiny_model, "b": other_tiny_model}, threshold=1.0, gradcam=False, batch_size=4)
+    assert cascade._first_engine is None and cascade._rest_comparison is None
+    result = cascade.classify(patches)
+    assert result.escalated.all()
+    assert all(explanation.heatmaps is None for _, explanation in result.explanations.values())
+    np.testing.assert_allclose(result.probabilities, cascade.full_ensemble(patches), atol=1e-6)
+
+
+def test_empty_input(tiny_model, other_tiny_model):
+    cascade = ModelCascade({"a": tiny_model, "b": other_tiny_model}, batch_size=4)
+    result = cascade.classify(np.zeros((0, 64, 64, 1), np.float32))
+    assert result.classes.shape == (0,) and result.probabilities.shape == (0, 3)
+    assert result.escalated.shape == (0,) and result.explanations == {}
+    assert cascade.patches == 0
+
+
+def test_evaluate_cascade(tiny_model, other_tiny_model, patches, flows):
+    cascade = ModelCascade({"a": tiny_model, "b": other_tiny_model}, threshold=1.0, batch_size=4)
+    labels = flows[1]
+    stats = evaluate_cascade(cascade, [(patches[:6], labels[:6]), (patches[6:], labels[6:])])
+    assert stats["patches"] == len(patches)
+    # Everything escalates, so the cascade is the full ensemble
+    assert stats["escalated"] == 1.0 and stats["agreement"] == 1.0 and stats["accuracy_change"] == 0.0
+
+
+def test_gradcam_gates_on_the_tape_predictions(tiny_model, other_tiny_model, patches, monkeypatch):
+    cascade = ModelCascade({"a": tiny_model, "b": other_tiny_model}, threshold=0.9, batch_size=4)
+    expected = cascade.classify(patches, gradcam=False)
+
+    def second_pass(x):
+        raise AssertionError("the first model ran a separate predict pass")
+
+    monkeypatch.setattr(cascade._runners["a"], "predict", second_pass)
+    result = cascade.classify(patches)
+    np.testing.assert_array_equal(result.escalated, expected.escalated)
+    np.testing.assert_allclose(result.probabilities, expected.probabilities, atol=1e-5)
+    assert result.explanations["a"][1].heatmaps.shape == (len(patches), 32, 32)
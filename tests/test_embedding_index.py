@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from embedding_index import EmbeddingExtractor, EmbeddingIndex, index_corpus
+
+
+def _brute_force(matrix, queries, k, exclude=None):
+    matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ matrix.astype(np.float16).astype(np.float32).T
+    if exclude is not None:
+        scores[np.arange(len(queries)), exclude] = -np.inf
+    rows = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(scores, rows, axis=1), rows
+
+
+def test_query_matches_brute_force_across_blocks(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(250, 16)).astype(np.float32)
+    index = EmbeddingIndex.create(str(tmp_path / "idx"), 16, capacity=8, block_size=64)
+    for lo in range(0, 250, 70):
+        index.add(vectors[lo:lo + 70], [f"p{i}" for i in range(lo, min(lo + 70, 250))])
+
+    queries = vectors[:5] + 0.1 * rng.normal(size=(5, 16)).astype(np.float32)
+    exclude = np.arange(5)
+    scores, rows = index.query(queries, k=7, exclude=exclude)
+    expected_scores, expected_rows = _brute_force(vectors, queries, 7, exclude)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-5)
+    np.testing.assert_array_equal(rows, expected_rows)
+    assert not np.isin(exclude, rows).any()
+
+
+def test_reopen_keeps_flushed_rows(tmp_path):
+    directory = str(tmp_path / "idx")
+    vectors = np.eye(4, dtype=np.float32)
+    index = EmbeddingIndex.create(directory, 4, capacity=2)
+    index.add(vectors, ["a", "b", "c", "d"])
+    index.add(vectors[:1], ["a"])                   # already indexed
+    index.flush()
+
+    reopened = EmbeddingIndex(directory)
+    assert len(reopened) == 4
+    paths, scores = reopened.neighbors(vectors[2], k=1)
+    assert paths == [["c"]] and scores[0, 0] == 1.0
+
+
+def test_empty_index_query(tmp_path):
+    index = EmbeddingIndex.create(str(tmp_path / "idx"), 4)
+    scores, rows = index.query(np.ones((2, 4), np.float32), k=5)
+    assert scores.shape == rows.shape == (2, 0)
+
+
+def test_index_corpus_skips_indexed_patches(tiny_model, patch_dir, tmp_path):
+    extractor = EmbeddingExtractor(tiny_model, batch_size=4)
+    index = EmbeddingIndex.create(str(tmp_path / "idx"), extractor.dim)
+    index_corpus(extractor, patch_dir, index, batch_size=5)
+    assert len(index) == 12
+    vectors = np.asarray(index.vectors, np.float32)
+    index_corpus(extractor, patch_dir, index, batch_size=5)
+    assert len(index) == 12
+    np.testing.assert_array_equal(np.asarray(index.vectors, np.float32), vectors)
+
+
+def _clustered(n, dim, clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return (centers[rng.integers(clusters, size=n)] + 0.3 * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def test_resident_and_streamed_queries_agree(tmp_path):
+    vectors = _clustered(300, 16, 5)
+    index = EmbeddingIndex.create(str(tmp_path / "idx"), 16, block_size=64, resident=False)
+    index.add(vectors[:200], [f"p{i}" for i in range(200)])
+    streamed = index.query(vectors[:4], k=9, exclude=np.arange(4))
+
+    resident = EmbeddingIndex(str(tmp_path / "idx"), resident=True)
+    resident.add(vectors[:200], [f"p{i}" for i in range(200)])     # already indexed
+    expected = resident.query(vectors[:4], k=9, exclude=np.arange(4))
+    np.testing.assert_allclose(streamed[0], expected[0], atol=1e-5)
+    np.testing.assert_array_equal(streamed[1], expected[1])
+    # Rows added after the resident copy was loaded are searched too
+    resident.add(vectors[200:], [f"p{i}" for i in range(200, 300)])
+    _, rows = resident.query(vectors[250], k=1)
+    assert rows[0, 0] == 250
+
+
+def test_inverted_lists(tmp_path):
+    vectors = _clustered(600, 16, 8)
+    directory = str(tmp_path / "idx")
+    index = EmbeddingIndex.create(directory, 16, block_size=128)
+    index.add(vectors[:500], [f"p{i}" for i in range(500)])
+    with pytest.raises(ValueError):
+        index.query(vectors[:1], k=5, nprobe=2)
+    index.build_lists(lists=8)
+    index.add(vectors[500:], [f"p{i}" for i in range(500, 600)])   # assigned on add
+    index.flush()
+
+    queries = vectors[::50] + 0.05
+    exact_scores, exact_rows = index.query(queries, k=10)
+    # Probing every list is the exact search
+    scores, rows = index.query(queries, k=10, nprobe=8)
+    np.testing.assert_allclose(scores, exact_scores, atol=1e-5)
+    np.testing.assert_array_equal(np.sort(rows, axis=1), np.sort(exact_rows, axis=1))
+
+    reopened = EmbeddingIndex(directory)
+    scores, rows = reopened.query(queries, k=10, nprobe=2, exclude=np.arange(0, 600, 50))
+    assert rows.shape == (len(queries), 10)
+    assert not (rows == np.arange(0, 600, 50)[:, None]).any()
+    recall = np.mean([len(set(a) & set(b)) / 10 for a, b in zip(rows, exact_rows)])
+    assert recall > 0.8
@@ -0,0 +1,49 @@
+import numpy as np
+
+from flow_data import FlowPatchLoader, expand_paths, magnitude_batch, magnitude_patch
+
+
+def test_magnitude_layout_matches_get_data_test(flows):
+    uv = flows[0][0]
+    mag = np.sqrt(uv[0] ** 2 + uv[1] ** 2)
+    expected = np.swapaxes(np.stack([mag]), 0, 2)
+    np.testing.assert_allclose(magnitude_patch(uv), expected)
+    np.testing.assert_allclose(magnitude_batch(flows[0])[0], expected)
+
+
+def test_loader_keeps_path_order_and_reports_bad_files(patch_dir, tmp_path):
+    paths = expand_paths(patch_dir)
+    bad = tmp_path / "patches" / "centered_CW" / "bad.npy"
+    np.save(bad, np.zeros((3, 5)))
+    loader = FlowPatchLoader(paths[:5] + [str(bad)] + paths[5:], batch_size=4)
+
+    seen, batches = [], []
+    for patches, batch_paths in loader:
+        seen.extend(batch_paths)
+        batches.append(patches)
+    assert seen == paths
+    np.testing.assert_allclose(np.concatenate(batches)[0], magnitude_patch(np.load(paths[0])))
+    assert list(loader.bad_files) == [str(bad)]
+
+
+def test_bad_files_are_recorded_again_on_every_pass(patch_dir, tmp_path):
+    bad = tmp_path / "bad.npy"
+    np.save(bad, np.zeros(7))
+    loader = FlowPatchLoader([str(bad)] + expand_paths(patch_dir)[:2], batch_size=2)
+    for _ in range(2):
+        loader.bad_files.clear()
+        assert sum(len(p) for _, p in loader) == 2
+        assert str(bad) in loader.bad_files
+
+
+def test_loader_with_uv_yields_the_source_arrays(patch_dir, tmp_path):
+    paths = expand_paths(patch_dir)
+    bad = tmp_path / "bad.npy"
+    np.save(bad, np.zeros(7))
+    loader = FlowPatchLoader(paths[:3] + [str(bad)], batch_size=2, with_uv=True)
+    batches = list(loader)
+    uv = np.concatenate([b[0] for b in batches])
+    assert [p for b in batches for p in b[2]] == paths[:3]
+    np.testing.assert_allclose(uv, np.stack([np.load(p) for p in paths[:3]]))
+    np.testing.assert_allclose(np.concatenate([b[1] for b in batches]), magnitude_batch(uv))
+    assert list(loader.bad_files) == [str(bad)]
@@ -0,0 +1,46 @@
+import numpy as np
+
+from flow_physics import PhysicsFilter, agreement, box_filter, filter_batches, vorticity_field
+from synthetic_flows import flow_batch, flow_patch
+
+
+def test_box_filter_matches_a_padded_window_mean():
+    x = np.random.default_rng(0).normal(size=(2, 9, 11)).astype(np.float32)
+    for size in (2, 3, 4):
+        before = size // 2
+        padded = np.pad(x, [(0, 0), (before, size - 1 - before), (before, size - 1 - before)], mode="edge")
+        expected = np.stack([[[padded[b, i:i + size, j:j + size].mean() for j in range(11)] for i in range(9)]
+                             for b in range(2)])
+        np.testing.assert_allclose(box_filter(x, size, axes=(1, 2)), expected, atol=1e-6)
+
+
+def test_labels_of_synthetic_patches():
+    uv, labels = flow_batch(300, seed=3)
+    keep, heuristic, _ = PhysicsFilter().apply(uv)
+    assert keep.mean() >= 0.98
+    for c in range(3):
+        assert (heuristic[labels == c] == c).mean() >= 0.95
+    assert agreement(labels, heuristic) >= 0.95
+
+
+def test_noise_and_uniform_flow_are_dropped():
+    rng = np.random.default_rng(0)
+    noise = rng.normal(size=(50, 2, 64, 64)).astype(np.float32)
+    uniform = np.broadcast_to(np.array([1.0, 0.5], np.float32)[None, :, None, None], (5, 2, 64, 64))
+    assert not PhysicsFilter().apply(noise)[0].any()
+    assert not PhysicsFilter().apply(uniform + rng.normal(0, 0.01, uniform.shape))[0].any()
+
+
+def test_vorticity_sign():
+    ccw = flow_patch("CCW")[None]
+    cw = flow_patch("CW")[None]
+    assert vorticity_field(ccw)[0, 32, 32] > 0 > vorticity_field(cw)[0, 32, 32]
+
+
+def test_filter_batches_drops_empty_batches():
+    uv, labels = flow_batch(6, seed=0)
+    noise = np.random.default_rng(0).normal(size=(4, 2, 64, 64)).astype(np.float32)
+    batches = [(noise, noise[:, :1], ["n"] * 4, np.full(4, -1)),
+               (uv, uv[:, :1], [f"p{i}" for i in range(6)], labels)]
+    out = list(filter_batches(batches))
+    assert len(out) == 1 and len(out[0][1]) == 6
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from flow_data import magnitude_batch
+from flow_scanner import FieldScanner
+from gradcam_engine import GradCamEngine
+from heatmap_overlay import resize_heatmaps
+
+
+@pytest.fixture(scope="module")
+def field():
+    return np.random.default_rng(0).normal(size=(2, 96, 128)).astype(np.float32)
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def test_default_scan_matches_the_cut_out_patches(tiny_model, field):
+    result = FieldScanner(tiny_model, stride=32, batch_size=4).scan(field)
+    rows, cols = result.probabilities.shape[:2]
+    assert (rows, cols) == (2, 3)
+
+    cuts = np.stack([field[:, i * 32:i * 32 + 64, j * 32:j * 32 + 64] for i, j in np.ndindex(rows, cols)])
+    heatmaps, preds, _ = GradCamEngine(tiny_model, batch_size=4).compute(magnitude_batch(cuts),
+                                                                          return_predictions=True)
+    np.testing.assert_allclose(result.probabilities.reshape(-1, 3), _softmax(preds), atol=1e-5)
+
+    # The first window is the only one covering the field's top-left 32 x 32 corner
+    first = resize_heatmaps(heatmaps[:1], (64, 64))[0].T
+    np.testing.assert_allclose(result.heatmap[:32, :32], first[:32, :32], atol=1e-4)
+    assert result.coverage.max() == 4 and result.coverage[:32, :32].min() == 1
+
+
+def test_shared_trunk_is_opt_in(tiny_model, field):
+    assert not FieldScanner(tiny_model, stride=32, batch_size=4).shared_trunk
+    result = FieldScanner(tiny_model, stride=32, batch_size=4, shared_trunk=True).scan(field)
+    assert result.probabilities.shape == (2, 3, 3)
+    np.testing.assert_allclose(result.probabilities.sum(axis=-1), 1.0, atol=1e-5)
+    with pytest.raises(ValueError):
+        FieldScanner(tiny_model, stride=3, shared_trunk=True)
+
+
+def test_field_smaller_than_a_window(tiny_model):
+    with pytest.raises(ValueError):
+        FieldScanner(tiny_model, batch_size=4).scan(np.zeros((2, 32, 128), np.float32))
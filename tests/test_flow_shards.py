@@ -0,0 +1,42 @@
+import numpy as np
+
+from flow_data import expand_paths, magnitude_batch
+from flow_shards import FlowShards, label_from_path, pack_flow_patches
+
+
+def test_label_from_path():
+    assert label_from_path("/data/centered_CCW/1.npy") == 0
+    assert label_from_path("/data/centered_CW/1.npy") == 1
+    assert label_from_path("/data/centered_SAD/1.npy") == 2
+    assert label_from_path("/data/unsorted/1.npy") == -1
+
+
+def test_pack_and_read_back_across_shards(patch_dir, tmp_path, flows):
+    paths = expand_paths(patch_dir)
+    bad = tmp_path / "patches" / "centered_CW" / "zz_bad.npy"
+    np.save(bad, np.zeros((2, 8, 8), np.float32))
+    shards = pack_flow_patches(paths + [str(bad)], tmp_path / "shards", shard_size=5, num_workers=2)
+
+    assert len(shards) == len(paths)
+    assert list(shards.skipped) == [str(bad)]
+    assert len(shards.shards) == 3
+    uv = np.stack([np.load(p) for p in paths])
+
+    # A slice that crosses shard boundaries
+    np.testing.assert_array_equal(shards.uv(3, 11), uv[3:11])
+    np.testing.assert_allclose(shards.magnitude(3, 11), magnitude_batch(uv[3:11]))
+    assert list(shards.labels(0, len(paths))) == [label_from_path(p) for p in paths]
+    assert shards.offset_of(paths[7]) == 7 and paths[7] in shards
+
+    seen = []
+    for batch_uv, mag, batch_paths, labels in shards.iter_batches(4, with_uv=True):
+        assert len(batch_uv) == len(mag) == len(batch_paths) == len(labels) <= 4
+        seen.extend(batch_paths)
+    assert seen == paths
+
+
+def test_magnitude_computed_when_not_stored(patch_dir, tmp_path):
+    paths = expand_paths(patch_dir)
+    pack_flow_patches(paths, tmp_path / "shards", store_magnitude=False)
+    shards = FlowShards(str(tmp_path / "shards"))
+    np.testing.assert_allclose(shards.magnitude(0, 4), magnitude_batch(shards.uv(0, 4)))
@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+
+from gradcam_engine import GradCamEngine
+
+
+@pytest.mark.parametrize("method", ["gradcam", "gradcam++"])
+def test_all_classes_from_one_tape(tiny_model, patches, method):
+    engine = GradCamEngine(tiny_model, batch_size=4)
+    maps, preds = engine.compute_all_classes(patches[:6], method=method, return_predictions=True)
+    assert maps.shape[:2] == (6, 3)
+    assert ((maps >= 0) & (maps <= 1)).all()
+    if method == "gradcam":
+        for k in range(3):
+            np.testing.assert_allclose(maps[:, k], engine.compute(patches[:6], pred_index=k), atol=1e-5)
+    np.testing.assert_allclose(preds, tiny_model.predict(patches[:6], verbose=0), atol=1e-5)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from gradcam_engine import GradCamComparison, GradCamEngine
+
+
+def test_comparison_matches_separate_engines(tiny_model, other_tiny_model, patches):
+    models = {"a": tiny_model, "b": other_tiny_model}
+    results = GradCamComparison(models, batch_size=5).compute(patches)
+    for name, model in models.items():
+        heatmaps, preds, classes = GradCamEngine(model, batch_size=5).compute(patches, return_predictions=True)
+        np.testing.assert_allclose(results[name].heatmaps, heatmaps, atol=1e-5)
+        np.testing.assert_allclose(results[name].predictions, preds, atol=1e-5)
+        np.testing.assert_array_equal(results[name].classes, classes)
+        np.testing.assert_array_equal(classes, preds.argmax(axis=1))
+
+
+def test_comparison_rejects_mismatched_inputs(tiny_model):
+    from tensorflow import keras
+    other = keras.Sequential([keras.Input((32, 32, 1)), keras.layers.Conv2D(2, 3), keras.layers.Flatten(),
+                              keras.layers.Dense(3)])
+    with pytest.raises(ValueError):
+        GradCamComparison({"a": tiny_model, "b": other})
+
+
+def test_comparison_of_an_empty_batch(tiny_model, other_tiny_model):
+    results = GradCamComparison({"a": tiny_model, "b": other_tiny_model}, batch_size=4).compute(
+        np.zeros((0, 64, 64, 1), np.float32))
+    for explanation in results.values():
+        assert explanation.predictions.shape == (0, 3)
+        assert explanation.classes.shape == (0,)
+        assert explanation.heatmaps.shape == (0, 32, 32)
@@ -0,0 +1,63 @@
+import numpy as np
+import tensorflow as tf
+
+import grad_cam
+from gradcam_engine import GradCamEngine, get_gradcam_engine, get_last_conv_layer
+
+
+def reference_heatmap(model, patch, layer_name, pred_index=None):
+    # The original per-patch make_gradcam_heatmap, eager tape and all
+    grad_model = tf.keras.models.Model([model.inputs], [model.get_layer(layer_name).output, model.output])
+    with tf.GradientTape() as tape:
+        conv_output, preds = grad_model(patch[np.newaxis])
+        if pred_index is None:
+            pred_index = tf.argmax(preds[0])
+        class_channel = preds[:, pred_index]
+    grads = tape.gradient(class_channel, conv_output)
+    pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
+    heatmap = conv_output[0] @ pooled_grads[..., tf.newaxis]
+    heatmap = tf.squeeze(heatmap)
+    heatmap = tf.maximum(heatmap, 0) / tf.math.reduce_max(heatmap)
+    return heatmap.numpy()
+
+
+def test_engine_matches_original_gradcam(tiny_model, patches):
+    layer = get_last_conv_layer(tiny_model)
+    engine = GradCamEngine(tiny_model, layer, batch_size=5)
+    heatmaps = engine.compute(patches)
+    assert heatmaps.shape == (len(patches), 32, 32)
+    for patch, heatmap in zip(patches, heatmaps):
+        np.testing.assert_allclose(heatmap, reference_heatmap(tiny_model, patch, layer), atol=1e-5)
+
+
+def test_engine_explains_requested_class(tiny_model, patches):
+    layer = get_last_conv_layer(tiny_model)
+    engine = GradCamEngine(tiny_model, layer, batch_size=4)
+    heatmaps, preds, classes = engine.compute(patches[:3], pred_index=2, return_predictions=True)
+    assert (classes == 2).all()
+    np.testing.assert_allclose(preds, tiny_model.predict(patches[:3], verbose=0), atol=1e-5)
+    np.testing.assert_allclose(heatmaps[0], reference_heatmap(tiny_model, patches[0], layer, 2), atol=1e-5)
+
+
+def test_make_gradcam_heatmap_accepts_a_single_patch(tiny_model, patches):
+    layer = get_last_conv_layer(tiny_model)
+    heatmap = grad_cam.make_gradcam_heatmap(patches[0], "cnn", tiny_model, None, None, layer, None, None)
+    np.testing.assert_allclose(heatmap, reference_heatmap(tiny_model, patches[0], layer), atol=1e-5)
+    # One unbatched patch is a batch of one, not of 64 rows
+    assert get_gradcam_engine(tiny_model, layer, batch_size=1).batch_size == 1
+
+
+def test_empty_input_gives_empty_results(tiny_model):
+    from gradcam_engine import MultiLayerGradCam
+
+    empty = np.zeros((0, 64, 64, 1), np.float32)
+    engine = GradCamEngine(tiny_model, batch_size=4)
+    heatmaps, preds, classes = engine.compute(empty, return_predictions=True)
+    assert heatmaps.shape == (0, 32, 32) and preds.shape == (0, 3) and classes.shape == (0,)
+    maps, preds = engine.compute_all_classes(empty, return_predictions=True)
+    assert maps.shape == (0, 3, 32, 32) and preds.shape == (0, 3)
+
+    sweep = MultiLayerGradCam(tiny_model, batch_size=4)
+    heatmaps, preds, classes = sweep.compute(empty, return_predictions=True)
+    assert heatmaps.shape == (0, len(sweep.layer_names), 64, 64) and preds.shape == (0, 3)
+    assert MultiLayerGradCam(tiny_model, batch_size=4, fuse="max").compute(empty).shape == (0, 64, 64)
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from gradcam_metrics import (CurveScorer, GradCamEvaluator, MetricTable, _softmax, auc, iou, pearson,
+                             top_mask)
+
+
+def _full_curves(model, patches, heatmaps, classes, steps, baseline):
+    # Every masked copy at once, in one predict, as the scorer used to do it
+    n, pixels = len(patches), patches.shape[1] * patches.shape[2]
+    order = np.argsort(-heatmaps.reshape(n, -1), axis=1, kind="stable")
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(pixels)[np.newaxis], axis=1)
+    rank = rank.reshape(patches.shape[:3] + (1,))
+    cutoffs = np.rint(np.linspace(0, pixels, steps + 1)).astype(np.int64)
+    top = rank[np.newaxis] < cutoffs[:, np.newaxis, np.newaxis, np.newaxis, np.newaxis]
+    deleted = np.where(top, baseline[np.newaxis], patches[np.newaxis])
+    inserted = np.where(top, patches[np.newaxis], baseline[np.newaxis])
+    masked = np.stack([deleted, inserted]).reshape((-1,) + patches.shape[1:])
+    probabilities = _softmax(model.predict(masked, verbose=0)).reshape(2, steps + 1, n, -1)
+    chosen = probabilities[:, :, np.arange(n), classes]
+    return chosen[0].T, chosen[1].T
+
+
+@pytest.fixture(scope="module")
+def explained(tiny_model, patches):
+    rng = np.random.default_rng(0)
+    heatmaps = rng.random(patches.shape[:3]).astype(np.float32)
+    classes = tiny_model.predict(patches, verbose=0).argmax(axis=1)
+    return heatmaps, classes
+
+
+@pytest.mark.parametrize("baseline", ["mean", "zero", "blur"])
+def test_chunked_curves_match_the_full_computation(tiny_model, patches, explained, baseline):
+    heatmaps, classes = explained
+    # 2 * 5 * 12 = 120 masked copies in chunks of 7, the last one partial
+    scorer = CurveScorer(tiny_model, steps=4, baseline=baseline, batch_size=7)
+    deletion, insertion = scorer.curves(patches, heatmaps, classes)
+    expected = _full_curves(tiny_model, patches, heatmaps, classes, 4, scorer._baseline(patches))
+    assert deletion.shape == insertion.shape == (len(patches), 5)
+    np.testing.assert_allclose(deletion, expected[0], atol=1e-5)
+    np.testing.assert_allclose(insertion, expected[1], atol=1e-5)
+
+
+def test_curve_endpoints(tiny_model, patches, explained):
+    heatmaps, classes = explained
+    scorer = CurveScorer(tiny_model, steps=3, batch_size=8)
+    deletion, insertion = scorer.curves(patches, heatmaps, classes)
+    rows = np.arange(len(patches))
+    original = _softmax(tiny_model.predict(patches, verbose=0))[rows, classes]
+    blank = _softmax(tiny_model.predict(np.ascontiguousarray(scorer._baseline(patches)), verbose=0))[rows, classes]
+    # Nothing deleted yet / everything restored is the original patch
+    np.testing.assert_allclose(deletion[:, 0], original, atol=1e-5)
+    np.testing.assert_allclose(insertion[:, -1], original, atol=1e-5)
+    # Everything deleted / nothing restored is the baseline
+    np.testing.assert_allclose(deletion[:, -1], blank, atol=1e-5)
+    np.testing.assert_allclose(insertion[:, 0], blank, atol=1e-5)
+
+
+def test_empty_batch_gives_empty_curves(tiny_model):
+    deletion, insertion = CurveScorer(tiny_model, steps=2, batch_size=4).curves(
+        np.zeros((0, 64, 64, 1), np.float32), np.zeros((0, 64, 64), np.float32), np.zeros(0, np.int64))
+    assert deletion.shape == insertion.shape == (0, 3)
+
+
+def test_unknown_baseline_is_rejected(tiny_model):
+    with pytest.raises(ValueError):
+        CurveScorer(tiny_model, baseline="noise", batch_size=4)
+
+
+def test_auc_of_constant_and_linear_curves():
+    np.testing.assert_allclose(auc(np.ones((2, 5))), 1.0)
+    np.testing.assert_allclose(auc(np.linspace(0, 1, 11)[np.newaxis]), 0.5)
+
+
+def test_pearson_and_iou():
+    rng = np.random.default_rng(1)
+    a = rng.random((3, 8, 8))
+    np.testing.assert_allclose(pearson(a, 2 * a + 1), 1.0)
+    np.testing.assert_allclose(pearson(a, -a), -1.0)
+    assert (pearson(a, np.ones_like(a)) == 0).all()
+    mask = top_mask(a, 0.25)
+    assert (mask.reshape(3, -1).sum(axis=1) == 16).all()
+    np.testing.assert_allclose(iou(mask, mask), 1.0)
+    assert (iou(mask, ~mask) == 0).all()
+
+
+def test_evaluator_fills_the_table(tiny_model, other_tiny_model, flows, patches):
+    uv, labels = flows
+    evaluator = GradCamEvaluator({"a": tiny_model, "b": other_tiny_model}, steps=2, batch_size=8)
+    table = evaluator.evaluate([(uv, patches, None, labels)])
+    assert isinstance(table, MetricTable)
+    rows = {(row["model"], row["class"]): row for row in table.rows()}
+    for key in ("a", "b", "a~b"):
+        assert rows[(key, "all")]["count"] == len(patches)
+    for metric in ("core_energy", "deletion_auc", "insertion_auc"):
+        assert 0.0 <= rows[("a", "all")][metric] <= 1.0
+
+
+def test_iter_uv_batches_reads_globs_and_skips_bad_files(patch_dir, tmp_path):
+    from flow_data import expand_paths, magnitude_batch
+    from gradcam_metrics import iter_uv_batches
+
+    bad = tmp_path / "patches" / "centered_CW" / "bad.npy"
+    np.save(bad, np.zeros(7))
+    batches = list(iter_uv_batches(patch_dir, batch_size=5))
+    paths = [p for _, _, batch_paths, _ in batches for p in batch_paths]
+    assert paths == [p for p in expand_paths(patch_dir) if p != str(bad)]
+    uv = np.concatenate([b[0] for b in batches])
+    np.testing.assert_allclose(uv, np.stack([np.load(p) for p in paths]))
+    np.testing.assert_allclose(np.concatenate([b[1] for b in batches]), magnitude_batch(uv))
+    labels = np.concatenate([b[3] for b in batches])
+    assert set(labels.tolist()) == {0, 1, 2}
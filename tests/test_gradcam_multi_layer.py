@@ -0,0 +1,19 @@
+import numpy as np
+
+from gradcam_engine import GradCamEngine, MultiLayerGradCam, select_layers
+from heatmap_overlay import resize_heatmaps
+
+
+def test_multi_layer_matches_single_layer(tiny_model, patches):
+    names = select_layers(tiny_model)
+    assert len(names) == 2
+    sweep = MultiLayerGradCam(tiny_model, names, batch_size=4)
+    maps = sweep.compute(patches[:5])
+    assert maps.shape == (5, 2, 64, 64)
+    for k, name in enumerate(names):
+        single = GradCamEngine(tiny_model, name, batch_size=4).compute(patches[:5])
+        np.testing.assert_allclose(maps[:, k], resize_heatmaps(single, (64, 64)), atol=1e-4)
+
+    fused = MultiLayerGradCam(tiny_model, names, batch_size=4, fuse="max").compute(patches[:5])
+    assert fused.shape == (5, 64, 64)
+    np.testing.assert_allclose(fused.max(axis=(1, 2))[fused.max(axis=(1, 2)) > 0], 1.0, atol=1e-6)
@@ -0,0 +1,31 @@
+import matplotlib
+import numpy as np
+
+from heatmap_overlay import colorize_heatmaps, get_lut, overlay_heatmaps, resize_heatmaps
+
+
+def test_colorize_matches_jet_lookup():
+    heatmaps = np.random.default_rng(0).random((3, 64, 64)).astype(np.float32)
+    colored = colorize_heatmaps(heatmaps)
+    jet = matplotlib.colormaps["jet"](np.arange(256))[:, :3]
+    expected = jet[np.rint(heatmaps * 255).astype(int)]
+    np.testing.assert_allclose(colored, expected, atol=1e-6)
+
+
+def test_resize_then_colorize_only_uses_lut_colors():
+    heatmaps = np.random.default_rng(1).random((2, 8, 8)).astype(np.float32)
+    assert resize_heatmaps(heatmaps, (64, 64)).shape == (2, 64, 64)
+    colored = colorize_heatmaps(heatmaps, size=(64, 64))
+    assert colored.shape == (2, 64, 64, 3)
+    lut = {tuple(c) for c in get_lut().round(6)}
+    assert {tuple(c) for c in colored.reshape(-1, 3).round(6)} <= lut
+
+
+def test_overlay_blends_scaled_background():
+    heatmaps = np.zeros((2, 16, 16), np.float32)
+    background = np.stack([np.full((64, 64, 1), 5.0), np.arange(64 * 64).reshape(64, 64, 1)]).astype(np.float32)
+    out = overlay_heatmaps(heatmaps, background, alpha=0.4)
+    assert out.shape == (2, 64, 64, 3)
+    # Constant background scales to 0; the ramp spans [0, 1]
+    np.testing.assert_allclose(out[0], np.broadcast_to(0.4 * get_lut()[0], (64, 64, 3)), atol=1e-6)
+    np.testing.assert_allclose(out[1, -1, -1], 0.6 + 0.4 * get_lut()[0], atol=1e-6)
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from inference_service import InferenceServer, MicroBatcher, _Request, connect, predict
+
+
+@pytest.fixture(scope="module")
+def server(tiny_model, other_tiny_model):
+    batcher = MicroBatcher({"a": tiny_model, "b": other_tiny_model}, max_batch_size=4, max_wait_ms=200)
+    server = InferenceServer(batcher, port=0)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    yield server
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def _get(server, path):
+    conn = connect(port=server.port)
+    conn.request("GET", path)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def _post(server, body):
+    conn = connect(port=server.port)
+    conn.request("POST", "/predict", body, {"Content-Type": "application/json"})
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def test_health(server):
+    assert _get(server, "/health") == (200, {"status": "ok", "models": ["a", "b"]})
+
+
+def test_concurrent_requests_are_batched(server, tiny_model, flows, patches):
+    uv = flows[0][:8]
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda patch: predict(connect(port=server.port), patch), uv))
+
+    expected = _softmax(tiny_model.predict(patches[:8], verbose=0))
+    got = np.array([r["models"]["a"]["probabilities"] for r in results])
+    np.testing.assert_allclose(got, expected, atol=1e-5)
+
+    status, metrics = _get(server, "/metrics")
+    assert status == 200 and metrics["queue_depth"] == 0
+    assert metrics["counters"]["patches"] >= 8
+    assert metrics["mean_batch_size"] > 1
+    assert metrics["latency_ms"]["request"]["count"] >= 8
+
+
+def test_a_lone_request_runs_at_batch_one(tiny_model, other_tiny_model, flows):
+    batcher = MicroBatcher({"a": tiny_model, "b": other_tiny_model}, max_batch_size=8)
+    sizes = []
+    for runner in batcher._runners.values():
+        forward = runner._forward
+        runner._forward = lambda x, forward=forward: sizes.append(len(x)) or forward(x)
+    step = batcher._comparison._step
+    batcher._comparison._step = lambda x, index: sizes.append(len(x)) or step(x, index)
+
+    batcher._warm_up()
+    assert sizes == [1, 1, 2, 2, 4, 4, 8, 8] + [1, 2, 4, 8]
+    del sizes[:]
+    uv = flows[0]
+    batcher._compute([_Request(uv[0], False, None)])
+    batcher._compute([_Request(uv[0], True, None)])
+    batcher._compute([_Request(patch, False, None) for patch in uv[:3]])
+    assert sizes == [1, 1, 1, 4, 4]
+
+
+def test_heatmaps_on_request(server, flows):
+    result = predict(connect(port=server.port), flows[0][0], heatmaps=True)
+    for entry in result["models"].values():
+        assert np.asarray(entry["heatmap"]).ndim == 2
+        assert entry["class"] in ("CCW", "CW", "SADDLE")
+
+
+@pytest.mark.parametrize("body", [
+    "not json",
+    json.dumps({"heatmaps": True}),
+    json.dumps({"uv": [[1.0, 2.0]]}),
+    json.dumps({"uv": "%%% not base64"}),
+    json.dumps([1, 2, 3]),
+])
+def test_malformed_bodies_are_rejected(server, body):
+    status, payload = _post(server, body)
+    assert status == 400 and "error" in payload
+
+
+def test_unknown_route(server):
+    assert _get(server, "/nope")[0] == 404
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from instrumentation import Tracer
+
+
+def test_spans_counters_and_stats():
+    tracer = Tracer()
+    for i in range(1, 101):
+        tracer.record("predict", 0.0, i * 1e-3)
+    with tracer.span("load"):
+        pass
+    tracer.count("patches", 8)
+    tracer.count("patches", 4)
+
+    stats = tracer.stats()
+    assert stats["predict"]["count"] == 100
+    assert stats["predict"]["total_s"] == pytest.approx(5.05)
+    assert stats["predict"]["p50_ms"] == pytest.approx(50.5)
+    assert stats["predict"]["p99_ms"] == pytest.approx(99.01)
+    assert stats["predict"]["max_ms"] == pytest.approx(100.0)
+    assert stats["load"]["count"] == 1
+    assert tracer.counters == {"patches": 12}
+    assert "predict" in tracer.summary() and "patches" in tracer.summary()
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer(enabled=False)
+    with tracer.span("load"):
+        pass
+    tracer.count("patches")
+    assert tracer.stats() == {} and tracer.counters == {}
+
+
+def test_chrome_trace_and_json(tmp_path):
+    tracer = Tracer(trace=True)
+    with tracer.span("gradcam"):
+        pass
+    tracer.write_chrome_trace(tmp_path / "trace.json")
+    tracer.write_json(tmp_path / "stats.json")
+
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert [(e["name"], e["ph"]) for e in events] == [("gradcam", "X")]
+    assert json.loads((tmp_path / "stats.json").read_text())["spans"]["gradcam"]["count"] == 1
+
+
+def test_untraced_tracer_keeps_no_events():
+    tracer = Tracer()
+    with tracer.span("render"):
+        pass
+    assert tracer.events == []
+
+
+def test_durations_are_a_bounded_window():
+    tracer = Tracer(window=10)
+    for i in range(1, 1001):
+        tracer.record("predict", 0.0, i * 1e-3)
+    assert len(tracer.durations["predict"]) == 10
+    stats = tracer.stats()["predict"]
+    assert stats["count"] == 1000
+    assert stats["total_s"] == pytest.approx(500.5)
+    assert stats["max_ms"] == pytest.approx(1000.0)
+    # Percentiles only see the last 10 spans, 991 to 1000 ms
+    assert stats["p50_ms"] == pytest.approx(995.5)
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from tensorflow import keras
+
+import memory_budget
+from gradcam_engine import GradCamComparison, GradCamEngine, get_gradcam_engine
+from memory_budget import (batch_size_for, bucket_size, footprint, interpreter_batch_size, interpreter_footprint,
+                           resolve_batch_size)
+from quantized_inference import TFLiteRunner, XLARunner, export_tflite
+
+
+def _available_for(model, samples):
+    # Host memory under which the default budget fits `samples` Grad-CAM patches
+    fixed, per_sample = memory_budget._fixed_and_per_sample([model], "gradcam")
+    return int((fixed + samples * per_sample) / memory_budget.DEFAULT_FRACTION)
+
+
+def test_train_estimate_keeps_the_backprop_tape(tiny_model):
+    prints = footprint(tiny_model)
+    assert prints.train > prints.gradcam > prints.predict
+    budget = 1 << 30
+    assert batch_size_for(tiny_model, "train", budget=budget) <= batch_size_for(tiny_model, "gradcam", budget=budget)
+
+
+def test_train_fixed_cost_counts_the_optimizer(tiny_model):
+    fixed, per_sample = memory_budget._fixed_and_per_sample([tiny_model], "train")
+    assert fixed == 4 * footprint(tiny_model).params
+    assert per_sample == footprint(tiny_model).train
+
+
+def test_batch_size_is_a_clamped_power_of_two(tiny_model):
+    per_sample = footprint(tiny_model).predict
+    fixed = footprint(tiny_model).params
+    assert batch_size_for(tiny_model, budget=fixed + 5 * per_sample) == 4
+    assert batch_size_for(tiny_model, budget=fixed + 5 * per_sample, limit=2) == 2
+    assert batch_size_for(tiny_model, budget=0, minimum=3) == 3
+
+
+def test_resolve_batch_size(tiny_model, monkeypatch):
+    assert resolve_batch_size(7, tiny_model) == 7
+    assert resolve_batch_size("7", tiny_model) == 7
+    monkeypatch.setattr(memory_budget, "available_memory", lambda: _available_for(tiny_model, 5))
+    assert resolve_batch_size("auto", tiny_model, "gradcam") == 4
+    assert resolve_batch_size(None, tiny_model, "gradcam") == 4
+
+
+def test_unknown_mode_is_rejected(tiny_model):
+    with pytest.raises(ValueError):
+        batch_size_for(tiny_model, "backprop")
+
+
+def test_defaults_resolve_to_an_int(tiny_model, monkeypatch):
+    monkeypatch.setattr(memory_budget, "available_memory", lambda: _available_for(tiny_model, 5))
+    assert GradCamEngine(tiny_model).batch_size == 4
+    assert GradCamComparison({"tiny": tiny_model}).batch_size == 4
+    assert XLARunner(tiny_model).batch_size == 32
+    assert XLARunner(tiny_model, batch_size="auto").batch_size >= 1
+
+
+def test_bucket_size():
+    assert [bucket_size(n, 32) for n in (0, 1, 2, 3, 5, 16, 17, 40)] == [1, 1, 2, 4, 8, 16, 32, 32]
+    assert bucket_size(5, 6) == 6
+
+
+def test_footprint_of_models_sharing_layers(tiny_model):
+    from conftest import make_tiny_model
+    from flow_scanner import split_trunk
+
+    model = make_tiny_model(seed=3)
+    expected = footprint(make_tiny_model(seed=3))[:-1]      # all but the layer name
+    split_trunk(model)                  # the trunk calls the same layers in a second graph
+    memory_budget._footprints.pop(model, None)
+    assert footprint(model)[:-1] == expected
+
+    # Layers first called in another graph: walked through a fresh copy
+    inputs = keras.Input((64, 64, 1))
+    x = inputs
+    for layer in model.layers[1:]:
+        x = layer(x)
+    assert footprint(keras.Model(inputs, x))[:-1] == expected
+
+
+def test_get_gradcam_engine_keys_on_the_resolved_batch(tiny_model, monkeypatch):
+    available = {"bytes": _available_for(tiny_model, 5)}
+    monkeypatch.setattr(memory_budget, "available_memory", lambda: available["bytes"])
+    engine = get_gradcam_engine(tiny_model)
+    assert engine.batch_size == 4
+
+    # Free memory drifts, but the same batch fits: the cached engine is reused
+    available["bytes"] = _available_for(tiny_model, 7)
+    assert get_gradcam_engine(tiny_model) is engine
+    assert get_gradcam_engine(tiny_model, batch_size=4) is engine
+
+    available["bytes"] = _available_for(tiny_model, 9)
+    bigger = get_gradcam_engine(tiny_model)
+    assert bigger is not engine and bigger.batch_size == 8
+
+
+def test_interpreter_footprint_and_auto_runner(tiny_model, patches, tmp_path):
+    path = export_tflite(tiny_model, str(tmp_path / "tiny.tflite"), mode="none")
+    fixed, per_sample = interpreter_footprint(path)
+    # At least the input patch and the logits grow with the batch
+    assert per_sample >= 64 * 64 * 4 + 3 * 4
+    assert fixed > 0
+
+    assert interpreter_batch_size(path, budget=fixed + 5 * per_sample) == 4
+    runner = TFLiteRunner(path, num_threads=1)
+    assert runner.batch_size >= 1 and runner.batch_size & (runner.batch_size - 1) == 0
+    np.testing.assert_allclose(runner.predict(patches), tiny_model.predict(patches, verbose=0), atol=1e-4)
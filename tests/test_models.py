@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from tensorflow import keras
+
+import models
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_builds_nothing():
+    code = "import models; print(len(models._models))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "0"
+
+
+def test_get_model_is_built_once_per_variant(cnn):
+    assert models.get_model("cnn", weights=None, logits=True) is cnn
+    softmax = models.get_model("cnn", weights=None)
+    assert softmax is not cnn
+    assert cnn.layers[-1].activation is keras.activations.linear
+    assert softmax.layers[-1].activation is keras.activations.softmax
+
+
+def test_weights_are_loaded_from_the_configured_path(tmp_path, cnn):
+    path = str(tmp_path / "cnn.weights.h5")
+    cnn.save_weights(path)
+    loaded = models.get_model("cnn", weights=path, logits=True)
+    assert loaded is not cnn
+    x = np.random.default_rng(0).random((2, 64, 64, 1)).astype(np.float32)
+    np.testing.assert_allclose(loaded.predict(x, verbose=0), cnn.predict(x, verbose=0), rtol=1e-5, atol=1e-5)
+
+
+def test_bad_names_and_missing_weights():
+    with pytest.raises(ValueError):
+        models.get_model("vgg")
+    with pytest.raises(ValueError):
+        models.set_weights_path("vgg", None)
+    with pytest.raises(FileNotFoundError):
+        models.get_model("cnn", weights="/nonexistent/30.h5")
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from panel_renderer import PanelRenderer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _item(path, uv):
+    overlay = np.zeros((64, 64, 3), np.float32)
+    return {"path": path, "U": uv[0], "V": uv[1], "image": np.hypot(uv[0], uv[1]).T,
+            "overlays": {"cnn": overlay, "resnet": overlay, "u_net": overlay},
+            "classes": {"cnn": "CW", "resnet": "CW", "u_net": "CCW"}}
+
+
+def test_renderer_writes_panels_and_collects_errors(tmp_path, flows):
+    uv = flows[0]
+    broken = {"path": "broken.npy", "U": uv[0, 0], "V": np.zeros((3, 3)), "image": np.zeros((64, 64)),
+              "overlays": {}}
+    # In memory only: no U/V and a path that does not exist
+    magnitude_only = {key: value for key, value in _item("in-memory", uv[3]).items() if key not in ("U", "V")}
+    with PanelRenderer(str(tmp_path / "panels"), num_workers=2, fast=True) as renderer:
+        for i in range(3):
+            renderer.submit(_item(f"patch-{i}.npy", uv[i]), name=str(i))
+        renderer.submit(magnitude_only, name="3")
+        renderer.submit(broken, name="broken")
+    assert sorted(os.path.basename(p) for p in renderer.written) == ["0.png", "1.png", "2.png", "3.png"]
+    assert [os.path.basename(p) for p, _ in renderer.errors] == ["broken.png"]
+    assert isinstance(renderer.errors[0][1], ValueError)
+    # Finished panels are not kept around
+    assert not renderer._pending
+
+
+def test_failed_submit_releases_its_slot(tmp_path, flows):
+    renderer = PanelRenderer(str(tmp_path / "panels"), num_workers=1, max_pending=1)
+    renderer.close()
+    for _ in range(2):
+        # A leaked slot would make the second call block forever
+        with pytest.raises(RuntimeError):
+            renderer.submit(_item("patch.npy", flows[0][0]), name="late")
+
+
+def test_grad_cam_top_level_does_not_import_tensorflow():
+    # What a spawned render worker re-imports as __mp_main__
+    out = subprocess.run([sys.executable, "-c", "import sys, grad_cam; print('tensorflow' in sys.modules)"],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "False"
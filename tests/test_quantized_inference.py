@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from flow_data import expand_paths
+from flow_shards import pack_flow_patches
+from quantized_inference import TFLiteRunner, XLARunner, accuracy_drift, export_tflite
+
+
+@pytest.fixture(scope="module")
+def tflite_path(tiny_model, tmp_path_factory):
+    return export_tflite(tiny_model, str(tmp_path_factory.mktemp("tflite") / "tiny.tflite"), mode="none")
+
+
+def test_xla_runner_matches_keras(tiny_model, patches):
+    runner = XLARunner(tiny_model, batch_size=5)
+    np.testing.assert_allclose(runner.predict(patches), tiny_model.predict(patches, verbose=0), atol=1e-4)
+
+
+def test_xla_runner_pads_to_the_smallest_bucket(tiny_model, patches):
+    runner = XLARunner(tiny_model, batch_size=8)
+    forward, sizes = runner._forward, []
+    runner._forward = lambda x: sizes.append(len(x)) or forward(x)
+    np.testing.assert_allclose(runner.predict(patches[:1]), tiny_model.predict(patches[:1], verbose=0), atol=1e-4)
+    runner.predict(patches[:11])
+    assert sizes == [1, 8, 4]
+
+
+def test_tflite_runner_matches_keras(tiny_model, patches, tflite_path):
+    runner = TFLiteRunner(tflite_path, num_threads=1, batch_size=5)
+    np.testing.assert_allclose(runner.predict(patches), tiny_model.predict(patches, verbose=0), atol=1e-4)
+
+
+def test_empty_input_gives_empty_predictions(tiny_model, tflite_path):
+    empty = np.zeros((0, 64, 64, 1), np.float32)
+    assert XLARunner(tiny_model, batch_size=4).predict(empty).shape == (0, 3)
+    assert TFLiteRunner(tflite_path, batch_size=4).predict(empty).shape == (0, 3)
+
+
+def test_accuracy_drift_of_an_exact_runner(tiny_model, patch_dir, tmp_path):
+    shards = pack_flow_patches(expand_paths(patch_dir), str(tmp_path / "shards"))
+    drift = accuracy_drift(tiny_model, XLARunner(tiny_model, batch_size=4), shards, batch_size=4)
+    assert drift["patches"] == drift["labeled"] == len(shards)
+    assert drift["agreement"] == 1.0
+    assert drift["accuracy"] == drift["fp32_accuracy"]
+    assert drift["max_abs_diff"] < 1e-3
@@ -0,0 +1,60 @@
+import numpy as np
+
+from gradcam_engine import GradCamComparison
+from result_cache import CachedComparison, ResultCache
+
+
+def _item(key, value):
+    return key, np.full(3, value, np.float32), 1, np.full((4, 4), value, np.float32)
+
+
+def test_hits_misses_and_persistence(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResultCache(path)
+    cache.put_many([_item("a", 0.5), _item("b", 2.0)])
+    found = cache.get_many(["a", "b", "c"])
+    assert set(found) == {"a", "b"} and (cache.hits, cache.misses) == (2, 1)
+    np.testing.assert_array_equal(found["b"].heatmaps, np.full((4, 4), 2.0))
+    cache.close()
+
+    reopened = ResultCache(path)
+    assert len(reopened) == 2
+    np.testing.assert_array_equal(reopened.get_many(["a"])["a"].predictions, np.full(3, 0.5))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    entry = 3 * 4 + 16 * 2
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), max_bytes=2 * entry)
+    cache.put_many([_item("a", 1.0)])
+    cache.put_many([_item("b", 1.0)])
+    cache.get_many(["a"])                   # "b" is now the oldest
+    cache.put_many([_item("c", 1.0)])
+    assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
+    assert cache.size_bytes() <= 2 * entry
+
+
+def test_access_updates_are_one_transaction(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResultCache(path)
+    cache.put_many([_item(str(i), 1.0) for i in range(50)])
+    commits = []
+    cache._db.set_trace_callback(lambda sql: commits.append(sql) if sql == "COMMIT" else None)
+    cache.get_many([str(i) for i in range(50)])
+    assert commits == ["COMMIT"]
+
+
+def test_cached_comparison_only_computes_new_patches(tiny_model, other_tiny_model, patches, tmp_path):
+    comparison = GradCamComparison({"a": tiny_model, "b": other_tiny_model}, batch_size=4)
+    computed = []
+    compute = comparison.compute
+    comparison.compute = lambda x, pred_index=None: computed.append(len(x)) or compute(x, pred_index)
+    cached = CachedComparison(comparison, ResultCache(str(tmp_path / "cache.sqlite")))
+
+    first = cached.compute(patches[:8])
+    again = cached.compute(patches)
+    assert computed == [8, 4]
+    expected = compute(patches)
+    for name in ("a", "b"):
+        np.testing.assert_array_equal(first[name].classes, expected[name].classes[:8])
+        np.testing.assert_allclose(again[name].heatmaps, expected[name].heatmaps, atol=1e-3)
+        np.testing.assert_allclose(again[name].predictions, expected[name].predictions, atol=1e-5)
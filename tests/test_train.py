@@ -0,0 +1,104 @@
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+import tensorflow as tf
+from tensorflow import keras
+
+from conftest import make_tiny_model
+from train import Throughput, TrainingBackup, labeled_dataset, train
+
+
+class _Crash(Exception):
+    pass
+
+
+def _compiled(seed=0):
+    model = make_tiny_model(seed)
+    model.compile(optimizer=keras.optimizers.Adam(1e-3),
+                  loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True))
+    return model
+
+
+def test_backup_restores_the_last_step(patches, flows, tmp_path):
+    labels = flows[1].astype(np.int32)
+    backup_dir = str(tmp_path / "backup")
+
+    def crash(batch, logs):
+        if crashed_epoch[0] == 1 and batch == 1:
+            raise _Crash()
+
+    crashed_epoch = [0]
+    callbacks = [TrainingBackup(backup_dir, save_freq=2),
+                 keras.callbacks.LambdaCallback(on_epoch_begin=lambda e, logs: crashed_epoch.__setitem__(0, e),
+                                                on_train_batch_end=crash)]
+    model = _compiled()
+    with pytest.raises(_Crash):
+        model.fit(patches, labels, batch_size=4, epochs=3, callbacks=callbacks, verbose=0)
+
+    # 3 steps per epoch: the last save was after step 4, inside epoch 1
+    with open(os.path.join(backup_dir, "state.json")) as fh:
+        state = json.load(fh)
+    assert (state["epoch"], state["steps"]) == (1, 4)
+    assert len([f for f in os.listdir(backup_dir) if f.endswith(".weights.h5")]) == 1
+
+    restored = _compiled(seed=1)
+    assert TrainingBackup(backup_dir).restore(restored) == 1
+    assert restored.optimizer.iterations.numpy() == 4
+
+
+def test_no_backup_starts_at_epoch_zero(tmp_path):
+    assert TrainingBackup(str(tmp_path / "none")).restore(_compiled()) == 0
+
+
+def test_labeled_dataset_counts_only_labeled_patches(patch_dir, tmp_path):
+    unlabeled = tmp_path / "other"
+    unlabeled.mkdir()
+    np.save(unlabeled / "x.npy", np.zeros((2, 64, 64), np.float32))
+    ds, count = labeled_dataset([patch_dir, str(unlabeled / "*.npy")], 5, "onehot", shuffle=False)
+    batches = list(ds)
+    assert count == 12 and sum(len(x) for x, _ in batches) == 12
+    assert batches[0][1].shape == (5, 3)
+
+
+def test_train_resumes_after_the_last_epoch(patch_dir, tmp_path):
+    out = str(tmp_path / "run")
+    kwargs = dict(val_sources=[patch_dir], batch_size=4, mixed_precision="off", checkpoint_every=2)
+    history = train("cnn", [patch_dir], out, epochs=1, **kwargs)
+    assert history.epoch == [0] and len(history.history["val_loss"]) == 1
+    assert os.path.exists(os.path.join(out, "cnn.weights.h5"))
+
+    history = train("cnn", [patch_dir], out, epochs=2, **kwargs)
+    assert history.epoch == [1]
+
+
+def test_resume_keeps_the_step_count(patches, flows, tmp_path):
+    labels = flows[1].astype(np.int32)
+    backup_dir = str(tmp_path / "backup")
+    _compiled().fit(patches, labels, batch_size=4, epochs=1, verbose=0,
+                    callbacks=[TrainingBackup(backup_dir, save_freq=2)])
+
+    backup = TrainingBackup(backup_dir, save_freq=2)
+    model = _compiled()
+    start = backup.restore(model)
+    model.fit(patches, labels, batch_size=4, epochs=2, initial_epoch=start, verbose=0, callbacks=[backup])
+    with open(os.path.join(backup_dir, "state.json")) as fh:
+        state = json.load(fh)
+    # 3 steps per epoch: the numbering goes on from step 3 instead of restarting
+    assert (state["epoch"], state["steps"]) == (2, 6)
+    assert state["weights"].startswith("state-00000006-")
+
+
+def test_throughput_counts_real_samples_and_skips_validation(patches, flows):
+    labels = flows[1].astype(np.int32)
+    ds = tf.data.Dataset.from_tensor_slices((patches, labels)).batch(5)
+    throughput = Throughput(5, samples_per_epoch=len(patches))
+    slow_validation = keras.callbacks.LambdaCallback(on_test_begin=lambda logs: time.sleep(0.5))
+    model = _compiled()
+    model.fit(ds.repeat(), steps_per_epoch=3, validation_data=ds, epochs=1, verbose=0,
+              callbacks=[throughput, slow_validation])
+    # Batches of 5, 5 and 2
+    assert throughput.samples == len(patches)
+    assert 0 < throughput.elapsed < 0.5
@@ -0,0 +1,377 @@
+"""Training entry point for the three classifier architectures.
+
+    python train.py cnn --train "patches/centered_*/*.npy" shards/ --val val_shards/ \\
+        --out runs/cnn --epochs 30 --batch-size 64
+
+Labeled patches stream from .npy globs (labels from the directory names, see
+flow_shards.label_from_path) and/or shard directories, decoded in parallel
+and prefetched with tf.data; unlabeled patches are left out.
+
+The original compile settings disagree (summed categorical cross-entropy for
+cnn, sparse categorical cross-entropy for resnet, binary cross-entropy on a
+3-way softmax for u_net). Here every architecture trains its logits (the
+same network get_model(..., logits=True) uses) with one loss per label
+format:
+
+    --labels sparse   class indices, SparseCategoricalCrossentropy(from_logits=True)
+    --labels onehot   one-hot targets, CategoricalCrossentropy(from_logits=True),
+                      which also allows --label-smoothing
+
+The saved weights load into build_model(name) as usual, e.g. through
+models.set_weights_path(name, "runs/cnn/cnn.weights.h5").
+
+--batch-size auto picks the largest per-replica batch whose activations,
+gradients and optimizer state fit the memory budget (memory_budget.py).
+
+Training state (weights, optimizer slots and the epoch) is backed up every
+--checkpoint-every steps and at every epoch end under out/backup; re-running
+the same command resumes from it, at the start of the epoch that was
+interrupted. Samples per second are logged per epoch and written to
+out/history.csv.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+
+from flow_data import CLASS_NAMES, PATCH_SHAPE, FlowPatchLoader, expand_paths
+from flow_shards import INDEX_FILE, FlowShards, label_from_path
+from memory_budget import memory_budget, resolve_batch_size
+from models import MODEL_NAMES, build_model
+
+log = logging.getLogger("train")
+
+NUM_CLASSES = len(CLASS_NAMES)
+
+
+def _shard_elements(shard_dir, block, shuffle):
+    # Contiguous blocks of rows are read straight from the memmaps (in
+    # parallel, in shuffled order), then split into single patches
+    shards = FlowShards(shard_dir)
+    starts = np.arange(0, len(shards), block, dtype=np.int64)
+
+    def load(start):
+        return (np.asarray(shards.magnitude(start, start + block), dtype=np.float32),
+                np.asarray(shards.labels(start, start + block), dtype=np.int32))
+
+    def decode(start):
+        patches, labels = tf.numpy_function(load, [start], [tf.float32, tf.int32], stateful=False)
+        patches.set_shape((None,) + PATCH_SHAPE)
+        labels.set_shape((None,))
+        return patches, labels
+
+    ds = tf.data.Dataset.from_tensor_slices(starts)
+    if shuffle:
+        ds = ds.shuffle(len(starts), reshuffle_each_iteration=True)
+    ds = ds.map(decode, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    return ds.unbatch(), len(shards)
+
+
+def _file_elements(paths, block, shuffle):
+    labeled = [p for p in paths if label_from_path(p) >= 0]
+    if not labeled:
+        return None, 0
+    table = tf.lookup.StaticHashTable(
+        tf.lookup.KeyValueTensorInitializer(
+            tf.constant(labeled), tf.constant([label_from_path(p) for p in labeled], dtype=tf.int32)),
+        default_value=-1)
+    loader = FlowPatchLoader(labeled, batch_size=block, shuffle=len(labeled) if shuffle else 0,
+                             deterministic=not shuffle)
+    ds = loader.dataset().map(lambda patches, paths: (patches, table.lookup(paths)))
+    return ds.unbatch(), len(labeled)
+
+
+def labeled_dataset(sources, batch_size, label_format="sparse", shuffle=True, shuffle_buffer=8192, block=256):
+    """
+    (patches, labels) batches from .npy globs and/or shard directories.
+
+    Sources are interleaved in proportion to their size. label_format
+    "sparse" gives int32 class indices, "onehot" float32 one-hot rows.
+    Returns (dataset, number of labeled patches).
+    """
+    if isinstance(sources, str):
+        sources = [sources]
+    parts, files = [], []
+    for source in sources:
+        if os.path.isdir(source) and os.path.exists(os.path.join(source, INDEX_FILE)):
+            parts.append(_shard_elements(source, block, shuffle))
+        else:
+            files.extend(expand_paths(source))
+    if files:
+        parts.append(_file_elements(files, block, shuffle))
+    parts = [(ds, n) for ds, n in parts if n]
+    if not parts:
+        raise ValueError(f"no labeled patches in {sources}")
+
+    total = sum(n for _, n in parts)
+    if len(parts) == 1:
+        ds = parts[0][0]
+    else:
+        ds = tf.data.Dataset.sample_from_datasets([d for d, _ in parts], weights=[n / total for _, n in parts],
+                                                  stop_on_empty_dataset=False)
+    ds = ds.filter(lambda patch, label: label >= 0)
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    if label_format == "onehot":
+        ds = ds.map(lambda patches, labels: (patches, tf.one_hot(labels, NUM_CLASSES)),
+                    num_parallel_calls=tf.data.AUTOTUNE)
+    elif label_format != "sparse":
+        raise ValueError(f"Unknown label format {label_format!r}, expected 'sparse' or 'onehot'.")
+    return ds.prefetch(tf.data.AUTOTUNE), total
+
+
+def loss_and_metric(label_format, label_smoothing=0.0):
+    """The one loss (on logits) and accuracy metric for a label format."""
+    if label_format == "sparse":
+        if label_smoothing:
+            raise ValueError("label smoothing needs --labels onehot")
+        return keras.losses.SparseCategoricalCrossentropy(from_logits=True), keras.metrics.SparseCategoricalAccuracy()
+    if label_format == "onehot":
+        return (keras.losses.CategoricalCrossentropy(from_logits=True, label_smoothing=label_smoothing),
+                keras.metrics.CategoricalAccuracy())
+    raise ValueError(f"Unknown label format {label_format!r}, expected 'sparse' or 'onehot'.")
+
+
+def set_precision(mode):
+    """
+    Pick the Keras dtype policy: "off", "on" or "auto".
+
+    auto only turns mixed precision on for GPUs with float16 tensor cores
+    (compute capability 7.0+); on forces mixed_float16 on a GPU and
+    mixed_bfloat16 on a CPU. Returns the policy name.
+    """
+    gpus = tf.config.list_physical_devices("GPU")
+    policy = "float32"
+    if mode == "on":
+        policy = "mixed_float16" if gpus else "mixed_bfloat16"
+    elif mode == "auto" and gpus:
+        capability = tf.config.experimental.get_device_details(gpus[0]).get("compute_capability", (0, 0))
+        if capability >= (7, 0):
+            policy = "mixed_float16"
+    elif mode not in ("auto", "off"):
+        raise ValueError(f"Unknown mixed precision mode {mode!r}, expected 'auto', 'on' or 'off'.")
+    keras.mixed_precision.set_global_policy(policy)
+    return policy
+
+
+def make_strategy(kind="default", cpu_replicas=1):
+    """
+    tf.distribute strategy: "default" (one device) or "mirrored".
+
+    Mirrored uses every GPU, or with cpu_replicas > 1 that many logical CPU
+    devices. Must run before TensorFlow initializes its devices.
+    """
+    if kind == "default":
+        return tf.distribute.get_strategy()
+    if kind != "mirrored":
+        raise ValueError(f"Unknown strategy {kind!r}, expected 'default' or 'mirrored'.")
+    if cpu_replicas > 1:
+        cpu = tf.config.list_physical_devices("CPU")[0]
+        tf.config.set_logical_device_configuration(
+            cpu, [tf.config.LogicalDeviceConfiguration() for _ in range(cpu_replicas)])
+        return tf.distribute.MirroredStrategy([f"/cpu:{i}" for i in range(cpu_replicas)])
+    return tf.distribute.MirroredStrategy()
+
+
+def build_training_model(name):
+    """
+    (network, training model) for `name`.
+
+    network is build_model(name) with a linear last layer; its weights are
+    what gets saved. The training model adds a float32 output cast so the
+    loss sees float32 logits under mixed precision.
+    """
+    network = build_model(name)
+    network.layers[-1].activation = keras.activations.linear
+    logits = layers.Activation("linear", dtype="float32", name="logits")(network.output)
+    return network, keras.Model(network.input, logits)
+
+
+class TrainingBackup(keras.callbacks.Callback):
+    """
+    Saves the training state every `save_freq` steps and at every epoch end.
+
+    Each save writes a new weights file (model and optimizer variables) and
+    then atomically swaps in state.json naming it and the epoch to resume
+    at, so a crash at any point leaves the previous state readable. Call
+    restore() before fit() and pass what it returns as initial_epoch.
+    """
+    def __init__(self, backup_dir, save_freq=None):
+        super().__init__()
+        self.backup_dir = backup_dir
+        self.save_freq = save_freq or None
+        self._state_path = os.path.join(backup_dir, "state.json")
+        self._epoch = 0
+        self._steps = 0
+
+    def restore(self, model):
+        """Load the last saved state into `model`; returns the epoch to start at (0 if none)."""
+        if not os.path.exists(self._state_path):
+            return 0
+        with open(self._state_path) as fh:
+            state = json.load(fh)
+        if model.optimizer is not None and not model.optimizer.built:
+            model.optimizer.build(model.trainable_variables)
+        model.load_weights(os.path.join(self.backup_dir, state["weights"]))
+        # Keeps the checkpoint cadence and the file numbering going
+        self._steps = state["steps"]
+        log.info("resuming from %s at epoch %d", self.backup_dir, state["epoch"] + 1)
+        return state["epoch"]
+
+    def _save(self, epoch):
+        os.makedirs(self.backup_dir, exist_ok=True)
+        weights = f"state-{self._steps:08d}-{epoch:04d}.weights.h5"
+        self.model.save_weights(os.path.join(self.backup_dir, weights))
+        tmp = self._state_path + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump({"epoch": epoch, "steps": self._steps, "weights": weights}, fh)
+        os.replace(tmp, self._state_path)
+        for old in glob.glob(os.path.join(self.backup_dir, "state-*.weights.h5")):
+            if os.path.basename(old) != weights:
+                os.remove(old)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps += 1
+        if self.save_freq and self._steps % self.save_freq == 0:
+            # Mid-epoch: a resume redoes this epoch from its start
+            self._save(self._epoch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._save(epoch + 1)
+
+
+class Throughput(keras.callbacks.Callback):
+    """
+    Logs training samples per second for every epoch and adds it to the epoch logs.
+
+    The clock runs from the start of an epoch's first train batch to the end
+    of its last one, so validation is left out. With samples_per_epoch (an
+    epoch is one pass over a dataset whose last batch may be short) the
+    batches count their real samples instead of batch_size each.
+    """
+    def __init__(self, batch_size, samples_per_epoch=None):
+        super().__init__()
+        self.batch_size = batch_size
+        self.samples_per_epoch = samples_per_epoch
+        self.samples = 0
+        self.elapsed = 0.0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._first = self._last = None
+        self._batches = 0
+        self.samples = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self._first is None:
+            self._first = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._last = time.perf_counter()
+        self._batches += 1
+        if self.samples_per_epoch is None:
+            self.samples += self.batch_size
+        else:
+            # Full batches, then what is left of the pass
+            self.samples += max(min(self.batch_size, self.samples_per_epoch - batch * self.batch_size), 0)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.elapsed = self._last - self._first if self._batches else 0.0
+        rate = self.samples / self.elapsed if self.elapsed > 0 else 0.0
+        if logs is not None:
+            logs["samples_per_s"] = rate
+        log.info("epoch %d: %.0f samples/s (%d samples in %d steps, %.1f s)", epoch + 1, rate, self.samples,
+                 self._batches, self.elapsed)
+
+
+def train(name, train_sources, out_dir, val_sources=None, epochs=30, batch_size=64, label_format="sparse",
+          label_smoothing=0.0, learning_rate=1e-3, mixed_precision="auto", strategy="default",
+          cpu_replicas=1, checkpoint_every=1000, shuffle_buffer=8192):
+    """Train (or resume training) `name`; returns the keras History."""
+    if name not in MODEL_NAMES:
+        raise ValueError(f"I don't recognize the name of that model: {name!r}")
+    os.makedirs(out_dir, exist_ok=True)
+    strategy = make_strategy(strategy, cpu_replicas)
+    policy = set_precision(mixed_precision)
+    with strategy.scope():
+        network, model = build_training_model(name)
+        loss, metric = loss_and_metric(label_format, label_smoothing)
+        model.compile(optimizer=keras.optimizers.Adam(learning_rate=learning_rate), loss=loss, metrics=[metric])
+
+    # CPU replicas share the host's memory, GPU replicas have their own
+    share = 1 if tf.config.list_physical_devices("GPU") else strategy.num_replicas_in_sync
+    batch_size = resolve_batch_size(batch_size, model, "train", budget=memory_budget(share=share))
+    global_batch = batch_size * strategy.num_replicas_in_sync
+    log.info("%s on %d replica(s), policy %s, global batch %d", name, strategy.num_replicas_in_sync, policy,
+             global_batch)
+
+    # Both datasets repeat and every epoch takes a fixed number of steps, so
+    # neither iterator runs out of data at the end of an epoch
+    train_ds, train_count = labeled_dataset(train_sources, global_batch, label_format,
+                                            shuffle=True, shuffle_buffer=shuffle_buffer)
+    val_ds = val_steps = None
+    if val_sources:
+        val_ds, val_count = labeled_dataset(val_sources, global_batch, label_format, shuffle=False)
+        val_ds, val_steps = val_ds.repeat(), math.ceil(val_count / global_batch)
+    log.info("%d labeled training patches", train_count)
+
+    backup = TrainingBackup(os.path.join(out_dir, "backup"), save_freq=checkpoint_every)
+    initial_epoch = backup.restore(model)
+    callbacks = [
+        backup,
+        Throughput(global_batch, train_count),
+        keras.callbacks.CSVLogger(os.path.join(out_dir, "history.csv"), append=True),
+        keras.callbacks.LambdaCallback(on_epoch_end=lambda epoch, logs: network.save_weights(
+            os.path.join(out_dir, f"{name}-epoch{epoch + 1:03d}.weights.h5"))),
+    ]
+    history = model.fit(train_ds.repeat(), steps_per_epoch=math.ceil(train_count / global_batch),
+                        validation_data=val_ds, validation_steps=val_steps, epochs=epochs,
+                        initial_epoch=initial_epoch, callbacks=callbacks, verbose=2)
+    network.save_weights(os.path.join(out_dir, f"{name}.weights.h5"))
+    return history
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("model", choices=MODEL_NAMES)
+    parser.add_argument("--train", nargs="+", required=True, help="globs of .npy patches and/or shard directories")
+    parser.add_argument("--val", nargs="*", default=None)
+    parser.add_argument("--out", required=True, help="run directory for checkpoints, weights and history")
+    parser.add_argument("--epochs", type=int, default=30)
+    parser.add_argument("--batch-size", default="64", help='per replica; "auto" fits it to the memory budget')
+    parser.add_argument("--labels", choices=("sparse", "onehot"), default="sparse")
+    parser.add_argument("--label-smoothing", type=float, default=0.0)
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--mixed-precision", choices=("auto", "on", "off"), default="auto")
+    parser.add_argument("--strategy", choices=("default", "mirrored"), default="default")
+    parser.add_argument("--cpu-replicas", type=int, default=1)
+    parser.add_argument("--checkpoint-every", type=int, default=1000, help="steps; 0 for once per epoch")
+    parser.add_argument("--shuffle-buffer", type=int, default=8192)
+    parser.add_argument("--log-level", default="INFO")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(name)s %(message)s")
+    train(args.model, args.train, args.out, args.val, args.epochs, args.batch_size, args.labels,
+          args.label_smoothing, args.learning_rate, args.mixed_precision, args.strategy, args.cpu_replicas,
+          args.checkpoint_every, args.shuffle_buffer)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())